@@ -0,0 +1,105 @@
+"""
+An asyncio transport for Node messaging. Every attached node gets an inbound
+message queue drained by its own task, so a send never runs the receiver on the
+sender's stack and one server can interleave messages from many sync sessions.
+Nodes without a transport keep delivering messages synchronously.
+"""
+from __future__ import print_function, unicode_literals
+
+import asyncio
+import timeit
+
+from wireFormat import messageRecords
+
+
+class AsyncTransport(object):
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        # Inbound message queue per attached node
+        self.queues = {}
+        self.tasks = []
+        # Messages sent but not yet handled by their receiver
+        self.pending = 0
+        # Set whenever there are no pending messages
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # First exception raised while a node was handling a message
+        self.error = None
+        # Total messages delivered and the deepest any queue has been
+        self.delivered = 0
+        self.maxQueueDepth = 0
+        # Records held by the messages waiting in each queue, and the most any queue has held
+        self.queuedRecords = {}
+        self.maxQueuedRecords = 0
+
+    def attach(self, *nodes):
+        """
+        Route all messages sent by the given nodes through this transport
+        """
+        for node in nodes:
+            node.transport = self
+            self.queues[node] = asyncio.Queue()
+            self.queuedRecords[node] = 0
+
+    def send(self, sender, receiver, sessionID, data):
+        """
+        Called by Node.send, queues the message on the receiver and returns immediately
+        """
+        queue = self.queues[receiver]
+        self.pending = self.pending + 1
+        self.idle.clear()
+        queue.put_nowait((sender, sessionID, data, timeit.default_timer()))
+        self.maxQueueDepth = max(self.maxQueueDepth, queue.qsize())
+        self.queuedRecords[receiver] = self.queuedRecords[receiver] + messageRecords(data)
+        self.maxQueuedRecords = max(self.maxQueuedRecords, self.queuedRecords[receiver])
+
+    async def run(self, node):
+        """
+        Message loop of a node : hands every inbound message to Node.receive
+        """
+        queue = self.queues[node]
+        while True:
+            sender, sessionID, data, sentAt = await queue.get()
+            if node.metrics is not None:
+                node.metrics.time(node, sessionID, "transfer", timeit.default_timer() - sentAt)
+            self.queuedRecords[node] = self.queuedRecords[node] - messageRecords(data)
+            try:
+                node.receive(sender, sessionID, data)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.delivered = self.delivered + 1
+                self.pending = self.pending - 1
+                if self.pending == 0:
+                    self.idle.set()
+            # Let the other nodes' loops run between messages
+            await asyncio.sleep(0)
+
+    def start(self):
+        """
+        Starts the message loop of every attached node, must be called from a running event loop
+        """
+        self.tasks = [asyncio.ensure_future(self.run(node)) for node in self.queues]
+
+    async def drain(self):
+        """
+        Waits until every message sent so far, and every message sent in reply, has been handled
+        """
+        await self.idle.wait()
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    async def stop(self):
+        """
+        Cancels the message loops
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
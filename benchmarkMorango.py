@@ -0,0 +1,714 @@
+"""
+Timing benchmarks for the Node sync paths.
+Run as a script : python benchmarkMorango.py
+"""
+from __future__ import print_function, unicode_literals
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import tempfile
+import timeit
+import tracemalloc
+
+from asyncTransport import AsyncTransport
+from experimentRunner import runExperiment, summarize
+from networkSimulator import Link, NetworkSimulator
+from payloadCompression import CODECS, compressRecords, decompressRecords
+from simulateNode import Node
+from storeEngine import SQLiteStoreEngine
+from storeRecord import StoreRecord
+from topology import addAppRecordDiff, createNodes, endConditionData, eventualFullMerge, fullDBReplication, \
+    fullDBSync, sessionsFull, sessionsStar
+from trafficTrace import TraceRecorder, replayTrace
+from wireFormat import WireDecoder, WireEncoder
+
+
+def createServer(numRecords):
+    """
+    Creates a node holding numRecords serialized records
+    """
+    server = Node("server")
+    for i in range(numRecords):
+        server.addAppData("record" + str(i), "data " + str(i), "", "")
+    server.serialize(("", ""))
+    return server
+
+
+def benchIntegration(sizes=(1000, 5000, 10000, 50000), storeEngine=None):
+    """
+    Times a fresh client pulling every record of a server. Integration is linear
+    when the time per record stays flat as the number of records grows.
+    storeEngine is an optional factory for the client's store engine.
+    """
+    print("Integration (full pull into an empty node%s)" % (", " + storeEngine.__name__ if storeEngine else ""))
+    print("records   seconds   usec/record")
+    results = []
+    for numRecords in sizes:
+        server = createServer(numRecords)
+        client = Node("client", storeEngine() if storeEngine else None)
+        sessionID = client.createSyncSession(server, server.instanceID)
+
+        start = timeit.default_timer()
+        client.pullInitiation(sessionID, ("", ""))
+        elapsed = timeit.default_timer() - start
+
+        assert len(client.store) == numRecords
+        results.append((numRecords, elapsed))
+        print("%-9d %-9.3f %.2f" % (numRecords, elapsed, elapsed * 1e6 / numRecords))
+    return results
+
+
+def benchSnapshot(sizes=(1000, 10000, 100000), numInstances=10, delta=100):
+    """
+    Times the snapshot for a client which is missing only the last delta records of
+    every instance. Snapshot time should follow the delta, not the store size.
+    """
+    print("Snapshot (%d instances, %d new records each)" % (numInstances, delta))
+    print("records   seconds   sent")
+    results = []
+    for numRecords in sizes:
+        node = Node("server")
+        perInstance = numRecords // numInstances
+        for i in range(numInstances):
+            instanceID = "instance" + str(i)
+            for j in range(1, perInstance + 1):
+                recordID = instanceID + "_" + str(j)
+                node.addRecordToStore(StoreRecord(recordID, "data", instanceID, j, {instanceID: j}, "", ""))
+            node.syncDataStructure["+"][instanceID] = perInstance
+        remoteFSIC = dict((k, v - delta) for k, v in node.calcFSIC(("", "")).items())
+
+        start = timeit.default_timer()
+        filter, (changes, records) = node.fsicDiffAndSnapshot(("", ""), remoteFSIC)
+        elapsed = timeit.default_timer() - start
+
+        results.append((numRecords, elapsed))
+        print("%-9d %-9.4f %d" % (numRecords, elapsed, len(records)))
+    return results
+
+
+def benchPartitionSnapshot(numFacilities=100, usersPerFacility=10, recordsPerUser=20, numInstances=5):
+    """
+    Times full, facility and facility+user snapshots against an empty remote FSIC on a
+    store spread over numFacilities facilities
+    """
+    node = Node("server")
+    counters = {}
+    for f in range(numFacilities):
+        for u in range(usersPerFacility):
+            for r in range(recordsPerUser):
+                instanceID = "instance" + str(r % numInstances)
+                counters[instanceID] = counters.get(instanceID, 0) + 1
+                recordID = "F%d_U%d_%d" % (f, u, r)
+                node.addRecordToStore(StoreRecord(recordID, "data", instanceID, counters[instanceID],
+                                                  {instanceID: counters[instanceID]},
+                                                  "Facility" + str(f), "User" + str(u)))
+    node.syncDataStructure["+"].update(counters)
+
+    print("Partition snapshot (%d facilities, %d records)" % (numFacilities, len(node.store)))
+    print("filter                    seconds   sent")
+    results = []
+    for filter in [("", ""), ("Facility1", ""), ("Facility1", "User1")]:
+        start = timeit.default_timer()
+        filter, (changes, records) = node.fsicDiffAndSnapshot(filter, {})
+        elapsed = timeit.default_timer() - start
+
+        results.append((filter, elapsed))
+        print("%-25s %-9.5f %d" % (str(filter), elapsed, len(records)))
+    return results
+
+
+def benchSerialize(sizes=(1000, 10000, 100000), dirty=10):
+    """
+    Times serializing a few modified records in an application holding many clean ones
+    """
+    print("Serialize (%d dirty records)" % dirty)
+    print("records   seconds")
+    results = []
+    for numRecords in sizes:
+        node = createServer(numRecords)
+        for i in range(dirty):
+            node.addAppData("record" + str(i), "new data " + str(i), "", "")
+
+        start = timeit.default_timer()
+        node.serialize(("", ""))
+        elapsed = timeit.default_timer() - start
+
+        results.append((numRecords, elapsed))
+        print("%-9d %.5f" % (numRecords, elapsed))
+    return results
+
+
+def benchRecordMemory(numRecords=100000, numInstances=10):
+    """
+    Reports the bytes allocated per StoreRecord, including its history dict. Instance IDs and
+    partition names are built per record, as they are when records arrive from another device.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = []
+    for i in range(numRecords):
+        instanceID = "instance" + str(i % numInstances)
+        records.append(StoreRecord("record" + str(i), None, instanceID, i, {instanceID: i},
+                                   "Facility" + str(i % 3), "User" + str(i % 7)))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    perRecord = float(after - before) / numRecords
+    print("StoreRecord memory : %.1f bytes per record (%d records)" % (perRecord, numRecords))
+    return perRecord
+
+
+def createSyncTraffic(numRecords, numInstances=50, dataLength=40):
+    """
+    Builds a DATA message of numRecords records saved by numInstances instances, with short
+    histories and text payloads of roughly dataLength characters
+    """
+    rng = random.Random(0)
+    words = ["learner", "exercise", "attempt", "facility", "progress", "mastery", "video", "content"]
+    records = []
+    changes = {}
+    for i in range(numRecords):
+        instanceID = hashlib.md5(str(i % numInstances).encode("utf-8")).hexdigest()
+        counter = i // numInstances + 1
+        history = {instanceID: counter}
+        if i % 3 == 0:
+            history[hashlib.md5(str((i + 1) % numInstances).encode("utf-8")).hexdigest()] = counter
+        data = ""
+        while len(data) < dataLength:
+            data = data + rng.choice(words) + " "
+        records.append(StoreRecord("record" + str(i), data, instanceID, counter, history,
+                                   "Facility" + str(i % 5), "User" + str(i % 40)))
+        changes[instanceID] = counter
+    return ("DATA", "pull_1", (("", ""), (changes, records)))
+
+
+def toJSON(message):
+    """
+    JSON baseline for a DATA message, records as lists of their fields
+    """
+    filter, (changes, records) = message[2]
+    return json.dumps([message[0], message[1], [filter, [changes, [
+        [r.recordID, r.recordData, r.lastSavedByInstance, r.lastSavedByCounter, r.lastSavedByHistory,
+         r.partitionFacility, r.partitionUser] for r in records]]]]).encode("utf-8")
+
+
+def fromJSON(data):
+    """
+    Decodes the JSON baseline back into a DATA message
+    """
+    messageType, pushPullID, (filter, (changes, records)) = json.loads(data.decode("utf-8"))
+    return (messageType, pushPullID, (tuple(filter), (changes, [StoreRecord(*r) for r in records])))
+
+
+def benchWireFormat(numRecords=10000):
+    """
+    Compares size and encode/decode speed of the binary wire format against JSON
+    """
+    message = createSyncTraffic(numRecords)
+
+    start = timeit.default_timer()
+    frame = WireEncoder().encode(message)
+    encodeTime = timeit.default_timer() - start
+    start = timeit.default_timer()
+    decoded = WireDecoder().feed(frame)
+    decodeTime = timeit.default_timer() - start
+    assert len(decoded[0][2][1][1]) == numRecords
+
+    start = timeit.default_timer()
+    encodedJSON = toJSON(message)
+    jsonEncodeTime = timeit.default_timer() - start
+    start = timeit.default_timer()
+    fromJSON(encodedJSON)
+    jsonDecodeTime = timeit.default_timer() - start
+
+    print("Wire format (%d records)" % numRecords)
+    print("format   bytes/record   encode usec/record   decode usec/record")
+    for name, size, encode, decode in [("binary", len(frame), encodeTime, decodeTime),
+                                       ("json", len(encodedJSON), jsonEncodeTime, jsonDecodeTime)]:
+        print("%-8s %-14.1f %-20.2f %.2f" % (name, float(size) / numRecords, encode * 1e6 / numRecords,
+                                            decode * 1e6 / numRecords))
+    return (len(frame), len(encodedJSON))
+
+
+def benchInstanceTable(numRequests=20, recordsPerRequest=50, numInstances=200):
+    """
+    Bytes sent in a sync session where every request travels on a fresh stream, as over
+    HTTP, with codecs starting empty or seeded from the instance tables exchanged at
+    handshake. The handshake tables themselves are counted for the seeded case.
+    """
+    server = Node("server")
+    client = Node("client")
+    instanceIDs = [hashlib.md5(str(i).encode("utf-8")).hexdigest() for i in range(numInstances)]
+    server.updateSyncDS(dict((instanceID, 1) for instanceID in instanceIDs), "+")
+    sessionID = client.createSyncSession(server, server.instanceID)
+    session = server.sessions[sessionID]
+    handshakeBytes = sum(len(instanceID.encode("utf-8")) + 1
+                         for instanceID in session.localInstances + session.peerInstances)
+
+    rng = random.Random(0)
+    plainBytes = 0
+    seededBytes = handshakeBytes
+    for request in range(numRequests):
+        records = []
+        for i in range(recordsPerRequest):
+            instanceID = rng.choice(instanceIDs)
+            records.append(StoreRecord("record%d_%d" % (request, i), "data", instanceID, i + 1,
+                                       {instanceID: i + 1}, "", ""))
+        message = ("DATA", sessionID, (("", ""), (dict((instanceID, 1) for instanceID in instanceIDs), records)))
+        plainBytes = plainBytes + len(WireEncoder().encode(message))
+        frame = session.createWireEncoder().encode(message)
+        assert client.sessions[sessionID].createWireDecoder().feed(frame)[0][2][1][1][0].recordID == records[0].recordID
+        seededBytes = seededBytes + len(frame)
+
+    print("Instance tables (%d instances, %d requests of %d records)" % (numInstances, numRequests,
+                                                                         recordsPerRequest))
+    print("Fresh codecs : %d bytes, seeded from handshake : %d bytes (handshake %d bytes)" % (
+        plainBytes, seededBytes, handshakeBytes))
+    return (plainBytes, seededBytes)
+
+
+def benchCompression(numRecords=10000, chunkSizes=(100, 1000), dataLength=200):
+    """
+    Compression ratio and CPU cost of record payload compression per codec and chunk size,
+    along with the resulting wire format size
+    """
+    message = createSyncTraffic(numRecords, dataLength=dataLength)
+    filter, (changes, records) = message[2]
+    rawBytes = len(json.dumps([r.recordData for r in records]).encode("utf-8"))
+
+    print("Payload compression (%d records, %.0f payload bytes/record)" % (numRecords, float(rawBytes) / numRecords))
+    print("codec  chunk   ratio   compress usec/record   decompress usec/record   wire bytes/record")
+    results = []
+    for codec in sorted(CODECS):
+        for chunkSize in chunkSizes:
+            chunks = [records[i:i + chunkSize] for i in range(0, numRecords, chunkSize)]
+
+            start = timeit.default_timer()
+            compressed = [compressRecords(chunk, codec, 0) for chunk in chunks]
+            compressTime = timeit.default_timer() - start
+            encoder = WireEncoder()
+            wireBytes = sum(len(encoder.encode(("CHUNK", "pull_1", (filter, chunk), changes))) for chunk in compressed)
+            ratio = float(rawBytes) / sum(len(chunk.payload) for chunk in compressed)
+
+            start = timeit.default_timer()
+            for chunk in compressed:
+                decompressRecords(chunk)
+            decompressTime = timeit.default_timer() - start
+            results.append((codec, chunkSize, ratio, compressTime, decompressTime))
+            print("%-6s %-7d %-7.2f %-22.2f %-24.2f %.1f" % (codec, chunkSize, ratio, compressTime * 1e6 / numRecords,
+                                                           decompressTime * 1e6 / numRecords,
+                                                           float(wireBytes) / numRecords))
+
+    encoder = WireEncoder()
+    wireBytes = sum(len(encoder.encode(("CHUNK", "pull_1", (filter, records[i:i + chunkSizes[0]]), changes)))
+                    for i in range(0, numRecords, chunkSizes[0]))
+    print("none   %-7d %-7.2f %-22s %-24s %.1f" % (chunkSizes[0], 1, "-", "-", float(wireBytes) / numRecords))
+    return results
+
+
+def benchPullBurst(numClients=200, numInstances=500):
+    """
+    Times a server answering a burst of pulls from clients which are already up to date,
+    on a syncDataStructure holding numInstances instances
+    """
+    server = Node("server")
+    for i in range(numInstances):
+        server.updateSyncDS({"instance" + str(i): i + 1}, "+")
+        server.updateSyncDS({"instance" + str(i): i + 1}, "Facility1+")
+    clients = []
+    for i in range(numClients):
+        client = Node("client" + str(i))
+        client.updateSyncDS(dict(server.calcFSIC(("Facility1", ""))), "Facility1+")
+        clients.append((client, client.createSyncSession(server, server.instanceID)))
+
+    start = timeit.default_timer()
+    for client, sessionID in clients:
+        client.pullInitiation(sessionID, ("Facility1", ""))
+    elapsed = timeit.default_timer() - start
+    print("Pull burst (%d clients, %d instances) : %.4f seconds" % (numClients, numInstances, elapsed))
+    return elapsed
+
+
+def benchConflictIntegration(numRecords=10000, networkSize=8):
+    """
+    Times conflict-heavy integration : a pull where every incoming record conflicts with a
+    local version, and the addAppRecordMerge full-mesh scenario run to convergence
+    """
+    server = createServer(numRecords)
+    client = Node("client")
+    for i in range(numRecords):
+        client.addAppData("record" + str(i), "client data " + str(i), "", "")
+    client.serialize(("", ""))
+    sessionID = client.createSyncSession(server, server.instanceID)
+
+    start = timeit.default_timer()
+    client.pullInitiation(sessionID, ("", ""))
+    elapsed = timeit.default_timer() - start
+    print("Conflicting pull (%d records) : %.3f seconds, %.2f usec/record" % (numRecords, elapsed,
+                                                                           elapsed * 1e6 / numRecords))
+
+    start = timeit.default_timer()
+    pulls = eventualFullMerge(networkSize, random.Random(0))
+    mergeElapsed = timeit.default_timer() - start
+    print("Full-mesh merge (%d nodes) : %d pulls, %.3f seconds" % (networkSize, pulls, mergeElapsed))
+    return (elapsed, mergeElapsed)
+
+
+class CountingTransport(object):
+    """
+    Delivers messages synchronously, as Node.send does without a transport, adding up the
+    bytes they take in the wire format. Each direction of a sync session is one stream.
+    """
+
+    def __init__(self):
+        self.encoders = {}
+        self.bytes = 0
+        self.messages = 0
+
+    def send(self, sender, receiver, sessionID, data):
+        key = (sender.instanceID, sessionID)
+        if key not in self.encoders:
+            self.encoders[key] = sender.sessions[sessionID].createWireEncoder()
+        self.bytes = self.bytes + len(self.encoders[key].encode(data))
+        self.messages = self.messages + 1
+        receiver.receive(sender, sessionID, data)
+
+
+def storeVersions(node):
+    return dict((recordID, (record.lastSavedByInstance, record.lastSavedByCounter))
+                for recordID, record in node.store.items())
+
+
+def runMeshAntiEntropy(networkSize, recordsPerNode, sharedRecords, merkleDepth, seed):
+    """
+    Full mesh where every node holds its own records and edits the same shared records,
+    pulling at random until all stores hold the same versions. Then node 0 loses its
+    syncDataStructure and pulls once from every other node. Returns the bytes of both phases.
+    """
+    rng = random.Random(seed)
+    nodes = createNodes(networkSize)
+    transport = CountingTransport()
+    for node in nodes:
+        for i in range(recordsPerNode):
+            node.addAppData("record%s_%d" % (node.instanceID, i), "data %d" % i, "", "")
+        for i in range(sharedRecords):
+            node.addAppData("shared%d" % i, "data " + node.instanceID, "", "")
+        node.serialize(("", ""))
+        node.merkleDepth = merkleDepth
+        node.transport = transport
+    sessionInfo = sessionsFull(nodes)
+
+    pulls = 0
+    while any(storeVersions(node) != storeVersions(nodes[0]) for node in nodes[1:]):
+        client, server, sessionID = sessionInfo[rng.randint(0, len(sessionInfo) - 1)]
+        nodes[client].pullInitiation(sessionID, ("", ""))
+        pulls = pulls + 1
+    convergeBytes = transport.bytes
+
+    nodes[0].syncDataStructure = {"+": {nodes[0].instanceID: nodes[0].counter}}
+    nodes[0].fsicCache = {}
+    for client, server, sessionID in sessionInfo:
+        if client == 0:
+            nodes[0].pullInitiation(sessionID, ("", ""))
+    return (pulls, convergeBytes, transport.bytes - convergeBytes)
+
+
+def benchAntiEntropy(networkSize=6, recordsPerNode=500, sharedRecords=50, depths=(2, 3)):
+    """
+    Bytes sent by FSIC and Merkle pulls on the full mesh, to converge a conflict storm on
+    shared records and to recover a node which lost its FSICs
+    """
+    print("Anti-entropy on a full mesh (%d nodes, %d own records each, %d shared records)" % (
+        networkSize, recordsPerNode, sharedRecords))
+    print("mode       pulls   converge bytes   lost FSIC recovery bytes")
+    results = {}
+    for name, depth in [("fsic", None)] + [("merkle/%d" % depth, depth) for depth in depths]:
+        pulls, convergeBytes, recoveryBytes = runMeshAntiEntropy(networkSize, recordsPerNode, sharedRecords,
+                                                                 depth, 0)
+        print("%-10s %-7d %-16d %d" % (name, pulls, convergeBytes, recoveryBytes))
+        results[name] = (convergeBytes, recoveryBytes)
+    return results
+
+
+def runReplication(networkSize, recordsPerNode, sessions, manifestMode, seed, facilityShare, numFacilities=4,
+                   dataLength=200):
+    """
+    Pull then push over random sessions until every node holds every record, as in the
+    fullBiDiff experiment. A share of the syncs only covers one facility, so records also
+    reach nodes outside of their full replication FSIC. Returns the bytes and messages sent.
+    """
+    rng = random.Random(seed)
+    nodes = createNodes(networkSize)
+    transport = CountingTransport()
+    for node in nodes:
+        for i in range(recordsPerNode):
+            data = ("record %d of %s " % (i, node.instanceID)) * (dataLength // 16)
+            node.addAppData("record%s_%d" % (node.instanceID, i), data, "Facility%d" % (i % numFacilities), "")
+        node.serialize(("", ""))
+        node.manifestMode = manifestMode
+        node.transport = transport
+    sessionInfo = sessions(nodes)
+
+    while endConditionData(nodes):
+        client, server, sessionID = sessionInfo[rng.randint(0, len(sessionInfo) - 1)]
+        if rng.random() < facilityShare:
+            filter = ("Facility%d" % rng.randint(0, numFacilities - 1), "")
+        else:
+            filter = ("", "")
+        nodes[client].pullInitiation(sessionID, filter)
+        nodes[client].pushInitiation(sessionID, filter)
+    return (transport.bytes, transport.messages)
+
+
+def benchManifest(networkSize=8, recordsPerNode=200, trials=3, facilityShares=(0, 0.7)):
+    """
+    Bytes sent to replicate every record to every node with full snapshots and with
+    manifest-then-fetch, on a full mesh and a star
+    """
+    print("Manifest then fetch (%d nodes, %d records each, %d trials)" % (networkSize, recordsPerNode, trials))
+    print("topology   facility syncs   mode       bytes      messages")
+    results = {}
+    for topologyName, sessions in [("full", sessionsFull), ("star", sessionsStar)]:
+        for facilityShare in facilityShares:
+            for mode, manifestMode in [("snapshot", False), ("manifest", True)]:
+                totals = [runReplication(networkSize, recordsPerNode, sessions, manifestMode, seed, facilityShare)
+                          for seed in range(trials)]
+                sent = sum(total[0] for total in totals) // trials
+                messages = sum(total[1] for total in totals) // trials
+                print("%-10s %-16s %-10s %-10d %d" % (topologyName, "%d%%" % (facilityShare * 100), mode, sent,
+                                                      messages))
+                results[(topologyName, facilityShare, mode)] = sent
+    return results
+
+def benchSyncRequest(sizes=(4, 8, 16), trials=20):
+    """
+    Messages, one way hops and bytes to converge the fullBiDiff scenario with pull then
+    push and with the combined SYNC request
+    """
+    print("Pull + push against SYNC (fullBiDiff scenario, %d trials)" % trials)
+    print("nodes   mode        syncs    messages   hops/sync   bytes")
+    results = {}
+    for size in sizes:
+        for mode, replicate in [("pull+push", fullDBReplication), ("sync", fullDBSync)]:
+            syncs = 0
+            transport = CountingTransport()
+            for trial in range(trials):
+                rng = random.Random(trial)
+                nodes = createNodes(size)
+                addAppRecordDiff(nodes)
+                for node in nodes:
+                    node.transport = transport
+                sessionInfo = sessionsFull(nodes)
+                while endConditionData(nodes):
+                    client, server, sessionID = sessionInfo[rng.randint(0, len(sessionInfo) - 1)]
+                    replicate(nodes[client], sessionID)
+                    syncs = syncs + 1
+            print("%-7d %-11s %-8.1f %-10.1f %-11.1f %.0f" % (size, mode, float(syncs) / trials,
+                                                             float(transport.messages) / trials,
+                                                             float(transport.messages) / syncs,
+                                                             float(transport.bytes) / trials))
+            results[(size, mode)] = (syncs, transport.messages, transport.bytes)
+    return results
+
+
+class FlakyTransport(CountingTransport):
+    """
+    Counting transport dropping the connection before a CHUNK or DATA message with the given
+    probability, and counting the records of the messages it delivers
+    """
+
+    def __init__(self, cutProbability, rng):
+        CountingTransport.__init__(self)
+        self.cutProbability = cutProbability
+        self.rng = rng
+        self.records = 0
+
+    def send(self, sender, receiver, sessionID, data):
+        if data[0] in ("CHUNK", "DATA"):
+            if self.rng.random() < self.cutProbability:
+                raise IOError("Connection lost")
+            self.records = self.records + len(data[2][1] if data[0] == "CHUNK" else data[2][1][1])
+        CountingTransport.send(self, sender, receiver, sessionID, data)
+
+
+def benchResumableTransfer(numRecords=5000, chunkSize=100, cutProbabilities=(0.02, 0.05, 0.1), trials=5):
+    """
+    Records sent to a fresh client pulling a server over a connection which drops during the
+    stream, the client pulling again after every cut until a pull goes through
+    """
+    server = createServer(numRecords)
+    server.chunkSize = chunkSize
+    print("Resumable transfer (%d records, chunks of %d)" % (numRecords, chunkSize))
+    print("cut/message  attempts  records sent  sent/needed")
+    results = {}
+    for cutProbability in cutProbabilities:
+        attempts = 0
+        transport = FlakyTransport(cutProbability, random.Random(1))
+        server.transport = transport
+        for trial in range(trials):
+            client = Node("client")
+            sessionID = client.createSyncSession(server, server.instanceID)
+            while True:
+                attempts = attempts + 1
+                try:
+                    client.pullInitiation(sessionID, ("", ""))
+                    break
+                except IOError:
+                    pass
+            assert len(client.store) == numRecords
+        print("%-12.2f %-9.1f %-13.0f %.2f" % (cutProbability, float(attempts) / trials,
+                                               float(transport.records) / trials,
+                                               float(transport.records) / (trials * numRecords)))
+        results[cutProbability] = (attempts, transport.records)
+    server.transport = None
+    return results
+
+
+def benchIncomingBudget(numClients=50, recordsPerClient=400, chunkSize=50, budgets=(None, 2000, 200)):
+    """
+    Peak number of records waiting in the server's inbound queue, and time taken, when every
+    client of a star pushes to the server at once over the asyncio transport
+    """
+    print("Incoming budget (%d clients pushing %d records at once, chunks of %d)"
+          % (numClients, recordsPerClient, chunkSize))
+    print("budget   peak queued records   msec")
+    results = {}
+    for budget in budgets:
+        server = Node("server")
+        server.incomingBudget = budget
+        clients = []
+        for i in range(numClients):
+            client = Node("client" + str(i))
+            client.chunkSize = chunkSize
+            for j in range(recordsPerClient):
+                client.addAppData("record%d_%d" % (i, j), "data " + str(j), "", "")
+            client.serialize(("", ""))
+            clients.append((client, client.createSyncSession(server, server.instanceID)))
+        transport = AsyncTransport()
+        transport.attach(server, *[client for client, sessionID in clients])
+
+        async def pushes():
+            transport.start()
+            for client, sessionID in clients:
+                client.pushInitiation(sessionID, ("", ""))
+            await transport.drain()
+            await transport.stop()
+
+        start = timeit.default_timer()
+        asyncio.run(pushes())
+        elapsed = timeit.default_timer() - start
+        assert len(server.store) == numClients * recordsPerClient
+        print("%-8s %-21d %.0f" % (budget, transport.maxQueuedRecords, elapsed * 1000))
+        results[budget] = (transport.maxQueuedRecords, elapsed)
+    return results
+
+
+def benchTrafficTrace(starSize=8, recordsPerNode=2000, rounds=2):
+    """
+    Size of the trace of full replications on a star, and time to replay it against the
+    time the recorded syncs took
+    """
+    nodes = createNodes(starSize)
+    for i, node in enumerate(nodes):
+        for j in range(recordsPerNode):
+            node.addAppData("record%d_%d" % (i, j), "data %d %d" % (i, j), "Facility" + str(j % 4), "")
+        node.serialize(("", ""))
+    sessionInfo = sessionsStar(nodes)
+    output = tempfile.NamedTemporaryFile(suffix=".trace", delete=False)
+    output.close()
+    path = output.name
+    try:
+        recorder = TraceRecorder(path)
+        recorder.attach(*nodes)
+        start = timeit.default_timer()
+        for i in range(rounds):
+            for client, server, sessionID in sessionInfo:
+                fullDBReplication(nodes[client], sessionID)
+        recorded = timeit.default_timer() - start
+        recorder.close()
+        size = os.path.getsize(path)
+        replayer = replayTrace(path)
+    finally:
+        os.remove(path)
+    print("Traffic trace (star of %d nodes, %d records each) : %d messages, %d bytes, recorded in %.3f seconds, "
+          "replayed in %.3f seconds of which %.3f restoring the nodes and %.3f handling the messages"
+          % (starSize, recordsPerNode, recorder.messages, size, recorded, replayer.seconds, replayer.restoreSeconds,
+             replayer.receiveSeconds))
+    return (size, recorded, replayer.seconds)
+
+
+def benchSimulatedNetwork(starSize=10, recordsPerNode=200, intervals=(300, 1800, 3600), trials=5):
+    """
+    Simulated time for a star to converge over rural connectivity, against the interval
+    between the syncs of every device, each device online a third of the time
+    """
+    print("Simulated network (star of %d nodes, %d records each, 0.5 s latency, 20 kB/s, 2%% loss)"
+          % (starSize, recordsPerNode))
+    print("interval s  median hours  syncs  skipped  kB sent")
+    results = {}
+    for interval in intervals:
+        runs = []
+        for trial in range(trials):
+            rng = random.Random(trial)
+            nodes = createNodes(starSize)
+            for i, node in enumerate(nodes):
+                for j in range(recordsPerNode):
+                    node.addAppData("record%d_%d" % (i, j), "data %d %d" % (i, j), "", "")
+                node.serialize(("", ""))
+            simulator = NetworkSimulator(Link(latency=0.5, bandwidth=20000, loss=0.02), rng)
+            simulator.attach(*nodes)
+            for client, server, sessionID in sessionsStar(nodes):
+                simulator.syncEvery(nodes[client], sessionID, interval, jitter=interval / 10.0)
+                simulator.addChurn(nodes[client], 2 * 3600.0, 4 * 3600.0)
+            # Record IDs differ between nodes, every store ends up holding all of them
+            convergedAt = simulator.run(until=30 * 24 * 3600, converged=lambda: all(
+                len(node.store) == starSize * recordsPerNode for node in nodes))
+            runs.append((convergedAt, simulator.syncs, simulator.skippedSyncs, simulator.bytesSent))
+        runs.sort(key=lambda run: float("inf") if run[0] is None else run[0])
+        convergedAt, syncs, skipped, bytesSent = runs[len(runs) // 2]
+        print("%-11d %-13.1f %-6d %-8d %.0f" % (interval, convergedAt / 3600, syncs, skipped, bytesSent / 1000.0))
+        results[interval] = runs
+    return results
+
+
+def benchScheduler(sizes=(4, 8, 12), trials=20, experiments=("fullDiff", "fullDiffBi", "starDiff", "starDiffBi")):
+    """
+    Mean number of sync calls for the convergence experiments to converge, with sessions
+    picked at random and by the gossip scheduler
+    """
+    print("Gossip scheduler (%d trials)" % trials)
+    print("experiment  nodes  random   gossip   reduction")
+    results = {}
+    for experiment in experiments:
+        means = [summarize(runExperiment(experiment, sizes, trials, options={"scheduler": scheduler}))
+                 for scheduler in ("random", "gossip")]
+        for size in sizes:
+            print("%-11s %-6d %-8.1f %-8.1f %.0f%%" % (experiment, size, means[0][size], means[1][size],
+                                                    100 * (1 - means[1][size] / means[0][size])))
+            results[(experiment, size)] = (means[0][size], means[1][size])
+    return results
+
+
+if __name__ == '__main__':
+    benchIntegration()
+    benchIntegration(storeEngine=SQLiteStoreEngine)
+    benchSnapshot()
+    benchPartitionSnapshot()
+    benchSerialize()
+    benchRecordMemory()
+    benchWireFormat()
+    benchInstanceTable()
+    benchCompression()
+    benchPullBurst()
+    benchConflictIntegration()
+    benchAntiEntropy()
+    benchManifest()
+    benchSyncRequest()
+    benchResumableTransfer()
+    benchIncomingBudget()
+    benchTrafficTrace()
+    benchSimulatedNetwork()
+    benchScheduler()
@@ -0,0 +1,290 @@
+"""
+Benchmark suite for the Node sync hot paths, timed on synthetic stores of varying size.
+
+A scenario is a store of a number of records saved by a number of instances and spread
+over a number of partitions (facilities). By default the records, instances and
+partitions are each swept on their own while the other two stay at a base value. Every
+benchmark is timed repeat times on fresh state and the best time is kept. Results go to
+a JSON lines file, one object per benchmark and scenario, which can be compared with the
+results of another revision.
+
+python benchmarkSuite.py --output before.jsonl
+python benchmarkSuite.py --output after.jsonl --compare before.jsonl
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import platform
+import subprocess
+import timeit
+
+from simulateNode import Node
+from storeRecord import StoreRecord
+
+RECORDS = (1000, 10000, 100000, 1000000)
+INSTANCES = (2, 50, 500)
+PARTITIONS = (1, 100, 1000)
+# Scenario the sweeps go through : (records, instances, partitions)
+BASE = (100000, 10, 10)
+# Share of the records the remote device is missing in the delta snapshot, and of the
+# application records modified before a serialize
+DELTA = 0.1
+DIRTY = 0.01
+
+
+class Scenario(object):
+    """
+    Store of numRecords records, record i being saved by instance i % numInstances
+    in facility i % numPartitions
+    """
+
+    def __init__(self, numRecords, numInstances, numPartitions):
+        self.numRecords = numRecords
+        self.numInstances = numInstances
+        self.numPartitions = numPartitions
+        self.server = None
+
+    def records(self, instancePrefix="instance"):
+        """
+        Yields the records of the scenario, with their counters per instance
+        """
+        counters = [0] * self.numInstances
+        for i in range(self.numRecords):
+            instance = i % self.numInstances
+            counters[instance] = counters[instance] + 1
+            instanceID = instancePrefix + str(instance)
+            yield StoreRecord("record" + str(i), "data " + str(i), instanceID, counters[instance],
+                              {instanceID: counters[instance]}, "Facility" + str(i % self.numPartitions), "")
+
+    def filters(self):
+        return [("Facility" + str(p), "") for p in range(self.numPartitions)]
+
+    def serverNode(self):
+        """
+        Node holding the records of the scenario, which the benchmarks only read from.
+        Every partition has a syncDataStructure entry of its own, as if synced separately.
+        """
+        if self.server is None:
+            self.server = Node("server")
+            fsic = {}
+            for record in self.records():
+                self.server.addRecordToStore(record)
+                fsic[record.lastSavedByInstance] = record.lastSavedByCounter
+            self.server.updateSyncDS(fsic, "+")
+            for filter in self.filters():
+                self.server.updateSyncDS(dict(fsic), filter[0] + "+")
+        return self.server
+
+    def key(self):
+        return {"records": self.numRecords, "instances": self.numInstances, "partitions": self.numPartitions}
+
+
+def prepareSerialize(scenario):
+    node = Node("local")
+    for record in scenario.records():
+        node.addAppData(record.recordID, record.recordData, record.partitionFacility, "")
+    node.serialize(("", ""))
+    dirty = max(1, int(scenario.numRecords * DIRTY))
+    for i in range(dirty):
+        node.addAppData("record" + str(i), "new data " + str(i), "Facility" + str(i % scenario.numPartitions), "")
+    return (lambda: node.serialize(("", "")), dirty)
+
+
+def prepareCalcFSIC(scenario):
+    server = scenario.serverNode()
+    filters = [("", "")] + scenario.filters()
+
+    def calcFSICs():
+        server.fsicCache.clear()
+        for filter in filters:
+            server.calcFSIC(filter)
+
+    return (calcFSICs, len(filters))
+
+
+def prepareSnapshot(scenario):
+    # The remote device is missing the last DELTA of the records of every instance
+    server = scenario.serverNode()
+    fsic = server.calcFSIC(("", ""))
+    remoteFSIC = dict((instanceID, int(counter * (1 - DELTA))) for instanceID, counter in fsic.items())
+    return (lambda: server.fsicDiffAndSnapshot(("", ""), remoteFSIC),
+            sum(counter - remoteFSIC[instanceID] for instanceID, counter in fsic.items()))
+
+
+def preparePartitionSnapshot(scenario):
+    # Snapshot of a single partition for a device holding nothing
+    server = scenario.serverNode()
+    return (lambda: server.fsicDiffAndSnapshot(("Facility0", ""), {}),
+            len(range(0, scenario.numRecords, scenario.numPartitions)))
+
+
+def prepareIntegrate(scenario):
+    client = Node("client")
+    records = list(scenario.serverNode().store.values())
+    client.incomingBuffer["pull"] = (("", ""), (scenario.serverNode().calcFSIC(("", "")), records))
+    return (client.integrate, len(records))
+
+
+def prepareConflictIntegrate(scenario):
+    # Every incoming record conflicts with a version the client saved itself
+    client = Node("client")
+    for record in scenario.records():
+        client.addAppData(record.recordID, "client " + record.recordData, record.partitionFacility, "")
+    client.serialize(("", ""))
+    records = list(scenario.serverNode().store.values())
+    client.incomingBuffer["pull"] = (("", ""), (scenario.serverNode().calcFSIC(("", "")), records))
+    return (client.integrate, len(records))
+
+
+def preparePull(scenario):
+    server = scenario.serverNode()
+    client = Node("client")
+    sessionID = client.createSyncSession(server, server.instanceID)
+    return (lambda: client.pullInitiation(sessionID, ("", "")), scenario.numRecords)
+
+
+# Benchmark name -> function(scenario) returning (operation to time, number of records or calls it handles)
+BENCHMARKS = {
+    "serialize": prepareSerialize,
+    "calcFSIC": prepareCalcFSIC,
+    "fsicDiffAndSnapshot": prepareSnapshot,
+    "fsicDiffAndSnapshotPartition": preparePartitionSnapshot,
+    "integrate": prepareIntegrate,
+    "integrateConflicts": prepareConflictIntegrate,
+    "pullInitiation": preparePull,
+}
+
+
+def sweepScenarios(records=RECORDS, instances=INSTANCES, partitions=PARTITIONS, base=BASE):
+    """
+    Returns the scenarios varying one of records, instances and partitions at a time from base
+    """
+    scenarios = [(numRecords, base[1], base[2]) for numRecords in records]
+    scenarios.extend((base[0], numInstances, base[2]) for numInstances in instances)
+    scenarios.extend((base[0], base[1], numPartitions) for numPartitions in partitions)
+    unique = []
+    for scenario in scenarios:
+        if scenario not in unique:
+            unique.append(scenario)
+    return unique
+
+
+def revision():
+    """
+    Short hash of the checked out git revision, None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.STDOUT).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runSuite(scenarios, benchmarks=None, repeat=3, output=None, label=None):
+    """
+    Runs benchmarks (every one by default) on each (records, instances, partitions) scenario,
+    writing each result to output (a JSON lines file path) as soon as it is available.
+    Returns the list of results.
+    """
+    benchmarks = sorted(BENCHMARKS) if benchmarks is None else benchmarks
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError("Unknown benchmark " + name)
+
+    results = []
+    outputFile = open(output, "w") if output else None
+    try:
+        for numRecords, numInstances, numPartitions in scenarios:
+            scenario = Scenario(numRecords, numInstances, numPartitions)
+            for name in benchmarks:
+                best = None
+                for i in range(repeat):
+                    operation, operations = BENCHMARKS[name](scenario)
+                    start = timeit.default_timer()
+                    operation()
+                    elapsed = timeit.default_timer() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                result = {"benchmark": name, "operations": operations, "seconds": best,
+                          "usecPerOperation": best * 1e6 / operations, "repeat": repeat, "label": label,
+                          "python": platform.python_version()}
+                result.update(scenario.key())
+                results.append(result)
+                if outputFile:
+                    outputFile.write(json.dumps(result, sort_keys=True) + "\n")
+                    outputFile.flush()
+    finally:
+        if outputFile:
+            outputFile.close()
+    return results
+
+
+def readResults(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def resultKey(result):
+    return (result["benchmark"], result["records"], result["instances"], result["partitions"])
+
+
+def compareResults(baseline, current):
+    """
+    Pairs the results of two runs by benchmark and scenario.
+    Returns (key, baseline usec per operation, current usec per operation, ratio) tuples.
+    """
+    baselineByKey = dict((resultKey(result), result) for result in baseline)
+    comparison = []
+    for result in current:
+        key = resultKey(result)
+        if key in baselineByKey:
+            before = baselineByKey[key]["usecPerOperation"]
+            after = result["usecPerOperation"]
+            comparison.append((key, before, after, after / before if before else float("inf")))
+    return comparison
+
+
+def printResults(results):
+    print("benchmark                     records   instances partitions usec/op")
+    for result in results:
+        print("%-29s %-9d %-9d %-10d %.3f" % (result["benchmark"], result["records"], result["instances"],
+                                              result["partitions"], result["usecPerOperation"]))
+
+
+def printComparison(comparison, threshold):
+    print("benchmark                     records   instances partitions before     after      ratio")
+    for key, before, after, ratio in comparison:
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  slower"
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print("%-29s %-9d %-9d %-10d %-10.3f %-10.3f %.2f%s" % (key + (before, after, ratio, flag)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite for the Node sync hot paths")
+    parser.add_argument("--records", type=int, nargs="+", default=list(RECORDS), help="record counts to sweep")
+    parser.add_argument("--instances", type=int, nargs="+", default=list(INSTANCES), help="instance counts to sweep")
+    parser.add_argument("--partitions", type=int, nargs="+", default=list(PARTITIONS),
+                        help="partition counts to sweep")
+    parser.add_argument("--base", type=int, nargs=3, default=list(BASE), metavar=("RECORDS", "INSTANCES", "PARTITIONS"),
+                        help="scenario the other sweeps start from")
+    parser.add_argument("--benchmarks", nargs="+", choices=sorted(BENCHMARKS), default=None,
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best one is kept")
+    parser.add_argument("--output", default=None, help="JSON lines file receiving one result per benchmark")
+    parser.add_argument("--label", default=None, help="label stored with the results, the git revision by default")
+    parser.add_argument("--compare", default=None, help="JSON lines file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as slower or faster")
+    args = parser.parse_args()
+
+    scenarios = sweepScenarios(args.records, args.instances, args.partitions, tuple(args.base))
+    results = runSuite(scenarios, args.benchmarks, args.repeat, args.output, args.label or revision())
+    printResults(results)
+    if args.compare:
+        printComparison(compareResults(readResults(args.compare), results), args.threshold)
+
+
+if __name__ == '__main__':
+    main()
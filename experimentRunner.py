@@ -0,0 +1,126 @@
+"""
+Runs the convergence experiments of topology.py as independent Monte Carlo trials
+over a process pool. Every trial gets its own seed derived from the base seed, the
+experiment, the network size and the trial number, so a run is reproducible no
+matter how trials are spread over the workers. Results are streamed to a JSON lines
+file, one object per trial, in trial order.
+
+python experimentRunner.py fullDiffBi --sizes 3 4 5 --trials 100 --workers 8 --output fullBiDiff.jsonl
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import random
+import timeit
+
+from gossipScheduler import SCHEDULERS
+from topology import createRandomRange, eventualFullDiff, eventualFullDiffBi, eventualFullMerge, \
+    eventualStarDiff, eventualStarDiffBi
+
+
+def scheduler(options):
+    return SCHEDULERS[options.get("scheduler", "random")]
+
+
+def fullDiffBi(size, rng, options):
+    # Offline window drawn per trial as in Test.test_eventualFullDiff
+    (start, end) = createRandomRange(1, options.get("offlineWindow", 5), rng)
+    return eventualFullDiffBi(size, options.get("offlinePercentage", 0), start, end, rng, scheduler(options))
+
+
+# Experiment name -> function(size, rng, options) returning the number of sync calls to converge
+EXPERIMENTS = {
+    "fullMerge": lambda size, rng, options: eventualFullMerge(size, rng, scheduler(options)),
+    "fullDiff": lambda size, rng, options: eventualFullDiff(size, rng, scheduler(options)),
+    "fullDiffBi": fullDiffBi,
+    "starDiff": lambda size, rng, options: eventualStarDiff(size, rng, scheduler(options)),
+    "starDiffBi": lambda size, rng, options: eventualStarDiffBi(size, rng, scheduler(options)),
+}
+
+
+def trialSeed(seed, experiment, size, trial):
+    """
+    Derives the seed of a single trial, identical across platforms and Python versions
+    """
+    key = "%s/%s/%d/%d" % (seed, experiment, size, trial)
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def runTrial(task):
+    """
+    Runs one trial in a worker process, task is (experiment, size, trial, seed, options)
+    """
+    experiment, size, trial, seed, options = task
+    start = timeit.default_timer()
+    messages = EXPERIMENTS[experiment](size, random.Random(seed), options)
+    return {"experiment": experiment, "size": size, "trial": trial, "seed": seed, "messages": messages,
+            "seconds": timeit.default_timer() - start}
+
+
+def runExperiment(experiment, sizes, trials, seed=0, workers=None, output=None, options=None):
+    """
+    Runs trials of experiment for every network size, writing each result to output
+    (a JSON lines file path) as soon as it is available. Returns the list of results.
+    """
+    if experiment not in EXPERIMENTS:
+        raise ValueError("Unknown experiment " + experiment)
+    options = options or {}
+    tasks = [(experiment, size, trial, trialSeed(seed, experiment, size, trial), options)
+             for size in sizes for trial in range(trials)]
+
+    results = []
+    pool = multiprocessing.Pool(workers)
+    outputFile = open(output, "w") if output else None
+    try:
+        # imap keeps trial order so the output file is the same for any number of workers
+        for result in pool.imap(runTrial, tasks):
+            results.append(result)
+            if outputFile:
+                outputFile.write(json.dumps(result, sort_keys=True) + "\n")
+                outputFile.flush()
+    finally:
+        pool.close()
+        pool.join()
+        if outputFile:
+            outputFile.close()
+    return results
+
+
+def summarize(results):
+    """
+    Mean number of sync calls per network size
+    """
+    totals = {}
+    for result in results:
+        total, count = totals.get(result["size"], (0, 0))
+        totals[result["size"]] = (total + result["messages"], count + 1)
+    return dict((size, float(total) / count) for size, (total, count) in totals.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel Monte Carlo runner for the convergence experiments")
+    parser.add_argument("experiment", choices=sorted(EXPERIMENTS))
+    parser.add_argument("--sizes", type=int, nargs="+", required=True, help="network sizes to run")
+    parser.add_argument("--trials", type=int, default=100, help="trials per network size")
+    parser.add_argument("--seed", type=int, default=0, help="base seed the trial seeds are derived from")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument("--output", default=None, help="JSON lines file receiving one result per trial")
+    parser.add_argument("--offline-percentage", type=int, default=0, help="fullDiffBi : percentage of offline nodes")
+    parser.add_argument("--offline-window", type=int, default=5, help="fullDiffBi : upper bound of the offline window")
+    parser.add_argument("--scheduler", choices=sorted(SCHEDULERS), default="random",
+                        help="how the session to sync next is picked")
+    args = parser.parse_args()
+
+    options = {"offlinePercentage": args.offline_percentage, "offlineWindow": args.offline_window,
+               "scheduler": args.scheduler}
+    results = runExperiment(args.experiment, args.sizes, args.trials, args.seed, args.workers, args.output,
+                            options)
+    for size, mean in sorted(summarize(results).items()):
+        print("%d nodes : %.2f sync calls on average" % (size, mean))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Schedulers picking the next sync session, and its direction, in the convergence experiments.
+
+A scheduler is built with the nodes, the (client, server, sessionID) sessions between
+them, the directions a sync can take and a random number generator. next returns the
+index of the session to sync next and the direction : "pull", "push", or "full" for a
+pull followed by a push. synced is called once the sync is done, failed when the session
+could not be synced, its nodes being offline.
+
+RandomScheduler picks sessions uniformly at random. GossipScheduler goes by the FSICs
+exchanged in the syncs so far, and picks the session and direction with the most records
+to transfer as far as they tell.
+"""
+from __future__ import print_function, unicode_literals
+
+import random
+
+INFINITY = float("inf")
+
+
+class RandomScheduler(object):
+
+    def __init__(self, nodeList, sessionInfo, directions=("pull",), rng=random):
+        self.sessionInfo = sessionInfo
+        self.directions = directions
+        self.rng = rng
+
+    def next(self):
+        index = self.rng.randint(0, len(self.sessionInfo) - 1)
+        if len(self.directions) == 1:
+            return (index, self.directions[0])
+        return (index, self.directions[self.rng.randint(0, len(self.directions) - 1)])
+
+    def synced(self, index):
+        pass
+
+    def failed(self, index):
+        pass
+
+
+class GossipScheduler(object):
+    """
+    Keeps the FSIC of every node as last exchanged in a sync it took part in. The records
+    a node would get from another are estimated from those FSICs : counters the receiver
+    is behind on. A node which has not synced yet is taken to hold records of its own
+    nobody has, and nothing else. The session and direction with the largest estimate go
+    next, ties being broken at random. Sessions whose estimate is zero are redundant and
+    skipped, unless every session is : the estimates are then out of date, and the session
+    synced the longest ago goes next.
+    """
+
+    def __init__(self, nodeList, sessionInfo, directions=("pull",), rng=random, filter=("", "")):
+        """
+        Constructor
+        filter : filter the sessions are synced with
+        """
+        self.nodeList = nodeList
+        self.sessionInfo = sessionInfo
+        self.directions = directions
+        self.rng = rng
+        self.filter = filter
+        # FSIC of each node as last exchanged, None until it synced
+        self.known = [None] * len(nodeList)
+        # Number of the sync each session last went through in, -1 if it never did
+        self.lastSynced = [-1] * len(sessionInfo)
+        self.syncs = 0
+        # Sessions which failed since the last sync went through
+        self.unreachable = set()
+
+    def estimatedFSIC(self, node):
+        if self.known[node] is None:
+            return {self.nodeList[node].instanceID: INFINITY}
+        return self.known[node]
+
+    def delta(self, receiver, sender):
+        """
+        Estimated number of records receiver would get from sender
+        """
+        receiverFSIC = self.estimatedFSIC(receiver)
+        return sum(max(0, counter - receiverFSIC.get(instanceID, 0))
+                   for instanceID, counter in self.estimatedFSIC(sender).items())
+
+    def score(self, client, server, direction):
+        if direction == "pull":
+            return self.delta(client, server)
+        if direction == "push":
+            return self.delta(server, client)
+        return self.delta(client, server) + self.delta(server, client)
+
+    def next(self):
+        best = 0
+        candidates = []
+        for index, (client, server, sessionID) in enumerate(self.sessionInfo):
+            if index in self.unreachable:
+                continue
+            for direction in self.directions:
+                score = self.score(client, server, direction)
+                if score > best:
+                    best = score
+                    candidates = [(index, direction)]
+                elif score == best and best > 0:
+                    candidates.append((index, direction))
+        if not candidates:
+            # No estimate left to go by
+            indexes = [index for index in range(len(self.sessionInfo)) if index not in self.unreachable]
+            if not indexes:
+                indexes = range(len(self.sessionInfo))
+            oldest = min(self.lastSynced[index] for index in indexes)
+            candidates = [(index, direction) for index in indexes if self.lastSynced[index] == oldest
+                          for direction in self.directions]
+        return candidates[self.rng.randint(0, len(candidates) - 1)]
+
+    def synced(self, index):
+        """
+        The session at index went through a sync, both ends exchanged their FSIC
+        """
+        client, server, sessionID = self.sessionInfo[index]
+        self.known[client] = self.nodeList[client].calcFSIC(self.filter)
+        self.known[server] = self.nodeList[server].calcFSIC(self.filter)
+        self.lastSynced[index] = self.syncs
+        self.syncs = self.syncs + 1
+        self.unreachable.clear()
+
+    def failed(self, index):
+        self.unreachable.add(index)
+
+
+# Scheduler name -> class, for the experiment options
+SCHEDULERS = {
+    "random": RandomScheduler,
+    "gossip": GossipScheduler,
+}
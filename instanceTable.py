@@ -0,0 +1,60 @@
+"""
+Per node numbering of instance IDs.
+"""
+from __future__ import print_function, unicode_literals
+
+from storeRecord import internString
+
+
+class InstanceTable(object):
+    """
+    Numbers the instance IDs known to a node with small integers, in the order they were
+    first seen. Two devices exchange their tables when a sync session starts, after which
+    the instance IDs either of them knows can travel as integers.
+    """
+
+    def __init__(self, instanceIDs=()):
+        """
+        Constructor
+        """
+        # Instance IDs by number and numbers by instance ID
+        self.instanceIDs = []
+        self.numbers = {}
+        self.update(instanceIDs)
+
+    def add(self, instanceID):
+        """
+        Returns the number of instanceID, numbering it if it is new
+        """
+        number = self.numbers.get(instanceID)
+        if number is None:
+            instanceID = internString(instanceID)
+            number = len(self.instanceIDs)
+            self.instanceIDs.append(instanceID)
+            self.numbers[instanceID] = number
+        return number
+
+    def update(self, instanceIDs):
+        for instanceID in instanceIDs:
+            self.add(instanceID)
+
+    def numberOf(self, instanceID):
+        return self.numbers[instanceID]
+
+    def instanceAt(self, number):
+        return self.instanceIDs[number]
+
+    def snapshot(self):
+        """
+        Returns the instance IDs in number order, as sent at handshake
+        """
+        return list(self.instanceIDs)
+
+    def __contains__(self, instanceID):
+        return instanceID in self.numbers
+
+    def __len__(self):
+        return len(self.instanceIDs)
+
+    def __iter__(self):
+        return iter(self.instanceIDs)
@@ -0,0 +1,99 @@
+"""
+Merkle tree over the record versions of a partition, used by the anti-entropy pull.
+
+Records are spread over 16 ** depth leaf buckets by the hash of their recordID, and a
+bucket at level L (0 being the root) covers the 16 buckets below it at level L + 1.
+The hash of a bucket is the XOR of the 64 bit hashes of the record versions it holds,
+so two devices holding the same versions of the same records in a bucket agree on its
+hash whatever order they stored them in. Empty buckets are left out of the tree.
+The tree only keeps the IDs of the records, which are read from the store again once
+the buckets to send are known.
+"""
+from __future__ import print_function, unicode_literals
+
+import hashlib
+
+FANOUT = 16
+
+
+def versionHash(record):
+    """
+    64 bit hash of the version of a record, identified by who saved it at which counter
+    """
+    key = "%s\0%s\0%d" % (record.recordID, record.lastSavedByInstance, record.lastSavedByCounter)
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def leafBucket(recordID, depth):
+    """
+    Leaf bucket of a record, taken from the leading hex digits of the hash of its ID
+    """
+    if depth == 0:
+        return 0
+    return int(hashlib.md5(recordID.encode("utf-8")).hexdigest()[:depth], 16)
+
+
+class MerkleTree(object):
+
+    def __init__(self, records, depth):
+        """
+        Constructor
+        records : store records of the partition, iterated once
+        depth   : number of levels below the root
+        """
+        if depth < 0:
+            raise ValueError("Depth of a Merkle tree cannot be negative")
+        self.depth = depth
+        # Leaf bucket -> IDs of the records it holds
+        self.leaves = {}
+        self.numRecords = 0
+        # levels[L] maps the non-empty buckets of level L to their hash
+        self.levels = [{} for level in range(depth + 1)]
+
+        leafHashes = self.levels[depth]
+        for record in records:
+            bucket = leafBucket(record.recordID, depth)
+            self.leaves.setdefault(bucket, []).append(record.recordID)
+            leafHashes[bucket] = leafHashes.get(bucket, 0) ^ versionHash(record)
+            self.numRecords = self.numRecords + 1
+        for level in range(depth - 1, -1, -1):
+            parents = self.levels[level]
+            for bucket, bucketHash in self.levels[level + 1].items():
+                parent = bucket // FANOUT
+                parents[parent] = parents.get(parent, 0) ^ bucketHash
+
+    def rootHash(self):
+        return self.levels[0].get(0, 0)
+
+    def childHashes(self, level, buckets):
+        """
+        Returns the hashes of the non-empty children of buckets at level, keyed by bucket
+        """
+        children = self.levels[level + 1]
+        hashes = {}
+        for bucket in buckets:
+            for child in range(bucket * FANOUT, (bucket + 1) * FANOUT):
+                if child in children:
+                    hashes[child] = children[child]
+        return hashes
+
+    def differingBuckets(self, level, candidates, remoteHashes):
+        """
+        Returns the candidate buckets of level holding versions which are not in the
+        remote tree, given the remote hashes of that level
+        """
+        local = self.levels[level]
+        return sorted(bucket for bucket in candidates
+                      if bucket in local and remoteHashes.get(bucket) != local[bucket])
+
+    def bucketRecordIDs(self, level, buckets):
+        """
+        Returns the IDs of the records held under the given buckets of level
+        """
+        shift = FANOUT ** (self.depth - level)
+        buckets = set(buckets)
+        recordIDs = []
+        for leaf, leafRecordIDs in self.leaves.items():
+            if leaf // shift in buckets:
+                recordIDs.extend(leafRecordIDs)
+        return recordIDs
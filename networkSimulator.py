@@ -0,0 +1,287 @@
+"""
+Discrete-event simulation of the network between Nodes.
+
+NetworkSimulator is the transport of the nodes attached to it. Messages travel on links,
+one per pair of nodes and direction, with a latency, a bandwidth and a loss rate. The
+size of a message is its size in the wire format, so a link is busy for as long as it
+takes to send it, and messages sent on a link arrive in order. Nodes handle a message
+at once, in simulated time.
+
+Devices go offline and come back, either at set times or following a churn model with
+exponentially distributed online and offline periods. Partitions cut the links between
+groups of nodes for a while. Syncs are scheduled at set times or periodically.
+
+Each sync session holds a connection, opened by a sync scheduled through the simulator.
+A message lost, sent to an offline node or across a partition breaks the connection :
+the messages still in flight in the session are lost too, and the ones sent afterwards,
+until the next scheduled sync opens the connection again. Both nodes of the session are
+told the connection was lost, and give up the snapshots streamed in it along with the
+credit they held. The next sync resumes a pull cut off that way from the last chunk
+integrated.
+
+run goes through the events in time order and returns the simulated time at which a
+convergence condition first holds.
+"""
+from __future__ import print_function, unicode_literals
+
+import heapq
+import random
+
+
+class Link(object):
+    """
+    One direction of the connection between two nodes
+    """
+
+    def __init__(self, latency=0.05, bandwidth=1000000, loss=0.0):
+        """
+        Constructor
+        latency   : seconds for a message to reach the other node once sent
+        bandwidth : bytes sent per second
+        loss      : probability for a message to be lost, breaking the connection
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+
+
+class NetworkSimulator(object):
+
+    def __init__(self, defaultLink=None, rng=random):
+        """
+        Constructor
+        defaultLink : Link of the pairs of nodes not given one with setLink
+        rng         : random number generator, for loss and churn
+        """
+        self.defaultLink = defaultLink if defaultLink is not None else Link()
+        self.rng = rng
+        self.now = 0.0
+        # Heap of (time, sequence number, function, arguments), the sequence number keeps
+        # events scheduled at the same time in order
+        self.events = []
+        self.sequence = 0
+        # (sender, receiver) -> Link
+        self.links = {}
+        # (sender, receiver) -> time the link is done sending the messages given to it
+        self.busyUntil = {}
+        self.offline = set()
+        # Pairs of nodes cut by partitions -> number of partitions cutting them
+        self.cuts = {}
+        # sessionID -> number of the current connection of the session, and the sessions broken
+        self.connections = {}
+        self.broken = set()
+        # Messages sent, delivered and lost, bytes put on the links, syncs started and skipped
+        self.sent = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.bytesSent = 0
+        self.syncs = 0
+        self.skippedSyncs = 0
+        # (sender, sessionID) -> wire encoder sizing the messages of that stream
+        self.encoders = {}
+        # Simulated time the convergence condition of the last run first held at
+        self.convergedAt = None
+
+    def attach(self, *nodes):
+        """
+        Routes the messages sent by nodes through the simulated network
+        """
+        for node in nodes:
+            node.transport = self
+
+    def setLink(self, a, b, link, symmetric=True):
+        """
+        Sets the link from a to b, and from b to a unless symmetric is False
+        """
+        self.links[(a, b)] = link
+        if symmetric:
+            self.links[(b, a)] = link
+
+    def link(self, sender, receiver):
+        return self.links.get((sender, receiver), self.defaultLink)
+
+    def at(self, time, action, *args):
+        """
+        Calls action with args at simulated time
+        """
+        heapq.heappush(self.events, (time, self.sequence, action, args))
+        self.sequence = self.sequence + 1
+
+    def every(self, interval, action, start=0.0, jitter=0.0):
+        """
+        Calls action every interval seconds from start, each call delayed by up to jitter seconds
+        """
+        def tick(time):
+            action()
+            self.at(time + interval, delayed, time + interval)
+
+        def delayed(time):
+            self.at(time + self.rng.uniform(0, jitter) if jitter else time, tick, time)
+
+        self.at(start, delayed, start)
+
+    def isConnected(self, a, b):
+        return a not in self.offline and b not in self.offline and frozenset((a, b)) not in self.cuts
+
+    def setOnline(self, node, online):
+        if online:
+            self.offline.discard(node)
+        else:
+            self.offline.add(node)
+
+    def goOffline(self, node, start, end=None):
+        """
+        Takes node offline from start until end, for good if end is None
+        """
+        self.at(start, self.setOnline, node, False)
+        if end is not None:
+            self.at(end, self.setOnline, node, True)
+
+    def addChurn(self, node, meanOnline, meanOffline, start=0.0):
+        """
+        From start, node stays online and offline in turn for periods drawn from exponential
+        distributions of means meanOnline and meanOffline seconds
+        """
+        def toggle(online):
+            self.setOnline(node, online)
+            mean = meanOnline if online else meanOffline
+            self.at(self.now + self.rng.expovariate(1.0 / mean), toggle, not online)
+
+        self.at(start + self.rng.expovariate(1.0 / meanOnline), toggle, False)
+
+    def partition(self, groups, start, end=None):
+        """
+        Cuts the links between nodes of different groups from start until end, for good if end is None.
+        Nodes in none of the groups keep their links.
+        """
+        pairs = [frozenset((a, b)) for i, group in enumerate(groups) for other in groups[i + 1:]
+                 for a in group for b in other]
+
+        def cut():
+            for pair in pairs:
+                self.cuts[pair] = self.cuts.get(pair, 0) + 1
+
+        def heal():
+            for pair in pairs:
+                self.cuts[pair] = self.cuts[pair] - 1
+                if self.cuts[pair] == 0:
+                    del self.cuts[pair]
+
+        self.at(start, cut)
+        if end is not None:
+            self.at(end, heal)
+
+    def sync(self, client, sessionID, kind="full", filter=("", "")):
+        """
+        Opens the connection of sessionID and starts a sync from client, if it can reach the server.
+        kind is "pull", "push", "full" for a pull followed by a push, or "sync" for a sync request.
+        """
+        if kind not in ("pull", "push", "full", "sync"):
+            raise ValueError("Unknown sync kind " + kind)
+        server = client.sessions[sessionID].serverInstance
+        if not self.isConnected(client, server):
+            self.skippedSyncs = self.skippedSyncs + 1
+            return
+        # Pulls of the filter cut off the last time the session was connected
+        pending = []
+        if sessionID in self.broken:
+            self.broken.discard(sessionID)
+            self.connections[sessionID] = self.connections.get(sessionID, 0) + 1
+            pending = [pullID for pullID, checkpoint in client.sessions[sessionID].checkpoints.items()
+                       if checkpoint[0] == filter]
+        self.syncs = self.syncs + 1
+        if kind in ("pull", "full") and pending:
+            # The latest pull asks for all the earlier ones were still missing
+            for pullID in pending[:-1]:
+                del client.sessions[sessionID].checkpoints[pullID]
+            client.resumePull(sessionID, pending[-1])
+        elif kind in ("pull", "full"):
+            client.pullInitiation(sessionID, filter)
+        if kind in ("push", "full"):
+            client.pushInitiation(sessionID, filter)
+        if kind == "sync":
+            client.syncInitiation(sessionID, filter)
+
+    def syncEvery(self, client, sessionID, interval, kind="full", filter=("", ""), start=None, jitter=0.0):
+        """
+        Schedules a sync from client every interval seconds, first at a random time within
+        the first interval unless start is given
+        """
+        if start is None:
+            start = self.rng.uniform(0, interval)
+        self.every(interval, lambda: self.sync(client, sessionID, kind, filter), start, jitter)
+
+    def breakConnection(self, sessionID, sender, receiver):
+        self.broken.add(sessionID)
+        self.connections[sessionID] = self.connections.get(sessionID, 0) + 1
+        self.dropped = self.dropped + 1
+        # The next connection starts new wire streams, with only the handshake's instance IDs known
+        self.encoders.pop((sender, sessionID), None)
+        self.encoders.pop((receiver, sessionID), None)
+        sender.connectionLost(sessionID)
+        receiver.connectionLost(sessionID)
+
+    def messageSize(self, sender, sessionID, data):
+        """
+        Size of a message in the wire format of its stream. Only called for messages put on
+        a link, so the encoder learns no more than the receiver will.
+        """
+        key = (sender, sessionID)
+        if key not in self.encoders:
+            self.encoders[key] = sender.sessions[sessionID].createWireEncoder()
+        return len(self.encoders[key].encode(data))
+
+    def send(self, sender, receiver, sessionID, data):
+        """
+        Called by Node.send, puts the message on the link to receiver
+        """
+        self.sent = self.sent + 1
+        if sessionID in self.broken:
+            self.dropped = self.dropped + 1
+            return
+        link = self.link(sender, receiver)
+        if not self.isConnected(sender, receiver) or (link.loss and self.rng.random() < link.loss):
+            self.breakConnection(sessionID, sender, receiver)
+            return
+        size = self.messageSize(sender, sessionID, data)
+        self.bytesSent = self.bytesSent + size
+        start = max(self.now, self.busyUntil.get((sender, receiver), 0.0))
+        self.busyUntil[(sender, receiver)] = start + float(size) / link.bandwidth
+        self.at(self.busyUntil[(sender, receiver)] + link.latency, self.deliver, sender, receiver, sessionID, data,
+                self.connections.get(sessionID, 0))
+
+    def deliver(self, sender, receiver, sessionID, data, connection):
+        if connection != self.connections.get(sessionID, 0):
+            # Sent on a connection which broke since
+            self.dropped = self.dropped + 1
+        elif not self.isConnected(sender, receiver):
+            self.breakConnection(sessionID, sender, receiver)
+        else:
+            self.delivered = self.delivered + 1
+            receiver.receive(sender, sessionID, data)
+
+    def run(self, until=None, converged=None):
+        """
+        Goes through the events in time order until simulated time until, or until there are no
+        more events. With converged, a function returning True once the nodes converged, stops as
+        soon as it holds. Returns the simulated time it first held at, None if it never did.
+        Periodic syncs and churn never run out of events, until should be given with them.
+        """
+        self.convergedAt = None
+        if converged is not None and converged():
+            self.convergedAt = self.now
+            return self.convergedAt
+        while self.events and (until is None or self.events[0][0] <= until):
+            time, sequence, action, args = heapq.heappop(self.events)
+            self.now = time
+            action(*args)
+            if converged is not None and converged():
+                self.convergedAt = self.now
+                return self.convergedAt
+        if until is not None:
+            self.now = max(self.now, until)
+        return None
+
+    def statistics(self):
+        return {"time": self.now, "sent": self.sent, "delivered": self.delivered, "dropped": self.dropped,
+                "bytesSent": self.bytesSent, "syncs": self.syncs, "skippedSyncs": self.skippedSyncs}
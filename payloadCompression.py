@@ -0,0 +1,82 @@
+"""
+Compression of record payloads in the sync path. The recordData of all records in a
+DATA or CHUNK message is compressed as one block with the codec chosen for the sync
+session, which compresses far better than record by record. Blocks smaller than a
+threshold are sent as they are, since compressing them costs more than it saves.
+"""
+from __future__ import print_function, unicode_literals
+
+import json
+import zlib
+
+from storeRecord import StoreRecord
+
+try:
+    import lzma
+except ImportError:
+    # lzma is only part of the standard library from Python 3.3
+    lzma = None
+
+# Codec name -> (compress, decompress)
+CODECS = {"zlib": (zlib.compress, zlib.decompress)}
+if lzma is not None:
+    CODECS["lzma"] = (lzma.compress, lzma.decompress)
+
+
+class CompressedRecords(object):
+    """
+    Records of a message with their recordData moved into a single, possibly compressed, payload
+    """
+
+    def __init__(self, codec, payload, records):
+        """
+        Constructor
+        codec   : name of the codec the payload was compressed with, None if it was not
+        payload : bytes holding the recordData of every record
+        records : the records, with recordData set to None
+        """
+        self.codec = codec
+        self.payload = payload
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+
+def checkCodec(codec):
+    if codec is not None and codec not in CODECS:
+        raise ValueError("Unknown compression codec : " + str(codec))
+
+
+def compressRecords(records, codec, threshold):
+    """
+    Packs the recordData of records into one payload, compressed with codec unless it is
+    smaller than threshold bytes
+    """
+    checkCodec(codec)
+    payload = json.dumps([record.recordData for record in records]).encode("utf-8")
+    if codec is None or len(payload) < threshold:
+        codec = None
+    else:
+        payload = CODECS[codec][0](payload)
+    stripped = [StoreRecord(record.recordID, None, record.lastSavedByInstance, record.lastSavedByCounter,
+                            record.lastSavedByHistory, record.partitionFacility, record.partitionUser)
+                for record in records]
+    return CompressedRecords(codec, payload, stripped)
+
+
+def decompressRecords(compressed):
+    """
+    Restores the recordData of the records held in a CompressedRecords
+    """
+    checkCodec(compressed.codec)
+    payload = compressed.payload
+    if compressed.codec is not None:
+        payload = CODECS[compressed.codec][1](payload)
+    recordData = json.loads(payload.decode("utf-8"))
+    if len(recordData) != len(compressed.records):
+        raise ValueError("Compressed payload holds %d recordData for %d records"
+                         % (len(recordData), len(compressed.records)))
+    for record, data in zip(compressed.records, recordData):
+        record.recordData = data
+    return compressed.records
@@ -0,0 +1,120 @@
+"""
+Lock letting any number of threads read a Node's store at once while writes get it alone.
+"""
+from __future__ import print_function, unicode_literals
+
+import threading
+
+try:
+    from threading import get_ident
+except ImportError:
+    # Python 2 only has it in the thread module
+    from thread import get_ident
+
+
+class ReadWriteLock(object):
+    """
+    The thread holding the write side can take either side again, so writes can be nested
+    and can read. A thread holding only the read side must not ask for the write side.
+    New readers wait while a writer is waiting, so a steady flow of readers cannot starve
+    writes. Threads already holding the read side do not wait, which keeps nested reads
+    from deadlocking.
+
+    with lock.reading(): ...
+    with lock.writing(): ...
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.condition = threading.Condition(threading.Lock())
+        # Number of read blocks entered by threads other than the writer
+        self.readers = 0
+        # Thread holding the write side and how many write blocks it entered
+        self.writer = None
+        self.writeDepth = 0
+        # Threads waiting for the write side
+        self.writersWaiting = 0
+        self.readSide = ReadSide(self)
+        self.writeSide = WriteSide(self)
+
+    def reading(self):
+        return self.readSide
+
+    def writing(self):
+        return self.writeSide
+
+    def acquireRead(self, nested=False):
+        """
+        Returns False when the calling thread already holds the write side
+        nested : the calling thread already holds the read side
+        """
+        if self.writer == get_ident():
+            return False
+        with self.condition:
+            while self.writer is not None or (self.writersWaiting > 0 and not nested):
+                self.condition.wait()
+            self.readers = self.readers + 1
+        return True
+
+    def releaseRead(self):
+        with self.condition:
+            self.readers = self.readers - 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquireWrite(self):
+        me = get_ident()
+        # Only the writer itself can have set writer to its own ident
+        if self.writer != me:
+            with self.condition:
+                self.writersWaiting = self.writersWaiting + 1
+                while self.writer is not None or self.readers > 0:
+                    self.condition.wait()
+                self.writersWaiting = self.writersWaiting - 1
+                self.writer = me
+        self.writeDepth = self.writeDepth + 1
+
+    def releaseWrite(self):
+        self.writeDepth = self.writeDepth - 1
+        if self.writeDepth == 0:
+            with self.condition:
+                self.writer = None
+                self.condition.notify_all()
+
+
+class ReadSide(object):
+    """
+    Context manager of the read side, shared by every thread
+    """
+
+    def __init__(self, lock):
+        self.lock = lock
+        # Per thread stack of whether each entered block counted as a reader
+        self.counted = threading.local()
+
+    def __enter__(self):
+        stack = self.counted.__dict__.setdefault("stack", [])
+        stack.append(self.lock.acquireRead(True in stack))
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.counted.stack.pop():
+            self.lock.releaseRead()
+        return False
+
+
+class WriteSide(object):
+    """
+    Context manager of the write side
+    """
+
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquireWrite()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.lock.releaseWrite()
+        return False
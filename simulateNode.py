@@ -3,61 +3,205 @@ A Node represents a data store with many records.
 """
 from __future__ import print_function, unicode_literals
 
-from storeRecord import StoreRecord
-from syncSession import SyncSession
-from copy import deepcopy
+from instanceTable import InstanceTable
+from merkleTree import MerkleTree
+from payloadCompression import CompressedRecords, checkCodec, compressRecords, decompressRecords
+from readWriteLock import ReadWriteLock
+from storeEngine import MemoryStoreEngine
+from storeRecord import StoreRecord, internString
+from syncMetrics import NO_PHASE, PhaseTimer
+from syncSession import SnapshotStream, SyncSession
+from versionVector import VersionVector, asVersionVector
+from contextlib import contextmanager
+from itertools import islice
 
 import hashlib
+import threading
 
 
 class Node:
     GENERIC = None
+    # The incoming budget is split in at most this many shares, so credit comes in usable amounts
+    CREDIT_SHARES = 4
 
-    def __init__(self, instanceID):
+    def __init__(self, instanceID, storeEngine=None):
         """
-        Constructor
+        Constructor, storeEngine holds the store (in memory by default)
         """
         if len(instanceID) == 0:
             raise ValueError('Length of instanceID should be greater than 0')
-        self.instanceID = instanceID
+        self.instanceID = internString(instanceID)
         # Initiate a node with counter position 0
         self.counter = 0
         # Add an entry for full replication containing own instance ID and counter position
-        self.syncDataStructure = {"+": {str(self.instanceID): self.counter}}
-        self.store = {}
+        self.syncDataStructure = {"+": {self.instanceID: self.counter}}
+        # FSIC per filter, dropped whenever one of the syncDataStructure entries it is built from changes
+        self.fsicCache = {}
+        self.store = storeEngine if storeEngine is not None else MemoryStoreEngine()
+        # Snapshots read the store under the read side, anything changing it takes the write side
+        self.lock = ReadWriteLock()
         self.incomingBuffer = {}
         self.appData = []
+        # Maps recordID to its slot in appData
+        self.appIndex = {}
+        # Set when the store held records at start, which are only inflated into appData once looked for
+        self.lazyAppData = False
+        # Inside a transaction, maps recordID to its application record as it was before the
+        # transaction changed it, None for records the transaction added
+        self.appUndo = None
+        # Maps (partitionFacility, partitionUser) to the IDs of application records with the dirty bit set
+        self.dirtyRecords = {}
         self.outgoingBuffer = {}
         self.sessions = {}
+        # Numbers every instance ID found in the syncDataStructure, starting with this node's own
+        self.instances = InstanceTable([self.instanceID])
+        # When set, snapshots are streamed to the other device in chunks of this many records
+        self.chunkSize = None
+        # When set, pulls compare Merkle trees of this depth instead of FSICs
+        self.merkleDepth = None
+        # When set, snapshots are announced with a manifest of record versions and only the
+        # records the other device is missing are sent. Chunked snapshots are sent as they are.
+        self.manifestMode = False
+        # Merkle pulls in progress by pullID : (sessionID, tree, filter) on the client,
+        # (sessionID, tree, remote FSIC, changes, buckets asked for next) on the server
+        self.merkleRequests = {}
+        # Transport carrying messages to other devices, None delivers them synchronously
+        self.transport = None
+        # When set, at most this many records sent to this node are in flight or waiting to be
+        # integrated at once. Other devices stream their snapshots only as far as the credit
+        # it grants, which is shared between the snapshots it is receiving.
+        self.incomingBudget = None
+        # Snapshots being received under the budget : pushPullID -> [sender, sessionID, credit not used yet]
+        self.incomingStreams = {}
+        self.creditOutstanding = 0
+        # Snapshots being sent to devices with a budget, by pushPullID
+        self.outgoingStreams = {}
+        # Guards the credit of incoming and outgoing streams
+        self.flowLock = threading.Lock()
+        # Receives the timings and counters of the sync phases when set, see syncMetrics
+        self.metrics = None
+
+        # Resume from whatever the store engine has persisted
+        for filter, fsic in self.store.readSyncDataStructure().items():
+            self.syncDataStructure.setdefault(filter, {}).update(fsic)
+            self.instances.update(fsic)
+        self.counter = self.syncDataStructure["+"][self.instanceID]
+        self.lazyAppData = len(self.store) > 0
+
+    def count(self, name, amount=1):
+        """
+        Adds amount to a counter of the metrics, if any
+        """
+        if self.metrics is not None:
+            self.metrics.count(self, None, name, amount)
+
+    def phase(self, name):
+        """
+        Context manager timing a phase for the metrics, if any
+        """
+        if self.metrics is None:
+            return NO_PHASE
+        return PhaseTimer(self, name)
 
     def updateCounter(self):
         """
         Increment counter by 1 when data is saved/modified
         """
         self.counter = self.counter + 1
-        self.syncDataStructure["+"][str(self.instanceID)] = self.counter
+        self.syncDataStructure["+"][self.instanceID] = self.counter
+        self.invalidateFSIC("+")
+        self.store.writeFSIC("+", {self.instanceID: self.counter})
 
     def searchRecordInApp(self, recordID):
         """
         Returns index of the record in appData if it exists,
         -1 otherwise
         """
-        for i, record in enumerate(self.appData):
-            if record[0] == recordID:
-                return i
-        return -1
+        recordIndex = self.appIndex.get(recordID, -1)
+        if recordIndex < 0 and self.lazyAppData and recordID in self.store:
+            # Stored before the node started, inflated on first use
+            self.appendAppRecord(self.inflateRecord(self.store[recordID]), False)
+            recordIndex = len(self.appData) - 1
+        return recordIndex
+
+    def appendAppRecord(self, appRecord, undoable=True):
+        """
+        Appends an application record to appData and indexes its slot
+        """
+        if undoable and self.appUndo is not None:
+            self.appUndo.setdefault(appRecord[0], None)
+        self.appIndex[appRecord[0]] = len(self.appData)
+        self.appData.append(appRecord)
+
+    def saveAppRecord(self, appRecord):
+        """
+        Keeps the state of an application record about to change, to restore it if the transaction fails
+        """
+        if self.appUndo is not None and appRecord[0] not in self.appUndo:
+            self.appUndo[appRecord[0]] = list(appRecord)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Store transaction which also undoes the changes made meanwhile to the counter, the
+        syncDataStructure and appData if the block raises. Blocks can be nested.
+        """
+        if self.appUndo is not None:
+            with self.store.transaction():
+                yield
+            return
+        counter = self.counter
+        syncDataStructure = dict((filter, dict(fsic)) for filter, fsic in self.syncDataStructure.items())
+        self.appUndo = {}
+        try:
+            with self.store.transaction():
+                yield
+        except Exception:
+            self.counter = counter
+            self.syncDataStructure.clear()
+            self.syncDataStructure.update(syncDataStructure)
+            self.fsicCache.clear()
+            added = set(recordID for recordID, appRecord in self.appUndo.items() if appRecord is None)
+            for recordID, appRecord in self.appUndo.items():
+                if appRecord is not None:
+                    self.appData[self.appIndex[recordID]][:] = appRecord
+                    self.setDirtyBit(self.appData[self.appIndex[recordID]], appRecord[2])
+            if added:
+                self.appData = [appRecord for appRecord in self.appData if appRecord[0] not in added]
+                self.appIndex = dict((appRecord[0], index) for index, appRecord in enumerate(self.appData))
+                for recordIDs in self.dirtyRecords.values():
+                    recordIDs.difference_update(added)
+            raise
+        finally:
+            self.appUndo = None
+
+    def setDirtyBit(self, appRecord, dirtyBit):
+        """
+        Sets the dirty bit of an application record and keeps dirtyRecords in step
+        """
+        self.saveAppRecord(appRecord)
+        appRecord[2] = dirtyBit
+        partition = (appRecord[3], appRecord[4])
+        if dirtyBit:
+            if partition not in self.dirtyRecords:
+                self.dirtyRecords[partition] = set()
+            self.dirtyRecords[partition].add(appRecord[0])
+        elif partition in self.dirtyRecords:
+            self.dirtyRecords[partition].discard(appRecord[0])
 
     def addAppData(self, recordID, recordData, partitionFacility, partitionUser):
         """
         Adding records to the application
         """
-        recordIndex = self.searchRecordInApp(recordID)
-        if recordIndex >= 0:
-            self.appData[recordIndex][1] = recordData
-            self.appData[recordIndex][2] = 1
-        else:
-            # Third argument is the dirty bit which will always be set for new data
-            self.appData.append([recordID, recordData, 1, partitionFacility, partitionUser])
+        with self.lock.writing():
+            recordIndex = self.searchRecordInApp(recordID)
+            if recordIndex >= 0:
+                self.appData[recordIndex][1] = recordData
+                self.setDirtyBit(self.appData[recordIndex], 1)
+            else:
+                # Third argument is the dirty bit which will always be set for new data
+                self.appendAppRecord([recordID, recordData, 1, partitionFacility, partitionUser])
+                self.setDirtyBit(self.appData[-1], 1)
 
     def superSetFilters(self, filter):
         """
@@ -91,43 +235,51 @@ class Node:
         elif len(dicts) == 1:
             return dicts[0]
 
-        result = deepcopy(dicts[0])
-        for i in range(1, len(dicts)):
-            for k, v in dicts[i].items():
-                if k in result:
-                    result[k] = max(result[k], dicts[i][k])
-                else:
-                    result[k] = v
-        return result
+        return VersionVector(dicts[0]).mergeMax(*dicts[1:])
+
+    def invalidateFSIC(self, filterKey):
+        """
+        Drops the cached FSICs built from the syncDataStructure entry filterKey
+        """
+        if filterKey == "+":
+            # Every FSIC includes the full replication entry
+            self.fsicCache.clear()
+            return
+        for key in list(self.fsicCache):
+            if key[0] and (filterKey == key[0] + "+" or (key[1] and filterKey == key[0] + "+" + key[1])):
+                del self.fsicCache[key]
 
     def calcFSIC(self, filter):
         """
         Given a filter(f), finds out maximum counter per instance for all
         filters which are superset of filter(f).
+        The result is cached and shared between callers, it must not be modified.
         """
-        # List of all superset filters
-        superSetFilters = self.superSetFilters(filter)
+        with self.lock.reading():
+            key = (filter[0], filter[1])
+            if key in self.fsicCache:
+                return self.fsicCache[key]
 
-        fsic = {}
-        for i in superSetFilters:
-            fsic = self.giveMaxDict([fsic, self.syncDataStructure[i]])
-        return fsic
+            with self.phase("fsic"):
+                # List of all superset filters
+                superSetFilters = self.superSetFilters(filter)
+
+                fsic = VersionVector().mergeMax(*[self.syncDataStructure[i] for i in superSetFilters])
+            self.fsicCache[key] = fsic
+            return fsic
 
     def updateSyncDS(self, change, filter):
         """
-        Makes changes to syncDataStructure after data has been integrated to the Store
+        Makes changes to syncDataStructure after data has been integrated to the Store. Entries
+        only ever go up : a chunk checkpoint may have taken them past the changes of the snapshot.
         """
-        # Merging existing syncDataSructure to accomodate
-        if filter in self.syncDataStructure:
-            temp = self.syncDataStructure[filter]
-            for key, value in change.items():
-                if key in temp:
-                    temp[key] = value
-                else:
-                    temp[key] = value
-        # no filter exists in the existing syncDataStructure
-        else:
-            self.syncDataStructure[filter] = change
+        with self.lock.writing():
+            fsic = self.syncDataStructure.setdefault(filter, {})
+            raised = dict((key, value) for key, value in change.items() if key not in fsic or fsic[key] < value)
+            fsic.update(raised)
+            self.instances.update(change)
+            self.invalidateFSIC(filter)
+            self.store.writeFSIC(filter, raised)
 
     def isSubset(self, filter1, filter2):
         """
@@ -145,38 +297,64 @@ class Node:
                     return True
         return False
 
-    def searchRecordInStore(self, instanceID, counterLow, counterHigh, partitionFacility, partitionUser):
-        records = []
-        for key, value in self.store.items():
-            recordCounter = value.lastSavedByCounter
-            recordInstance = value.lastSavedByInstance
+    def addRecordToStore(self, record):
+        """
+        Puts a record in the store, replacing any record with the same ID
+        """
+        self.store.addRecord(record)
 
-            if recordCounter >= counterLow and recordCounter <= counterHigh and recordInstance == instanceID:
-                # Full replication condition, get all the records
-                if self.isSubset((value.partitionFacility, value.partitionUser), (partitionFacility, partitionUser)):
-                    records.append(value)
-        return records
+    def searchRecordInStore(self, instanceID, counterLow, counterHigh, partitionFacility, partitionUser):
+        """
+        Returns records last saved by instanceID with counter between counterLow and counterHigh
+        (both inclusive) which fall under the given partition, ordered by counter
+        """
+        return self.store.rangeQuery(instanceID, counterLow, counterHigh, partitionFacility, partitionUser)
 
-    def calcDiffFSIC(self, fsic1, fsic2, partFacility, partUser):
+    def calcDiffChanges(self, fsic1, fsic2):
         """
         fsic1  : Local FSIC copy
         fsic2  : Remote FSIC copy
-        filter : filter associated to both FSIC instances
-        Calculates changes, according to the new data which local device has
+        Returns the FSIC entries in which the local device is ahead of the remote one
         """
-        records = []
         changes = {}
+        for key, value in fsic1.items():
+            if key not in fsic2 or fsic2[key] < value:
+                changes[key] = value
+        return changes
+
+    def iterDiffFSIC(self, fsic1, fsic2, partFacility, partUser):
+        """
+        Generator version of calcDiffFSIC, yields the records one at a time
+        """
         for key, value in fsic1.items():
             if key in fsic2:
-                if fsic2[key] < fsic1[key]:
-                    records = records + self.searchRecordInStore(key, fsic2[key] + 1, \
-                                                                 fsic1[key] + 1, partFacility, partUser)
-                    changes[key] = fsic1[key]
+                if fsic2[key] < value:
+                    for record in self.searchRecordInStore(key, fsic2[key] + 1, value + 1, partFacility, partUser):
+                        yield record
             else:
-                records = records + self.searchRecordInStore(key, 1, value + 1, partFacility, partUser)
-                changes[key] = value
+                for record in self.searchRecordInStore(key, 1, value + 1, partFacility, partUser):
+                    yield record
+
+    def calcDiffFSIC(self, fsic1, fsic2, partFacility, partUser):
+        """
+        fsic1  : Local FSIC copy
+        fsic2  : Remote FSIC copy
+        filter : filter associated to both FSIC instances
+        Calculates changes, according to the new data which local device has
+        """
+        changes = self.calcDiffChanges(fsic1, fsic2)
+        records = list(self.iterDiffFSIC(fsic1, fsic2, partFacility, partUser))
         return (changes, records)
 
+    def buildMerkleTree(self, filter, depth):
+        """
+        Returns the Merkle tree of the store records falling under filter, found without relying on the FSICs
+        """
+        with self.lock.reading(), self.phase("snapshot"):
+            tree = MerkleTree(self.store.partitionQuery(filter[0], filter[1]), depth)
+            self.count("recordsScanned", tree.numRecords)
+            return tree
+
     def updateIncomingBuffer(self, pushPullID, filter, records):
         """
         Creating Incoming Buffer
@@ -191,36 +369,60 @@ class Node:
         Input : Filter
         Serializes data from application(with dirty bit set) to store according to input filter
         """
-        for i in range(0, len(self.appData)):
-            tempAppData = self.appData[i]
-            if tempAppData[2] and self.isSubset((tempAppData[3], tempAppData[4]), filter):
-                self.updateCounter()
-                # If store has a record with the same ID
-                if tempAppData[0] in self.store:
-                    temp = self.store[str(tempAppData[0])].lastSavedByHistory
-                    temp[str(self.instanceID)] = self.counter
-                    record = StoreRecord(tempAppData[0], tempAppData[1], self.instanceID, \
-                                         self.counter, temp, tempAppData[3], tempAppData[4])
-                # Adding a new record with the given recordID
-                else:
-                    record = StoreRecord(tempAppData[0], tempAppData[1], self.instanceID, \
-                                         self.counter, {str(self.instanceID): self.counter}, tempAppData[3],
-                                         tempAppData[4])
-                self.store[str(tempAppData[0])] = record
-                # Clear dirty bit from data residing in the application
-                self.appData[i] = self.appData[i][:2] + [0, self.appData[i][-2]]
-                # Making changes to Sync Data Structure
-                self.syncDataStructure["+"][str(self.instanceID)] = self.counter
+        with self.lock.writing(), self.phase("serialize"):
+            # Only the dirty records of partitions covered by the filter are visited
+            recordIndexes = []
+            serialized = []
+            for partition, recordIDs in self.dirtyRecords.items():
+                if recordIDs and self.isSubset(partition, filter):
+                    recordIndexes.extend(self.appIndex[recordID] for recordID in recordIDs)
+                    serialized.append(recordIDs)
+            # Serialize in application order
+            recordIndexes.sort()
+
+            # Every record written by this call is committed at once
+            copies = 0
+            with self.transaction():
+                for i in recordIndexes:
+                    tempAppData = self.appData[i]
+                    self.updateCounter()
+                    # If store has a record with the same ID
+                    if tempAppData[0] in self.store:
+                        temp = VersionVector(self.store[str(tempAppData[0])].lastSavedByHistory)
+                        temp[self.instanceID] = self.counter
+                        copies = copies + 1
+                        record = StoreRecord(tempAppData[0], tempAppData[1], self.instanceID, \
+                                             self.counter, temp, tempAppData[3], tempAppData[4])
+                    # Adding a new record with the given recordID
+                    else:
+                        record = StoreRecord(tempAppData[0], tempAppData[1], self.instanceID, \
+                                             self.counter, VersionVector({self.instanceID: self.counter}),
+                                             tempAppData[3], tempAppData[4])
+                    self.addRecordToStore(record)
+                    # Clear dirty bit from data residing in the application
+                    self.saveAppRecord(tempAppData)
+                    tempAppData[2] = 0
+                    # Making changes to Sync Data Structure
+                    self.syncDataStructure["+"][self.instanceID] = self.counter
+            # The records stay dirty if the transaction fails
+            for recordIDs in serialized:
+                recordIDs.clear()
+            self.count("copies", copies)
 
     def integrate(self):
-        for key, value in list(self.incomingBuffer.items()):
-            for i in value[1][1]:
-                self.integrateRecord(i)
-
-            # Update the sync data structure according to integrated data
-            self.updateSyncDS(value[1][0], value[0][0] + "+" + value[0][1])
-            # After all the records from incoming buffer have been integrated to store
-            del self.incomingBuffer[key]
+        with self.lock.writing(), self.phase("integrate"):
+            for key, value in list(self.incomingBuffer.items()):
+                self.count("recordsIntegrated", len(value[1][1]))
+                # Records and sync data structure changes of a buffer entry are committed together
+                with self.transaction():
+                    for i in value[1][1]:
+                        self.integrateRecord(i)
+
+                    if value[1][0] is not None:
+                        # Update the sync data structure according to integrated data
+                        self.updateSyncDS(value[1][0], value[0][0] + "+" + value[0][1])
+                # After all the records from incoming buffer have been integrated to store
+                del self.incomingBuffer[key]
 
     def compareVersions(self, v1, v2, savedBy1, savedBy2):
         """
@@ -232,8 +434,8 @@ class Node:
         if savedBy1 == savedBy2:
             return 3
 
-        v2GreaterThanv1 = savedBy1[0] in v2 and v2[savedBy1[0]] >= savedBy1[1]
-        v1GreaterThanv2 = savedBy2[0] in v1 and v1[savedBy2[0]] >= savedBy2[1]
+        v2GreaterThanv1 = asVersionVector(v2).covers(*savedBy1)
+        v1GreaterThanv2 = asVersionVector(v1).covers(*savedBy2)
 
         if v2GreaterThanv1 and not (v1GreaterThanv2):
             return 0
@@ -247,6 +449,7 @@ class Node:
         Not using data1 and application data currently to resolve conflict
         Picking one of the values using hash values
         """
+        self.count("conflicts")
         hashedData1 = hashlib.md5(data1[1].encode("utf-8")).hexdigest()
         hashedAppData = hashlib.md5(self.appData[indexInApp][1].encode("utf-8")).hexdigest()
         if (hashedData1 > hashedAppData):
@@ -263,36 +466,39 @@ class Node:
         return [record.recordID, record.recordData, 0, record.partitionFacility, record.partitionUser]
 
     def editRecordInStore(self, recordID, recordData, instanceID, counter, history):
-        self.store[recordID].recordData = recordData
-        self.store[recordID].lastSavedByInstance = instanceID
-        self.store[recordID].lastSavedByCounter = counter
-        self.store[recordID].lastSavedByHistory = history
-
-    def bufferDataChosen(self, record, hist):
-        recordIndex = self.searchRecordInApp(record.recordID)
-        storeRecordHistory = self.store[record.recordID].lastSavedByHistory
+        self.store.editRecord(recordID, recordData, instanceID, counter, history)
 
-        self.appData[recordIndex][1] = record.recordData
+    def writeChosenVersion(self, record, recordData, hist, storeRecord):
+        """
+        Writes the version chosen for a received record, with recordData and the histories of
+        the received and stored versions merged with hist. hist names this node's counter when
+        the version is the outcome of a merge, it is empty when the received version wins as it is.
+        The merged history is built once, into the one new record written.
+        """
+        if self.metrics is not None:
+            self.count("historyMerges")
+            self.count("copies")
+        # Records already in the store may be read by snapshots at any time, so they are never changed
+        history = VersionVector(record.lastSavedByHistory)
+        if storeRecord is not None:
+            history.mergeMax(storeRecord.lastSavedByHistory)
         if len(hist) > 0:
-            history = self.giveMaxDict([record.lastSavedByHistory, storeRecordHistory, hist])
-            self.editRecordInStore(record.recordID, record.recordData, self.instanceID, self.counter, history)
+            history.mergeMax(hist)
+            instanceID, counter = self.instanceID, self.counter
         else:
-            history = self.giveMaxDict([record.lastSavedByHistory, storeRecordHistory])
-            self.editRecordInStore(record.recordID, record.recordData, record.lastSavedByInstance, \
-                                   record.lastSavedByCounter, history)
+            instanceID, counter = record.lastSavedByInstance, record.lastSavedByCounter
+        self.addRecordToStore(StoreRecord(record.recordID, recordData, instanceID, counter, history,
+                                          record.partitionFacility, record.partitionUser))
 
-    def appDataChosen(self, record, hist):
+    def bufferDataChosen(self, record, hist, storeRecord):
         recordIndex = self.searchRecordInApp(record.recordID)
-        storeRecordHistory = self.store[record.recordID].lastSavedByHistory
+        self.saveAppRecord(self.appData[recordIndex])
+        self.appData[recordIndex][1] = record.recordData
+        self.writeChosenVersion(record, record.recordData, hist, storeRecord)
 
-        if len(hist) > 0:
-            history = self.giveMaxDict([record.lastSavedByHistory, storeRecordHistory, hist])
-            self.editRecordInStore(record.recordID, self.appData[recordIndex][1], \
-                                   self.instanceID, self.counter, history)
-        else:
-            history = self.giveMaxDict([record.lastSavedByHistory, storeRecordHistory])
-            self.editRecordInStore(record.recordID, self.appData[recordIndex][1], record.lastSavedByInstance \
-                                   , record.lastSavedByCounter, history)
+    def appDataChosen(self, record, hist, storeRecord):
+        recordIndex = self.searchRecordInApp(record.recordID)
+        self.writeChosenVersion(record, self.appData[recordIndex][1], hist, storeRecord)
 
     def integrateRecord(self, record):
         """
@@ -309,12 +515,12 @@ class Node:
             # Record exists in the application
             if recordIndex >= 0:
 
+                storeRecord = self.store[record.recordID]
                 # Dirty bit in the application is not set
                 if self.appData[recordIndex][2] == 0:
 
-                    storeRecordHistory = self.store[record.recordID].lastSavedByHistory
-                    storeRecord = self.store[record.recordID]
-                    versionComparison = self.compareVersions(storeRecordHistory, record.lastSavedByHistory, \
+                    versionComparison = self.compareVersions(storeRecord.lastSavedByHistory, \
+                                                             record.lastSavedByHistory, \
                                                              (storeRecord.lastSavedByInstance,
                                                               storeRecord.lastSavedByCounter), \
                                                              (record.lastSavedByInstance, record.lastSavedByCounter))
@@ -325,15 +531,15 @@ class Node:
                         self.updateCounter()
                         if self.resolveMergeConflict(inflatedIncomingBufferRecord, recordIndex):
                             # Merge conflict resolution did not choose the app data
-                            self.bufferDataChosen(record, {self.instanceID: self.counter})
+                            self.bufferDataChosen(record, {self.instanceID: self.counter}, storeRecord)
 
                         else:
                             # Merge conflict resolution algorithm chose app data
-                            self.appDataChosen(record, {self.instanceID: self.counter})
+                            self.appDataChosen(record, {self.instanceID: self.counter}, storeRecord)
 
                     # Chooses incoming buffer record
                     elif versionComparison == 0:
-                        self.bufferDataChosen(record, {})
+                        self.bufferDataChosen(record, {}, storeRecord)
 
                     # Application record is updated
                     elif versionComparison == 1 or versionComparison == 3:
@@ -345,14 +551,14 @@ class Node:
                 # Dirty bit for the record is set
                 else:
                     self.updateCounter()
-                    self.appData[recordIndex][2] = 2
+                    self.setDirtyBit(self.appData[recordIndex], 2)
                     # Merge conflict resolution did not choose the app Data
                     if self.resolveMergeConflict(inflatedIncomingBufferRecord, recordIndex):
-                        self.bufferDataChosen(record, {self.instanceID: self.counter})
+                        self.bufferDataChosen(record, {self.instanceID: self.counter}, storeRecord)
 
                     # Merge conflict resolution chose the app Data
                     else:
-                        self.appDataChosen(record, {self.instanceID: self.counter})
+                        self.appDataChosen(record, {self.instanceID: self.counter}, storeRecord)
 
             # Record does not exist in the application
             else:
@@ -363,38 +569,256 @@ class Node:
             # Record exists in the application
             if recordIndex >= 0:
 
-                if self.appData[i][2] == 0:
+                if self.appData[recordIndex][2] == 0:
                     raise ValueError('Data not present in Store but present in Application!')
 
                 else:
                     self.updateCounter()
                     # Does not choose app Data
                     if self.resolveMergeConflict(inflatedIncomingBufferRecord, recordIndex):
-                        self.store[record.recordID] = deepcopy(record)
-                        self.bufferDataChosen(record, {self.instanceID: self.counter})
+                        self.bufferDataChosen(record, {self.instanceID: self.counter}, None)
 
                     # Chooses app Data
                     else:
-                        self.appData[recordIndex][2] = 0
-                        self.store[record.recordID] = deepcopy(record)
-                        self.appDataChosen(record, {self.instanceID: self.counter})
+                        self.setDirtyBit(self.appData[recordIndex], 0)
+                        self.appDataChosen(record, {self.instanceID: self.counter}, None)
 
             # Record does not exist in the application
             else:
-                self.appData.append(self.inflateRecord(record))
-                self.store[str(record.recordID)] = deepcopy(record)
+                self.appendAppRecord(self.inflateRecord(record))
+                self.addRecordCopy(record)
+
+    def addRecordCopy(self, record):
+        """
+        Puts a copy of a received record in the store, the received one may still be read by its sender
+        """
+        if self.metrics is not None:
+            self.count("copies")
+        self.addRecordToStore(record.copy())
 
     def fsicDiffAndSnapshot(self, filter, receivedFSIC):
         """
         Input : remote FSIC, filter
         Output : Transfers data to be sent in the outgoing buffer
         """
-        # Create a copy of your FSIC
+        with self.lock.reading(), self.phase("snapshot"):
+            # Create a copy of your FSIC
+            localFSIC = self.calcFSIC(filter)
+            # Calculates differences in local and remote FSIC
+            extra = self.calcDiffFSIC(localFSIC, receivedFSIC, filter[0], filter[1])
+            self.count("recordsScanned", len(extra[1]))
+            # Put all the data to be sent in outgoing buffer
+            return (filter, extra)
+
+    def sendSnapshot(self, receiver, sessionID, pushPullID, filter, receivedFSIC, sync=False):
+        """
+        Streams the snapshot for a remote FSIC in CHUNK messages of at most chunkSize records.
+        The last records go out in the final DATA message along with the changes, or in a
+        SYNCDATA message carrying the local FSIC if sync is True.
+        Records come out instance by instance in counter order, so each CHUNK carries the
+        checkpoint the receiver reaches with it : the counter of the last record sent from
+        every instance started so far. If the transfer is cut, a new request from the
+        receiver's FSIC only asks for what comes after the last chunk it integrated.
+        """
         localFSIC = self.calcFSIC(filter)
-        # Calculates differences in local and remote FSIC
-        extra = self.calcDiffFSIC(localFSIC, receivedFSIC, filter[0], filter[1])
-        # Put all the data to be sent in outgoing buffer
-        return (filter, extra)
+        changes = self.calcDiffChanges(localFSIC, receivedFSIC)
+        records = self.iterDiffFSIC(localFSIC, receivedFSIC, filter[0], filter[1])
+        if self.sessions[sessionID].peerBudget is not None:
+            # Records only go out as credit arrives from the receiver. A request sent again
+            # under the same ID replaces the stream it started before.
+            self.outgoingStreams[pushPullID] = SnapshotStream(receiver, sessionID, filter, changes, records)
+            return
+        self.sendChunks(receiver, sessionID, pushPullID, filter, changes, records, localFSIC if sync else None)
+
+    def sendChunks(self, receiver, sessionID, pushPullID, filter, changes, records, syncFSIC=None):
+        """
+        Sends records, an iterator going instance by instance in counter order, in CHUNK
+        messages of at most chunkSize records. The last ones go out in a DATA message along
+        with the changes, or in a SYNCDATA message carrying syncFSIC if given.
+        """
+        checkpoint = VersionVector()
+        # The store is only locked while a chunk is read, not while it is sent
+        with self.lock.reading(), self.phase("snapshot"):
+            chunk = list(islice(records, self.chunkSize))
+            self.count("recordsScanned", len(chunk))
+        while True:
+            with self.lock.reading(), self.phase("snapshot"):
+                nextChunk = list(islice(records, self.chunkSize))
+                self.count("recordsScanned", len(nextChunk))
+            if not nextChunk:
+                break
+            for record in chunk:
+                checkpoint[record.lastSavedByInstance] = record.lastSavedByCounter
+            self.send(receiver, sessionID, ("CHUNK", pushPullID, (filter, self.packRecords(sessionID, chunk)),
+                                            checkpoint.copy()))
+            chunk = nextChunk
+        data = (filter, (changes, self.packRecords(sessionID, chunk)))
+        if syncFSIC is None:
+            self.send(receiver, sessionID, ("DATA", pushPullID, data))
+        else:
+            self.send(receiver, sessionID, ("SYNCDATA", pushPullID, data, syncFSIC))
+
+    def addCredit(self, pushPullID, credit):
+        """
+        Sends as much of the snapshot streamed for pushPullID as the credit now allows. Chunks
+        are cut short to the credit, and the snapshot ends with a DATA holding fewer records
+        than the credit allowed for, which can be empty.
+        """
+        stream = self.outgoingStreams.get(pushPullID)
+        if stream is None:
+            return
+        with self.flowLock:
+            stream.credit = stream.credit + credit
+            if stream.sending:
+                return
+            stream.sending = True
+        while True:
+            with self.flowLock:
+                size = min(stream.credit, self.chunkSize or stream.credit)
+                if size == 0 or self.outgoingStreams.get(pushPullID) is not stream:
+                    # Out of credit, or the receiver gave up on the snapshot
+                    stream.sending = False
+                    return
+                stream.credit = stream.credit - size
+            with self.lock.reading(), self.phase("snapshot"):
+                chunk = list(islice(stream.records, size))
+                self.count("recordsScanned", len(chunk))
+            if len(chunk) < size:
+                self.outgoingStreams.pop(pushPullID, None)
+                self.send(stream.receiver, stream.sessionID, ("DATA", pushPullID, (
+                    stream.filter, (stream.changes, self.packRecords(stream.sessionID, chunk)))))
+                return
+            for record in chunk:
+                stream.checkpoint[record.lastSavedByInstance] = record.lastSavedByCounter
+            self.send(stream.receiver, stream.sessionID, ("CHUNK", pushPullID, (
+                stream.filter, self.packRecords(stream.sessionID, chunk)), stream.checkpoint.copy()))
+
+    def expectStream(self, sender, sessionID, pushPullID):
+        """
+        Called once this node asked sender for the snapshot of pushPullID, grants it credit
+        if this node has an incoming budget. Snapshots received at once, in one session or
+        several, share the budget.
+        """
+        if self.incomingBudget is None:
+            return
+        with self.flowLock:
+            # A request sent again under the same ID starts over, with the credit it held given back
+            if pushPullID in self.incomingStreams:
+                self.creditOutstanding = self.creditOutstanding - self.incomingStreams[pushPullID][2]
+            self.incomingStreams[pushPullID] = [sender, sessionID, 0]
+        self.grantCredit()
+
+    def releaseIncomingStreams(self, sessionID):
+        """
+        Stops waiting for the snapshots of sessionID being received and takes back their credit
+        """
+        with self.flowLock:
+            for pushPullID in [pushPullID for pushPullID, stream in self.incomingStreams.items()
+                               if stream[1] == sessionID]:
+                self.creditOutstanding = self.creditOutstanding - self.incomingStreams.pop(pushPullID)[2]
+
+    def dropOutgoingStreams(self, sessionID):
+        """
+        Stops sending the snapshots of sessionID waiting for credit
+        """
+        with self.flowLock:
+            for pushPullID in [pushPullID for pushPullID, stream in self.outgoingStreams.items()
+                               if stream.sessionID == sessionID]:
+                del self.outgoingStreams[pushPullID]
+
+    def connectionLost(self, sessionID):
+        """
+        Called by transports when the connection carrying sessionID drops : the snapshots and
+        Merkle pulls of the session in either direction are given up, the credit they held
+        goes to the others
+        """
+        self.dropOutgoingStreams(sessionID)
+        if self.sessions[sessionID].clientInstance is not None:
+            # Only pulls resume, the server forgets the pushes it was receiving
+            self.sessions[sessionID].checkpoints.clear()
+        for pullID in [pullID for pullID, request in self.merkleRequests.items() if request[0] == sessionID]:
+            del self.merkleRequests[pullID]
+        if self.incomingBudget is not None:
+            self.releaseIncomingStreams(sessionID)
+            self.grantCredit()
+
+    def streamReceived(self, pushPullID, numRecords, last):
+        """
+        Gives back the credit of records which have been integrated, and all the credit of a
+        snapshot once its last message arrived
+        """
+        with self.flowLock:
+            stream = self.incomingStreams.get(pushPullID)
+            if stream is None:
+                return
+            used = stream[2] if last else min(numRecords, stream[2])
+            stream[2] = stream[2] - used
+            self.creditOutstanding = self.creditOutstanding - used
+            if last:
+                del self.incomingStreams[pushPullID]
+        self.grantCredit()
+
+    def grantCredit(self):
+        """
+        Shares the free part of the incoming budget between the snapshots being received,
+        each one holding at most one share at a time. With more snapshots than shares they
+        are granted credit in turn.
+        """
+        grants = []
+        with self.flowLock:
+            if not self.incomingStreams:
+                return
+            share = max(1, self.incomingBudget // min(len(self.incomingStreams), self.CREDIT_SHARES))
+            for pushPullID in list(self.incomingStreams):
+                credit = min(share - self.incomingStreams[pushPullID][2], self.incomingBudget - self.creditOutstanding)
+                if credit > 0:
+                    # Streams granted credit go last next time, so a small budget is shared in turn
+                    stream = self.incomingStreams.pop(pushPullID)
+                    self.incomingStreams[pushPullID] = stream
+                    stream[2] = stream[2] + credit
+                    self.creditOutstanding = self.creditOutstanding + credit
+                    grants.append((stream[0], stream[1], pushPullID, credit))
+        for sender, sessionID, pushPullID, credit in grants:
+            # CREDIT message : ("CREDIT", pushPullID, records)
+            self.send(sender, sessionID, ("CREDIT", pushPullID, credit))
+
+    def sendMerkleLevel(self, receiver, sessionID, request):
+        """
+        Compares one level of the remote Merkle tree of a pull with the local one. Asks for
+        the children of the buckets which differ, or once the leaves are reached or most
+        buckets differ, sends the records they hold along with the changes.
+        """
+        pullID, filter, receivedFSIC, depth, level, hashes = request[1:]
+        if level == 0:
+            localFSIC = self.calcFSIC(filter)
+            tree = self.buildMerkleTree(filter, depth)
+            receivedFSIC = asVersionVector(receivedFSIC)
+            self.merkleRequests[pullID] = (sessionID, tree, receivedFSIC,
+                                           self.calcDiffChanges(localFSIC, receivedFSIC), [0])
+        sessionID, tree, receivedFSIC, changes, candidates = self.merkleRequests[pullID]
+
+        differing = tree.differingBuckets(level, candidates, hashes)
+        # Descending costs a round of hashes, which does not pay off once most buckets differ
+        if differing and level < depth and (level == 0 or 2 * len(differing) <= len(candidates)):
+            self.merkleRequests[pullID] = (sessionID, tree, receivedFSIC, changes,
+                                           sorted(tree.childHashes(level, differing)))
+            # MERKLE2 request : ("MERKLE2", pullID, level, buckets)
+            self.send(receiver, sessionID, ("MERKLE2", pullID, level, differing))
+        else:
+            del self.merkleRequests[pullID]
+            # Versions covered by the remote FSIC are already on the other device
+            with self.lock.reading(), self.phase("snapshot"):
+                # The tree only holds record IDs, the records are read again as they stand now
+                records = [self.store[recordID] for recordID in tree.bucketRecordIDs(level, differing)]
+                records = [record for record in records
+                           if not receivedFSIC.covers(record.lastSavedByInstance, record.lastSavedByCounter)]
+            if self.chunkSize:
+                # Records of the buckets which match are on the other device already, so
+                # once sorted the records sent reach checkpoints as a snapshot's do
+                records.sort(key=lambda record: (record.lastSavedByInstance, record.lastSavedByCounter))
+                self.sendChunks(receiver, sessionID, pullID, filter, changes, iter(records))
+                return
+            self.send(receiver, sessionID, ("DATA", pullID, (filter, (changes, self.packRecords(sessionID, records)))))
 
     def queue(self, pushPullID, filter, snapshot):
         """
@@ -402,51 +826,166 @@ class Node:
         """
         self.outgoingBuffer[pushPullID] = (filter, snapshot)
 
-    def createSyncSession(self, serverInstance, serverInstanceID):
+    def sendManifest(self, receiver, sessionID, pushPullID):
+        """
+        Announces the snapshot queued for pushPullID with the version of every record in it.
+        The snapshot stays in the outgoing buffer until the receiver asks for its records.
+        """
+        filter, (changes, records) = self.outgoingBuffer[pushPullID]
+        manifest = [(record.recordID, record.lastSavedByInstance, record.lastSavedByCounter) for record in records]
+        # MANIFEST message : ("MANIFEST", pushPullID, (filter, (changes, manifest)))
+        self.send(receiver, sessionID, ("MANIFEST", pushPullID, (filter, (changes, manifest))))
+
+    def missingRecords(self, manifest):
+        """
+        Returns the positions in the manifest of the versions which are neither in the store
+        nor superseded by the version in the store
+        """
+        with self.lock.reading():
+            missing = []
+            for index, (recordID, instanceID, counter) in enumerate(manifest):
+                if recordID not in self.store or \
+                        not asVersionVector(self.store[recordID].lastSavedByHistory).covers(instanceID, counter):
+                    missing.append(index)
+            return missing
+
+    def sendFetched(self, receiver, sessionID, pushPullID, indexes):
+        """
+        Sends the records of the snapshot queued for pushPullID at the given manifest
+        positions, along with its changes
+        """
+        filter, (changes, records) = self.outgoingBuffer.pop(pushPullID)
+        records = [records[index] for index in indexes]
+        self.send(receiver, sessionID, ("DATA", pushPullID, (filter, (changes, self.packRecords(sessionID, records)))))
+
+    def createSyncSession(self, serverInstance, serverInstanceID, compression=None):
         """
         Create a sync session and send ID and client's instance to server
+        compression : codec compressing record payloads in both directions, None to not compress
         """
+        checkCodec(compression)
         ID = hashlib.md5(self.instanceID.encode("utf-8")).hexdigest() + hashlib.md5(serverInstanceID.encode("utf-8")).hexdigest()
-        self.sessions[ID] = SyncSession(ID, None, serverInstance)
-        serverInstance.initialHandshake(ID, self)
+        session = SyncSession(ID, None, serverInstance, compression)
+        session.localInstances = self.instances.snapshot()
+        session.peerInstances, session.peerBudget = serverInstance.initialHandshake(
+            ID, self, compression, session.localInstances, self.incomingBudget)
+        self.sessions[ID] = session
         return ID
 
-    def initialHandshake(self, ID, clientInstance):
+    def initialHandshake(self, ID, clientInstance, compression=None, clientInstances=(), clientBudget=None):
         """
         Store sync session details you have received from Client
+        clientInstances : instance table of the client
+        clientBudget    : incoming budget of the client
+        Returns the server's own instance table and incoming budget
         """
-        self.sessions[ID] = SyncSession(ID, clientInstance, None)
+        session = SyncSession(ID, clientInstance, None, compression)
+        session.localInstances = self.instances.snapshot()
+        session.peerInstances = list(clientInstances)
+        session.peerBudget = clientBudget
+        self.sessions[ID] = session
+        return (session.localInstances, self.incomingBudget)
+
+    def packRecords(self, sessionID, records):
+        """
+        Compresses the payloads of records about to be sent if the session asks for it
+        """
+        session = self.sessions[sessionID]
+        if session.compression is None:
+            return records
+        return compressRecords(records, session.compression, session.compressionThreshold)
+
+    def unpackRecords(self, records):
+        """
+        Restores records received in compressed form
+        """
+        if isinstance(records, CompressedRecords):
+            return decompressRecords(records)
+        return records
 
     def serviceRequests(self):
         """
         Services the ongoing requests in sessions object
         """
-        for k in self.sessions:
-            request = self.sessions[k].ongoingRequest
-            client = self.sessions[k].clientInstance
-
-            if request and request[0] == "PULL":
-                filter, snapshot = self.fsicDiffAndSnapshot(request[2], request[3])
-                self.queue(request[1], filter, snapshot)
-                self.send(client, k, ("DATA", request[1], self.outgoingBuffer[request[1]]))
-                del self.outgoingBuffer[request[1]]
-                self.sessions[k].ongoingRequest = None
-
-            elif request and request[0] == "PUSH":
-                # Create a copy of your FSIC and sends it to client
-                localFSIC = self.calcFSIC(request[2])
-                # PUSH2 request : ("PUSH2", pushID, filter, localFSIC)
-                self.send(client, k, ("PUSH2", request[1], request[2], localFSIC))
-                self.sessions[k].ongoingRequest = None
-
-            elif request and request[0] == "PUSH2":
-                filter, snapshot = self.fsicDiffAndSnapshot(request[2], request[3])
-                self.queue(request[1], filter, snapshot)
-                self.send(self.sessions[k].serverInstance, k, ("DATA", request[1], self.outgoingBuffer[request[1]]))
-                self.sessions[k].ongoingRequest = None
-
-            elif request:
-                raise ValueError('Invalid Request!')
+        for k in list(self.sessions):
+            self.serviceRequest(k)
+
+    def serviceRequest(self, k):
+        """
+        Services the ongoing request of session k. Requests of different sessions can be
+        serviced from different threads at once.
+        """
+        request = self.sessions[k].ongoingRequest
+        client = self.sessions[k].clientInstance
+
+        # Snapshots for a device with an incoming budget are always streamed
+        streamed = self.chunkSize or self.sessions[k].peerBudget is not None
+
+        if request and request[0] == "PULL" and streamed:
+            self.sendSnapshot(client, k, request[1], request[2], request[3])
+            self.sessions[k].ongoingRequest = None
+
+        elif request and request[0] == "PULL" and self.manifestMode:
+            self.queue(request[1], *self.fsicDiffAndSnapshot(request[2], request[3]))
+            self.sendManifest(client, k, request[1])
+            self.sessions[k].ongoingRequest = None
+
+        elif request and request[0] == "PULL":
+            filter, (changes, records) = self.fsicDiffAndSnapshot(request[2], request[3])
+            self.queue(request[1], filter, (changes, self.packRecords(k, records)))
+            self.send(client, k, ("DATA", request[1], self.outgoingBuffer[request[1]]))
+            del self.outgoingBuffer[request[1]]
+            self.sessions[k].ongoingRequest = None
+
+        elif request and (request[0] == "MERKLE" and self.sessions[k].peerBudget is not None or
+                          request[0] == "SYNC" and (self.sessions[k].peerBudget is not None or
+                                                    self.incomingBudget is not None)):
+            # Their replies are not streamed under credit : devices with a budget pull and push instead
+            raise ValueError(request[0] + ' request in a session with an incoming budget')
+
+        elif request and request[0] == "MERKLE":
+            self.sendMerkleLevel(client, k, request)
+            self.sessions[k].ongoingRequest = None
+
+        elif request and request[0] == "SYNC" and self.chunkSize:
+            self.sendSnapshot(client, k, request[1], request[2], request[3], sync=True)
+            self.sessions[k].ongoingRequest = None
+
+        elif request and request[0] == "SYNC":
+            # Delta and FSIC are taken from the same state of the store
+            with self.lock.reading():
+                filter, (changes, records) = self.fsicDiffAndSnapshot(request[2], request[3])
+                localFSIC = self.calcFSIC(filter)
+            # SYNCDATA response : ("SYNCDATA", syncID, (filter, (changes, records)), localFSIC)
+            self.send(client, k, ("SYNCDATA", request[1], (filter, (changes, self.packRecords(k, records))), localFSIC))
+            self.sessions[k].ongoingRequest = None
+
+        elif request and request[0] == "PUSH":
+            # Create a copy of your FSIC and sends it to client
+            localFSIC = self.calcFSIC(request[2])
+            # PUSH2 request : ("PUSH2", pushID, filter, localFSIC)
+            self.send(client, k, ("PUSH2", request[1], request[2], localFSIC))
+            self.sessions[k].startTransfer(request[1], request[2])
+            self.sessions[k].ongoingRequest = None
+            self.expectStream(client, k, request[1])
+
+        elif request and request[0] == "PUSH2" and streamed:
+            self.sendSnapshot(self.sessions[k].serverInstance, k, request[1], request[2], request[3])
+            self.sessions[k].ongoingRequest = None
+
+        elif request and request[0] == "PUSH2" and self.manifestMode:
+            self.queue(request[1], *self.fsicDiffAndSnapshot(request[2], request[3]))
+            self.sendManifest(self.sessions[k].serverInstance, k, request[1])
+            self.sessions[k].ongoingRequest = None
+
+        elif request and request[0] == "PUSH2":
+            filter, (changes, records) = self.fsicDiffAndSnapshot(request[2], request[3])
+            self.queue(request[1], filter, (changes, self.packRecords(k, records)))
+            self.send(self.sessions[k].serverInstance, k, ("DATA", request[1], self.outgoingBuffer[request[1]]))
+            self.sessions[k].ongoingRequest = None
+
+        elif request:
+            raise ValueError('Invalid Request!')
 
     def pullInitiation(self, syncSessID, filter):
         """
@@ -459,8 +998,30 @@ class Node:
         syncSessObj.incrementCounter()
         # Step 2 : Client calculates its FSIC locally
         localFSIC = self.calcFSIC(filter)
+        # The records of a Merkle pull are not streamed under credit
+        if self.merkleDepth is not None and self.incomingBudget is None:
+            # Anti-entropy : the server walks down the Merkle tree of the filter's records from the root
+            tree = self.buildMerkleTree(filter, self.merkleDepth)
+            self.merkleRequests[pullID] = (syncSessID, tree, filter)
+            # MERKLE request : ("MERKLE", pullID, filter, FSIC, depth, level, hashes)
+            self.send(syncSessObj.serverInstance, syncSessID,
+                      ("MERKLE", pullID, filter, localFSIC, tree.depth, 0, tree.levels[0]))
+            return
         # Step 3 : Client sends pullID, filter and its FSIC to server
+        syncSessObj.startTransfer(pullID, filter)
         self.send(syncSessObj.serverInstance, syncSessID, ("PULL", pullID, filter, localFSIC))
+        self.expectStream(syncSessObj.serverInstance, syncSessID, pullID)
+
+    def resumePull(self, syncSessID, pullID):
+        """
+        Asks again for a pull cut off mid-stream, under the same pullID. The FSIC already
+        stands at the checkpoint of the last integrated chunk, so integrated chunks are not sent again.
+        A pull cut before its first chunk starts over.
+        """
+        syncSessObj = self.sessions[syncSessID]
+        filter = syncSessObj.checkpoints[pullID][0]
+        self.send(syncSessObj.serverInstance, syncSessID, ("PULL", pullID, filter, self.calcFSIC(filter)))
+        self.expectStream(syncSessObj.serverInstance, syncSessID, pullID)
 
     def pushInitiation(self, syncSessID, filter):
         """
@@ -474,29 +1035,115 @@ class Node:
         # Step 3 : Client sends pushID and filter to server
         self.send(syncSessObj.serverInstance, syncSessID, ("PUSH", pushID, filter))
 
+    def syncInitiation(self, syncSessID, filter):
+        """
+        Pull and push in one round trip : the server answers with its delta and its FSIC,
+        then the client sends the records the server is missing. Replies to a sync request
+        are not streamed under credit, so devices with an incoming budget pull and push instead.
+        """
+        syncSessObj = self.sessions[syncSessID]
+        if self.incomingBudget is not None or syncSessObj.peerBudget is not None:
+            self.pullInitiation(syncSessID, filter)
+            self.pushInitiation(syncSessID, filter)
+            return
+        syncID = str(syncSessObj.syncSessID) + "_" + str(syncSessObj.requestCounter)
+        syncSessObj.incrementCounter()
+        syncSessObj.startTransfer(syncID, filter)
+        # SYNC request : ("SYNC", syncID, filter, localFSIC)
+        self.send(syncSessObj.serverInstance, syncSessID, ("SYNC", syncID, filter, self.calcFSIC(filter)))
+
     def send(self, receiver, sessionID, data):
         """
         The only API through which a device communicates with another device
         """
-        receiver.receive(self, sessionID, data)
+        if self.metrics is not None:
+            self.metrics.sent(self, sessionID, data)
+        if self.transport is not None:
+            self.transport.send(self, receiver, sessionID, data)
+        else:
+            receiver.receive(self, sessionID, data)
 
     def receive(self, sender, sessionID, data):
         """
         Action to be taken once data arrives on a device
         """
-        if data[0] == "PULL" or data[0] == "PUSH" or data[0] == "PUSH2":
+        if self.metrics is None:
+            self.handleMessage(sender, sessionID, data)
+            return
+        # Figures reported while handling the message go to its session
+        self.metrics.received(self, sessionID, data)
+        self.metrics.enter(self, sessionID)
+        try:
+            self.handleMessage(sender, sessionID, data)
+        finally:
+            self.metrics.leave(self)
+
+    def handleMessage(self, sender, sessionID, data):
+        """
+        Handles a message according to its type
+        """
+        if data[0] in ("PULL", "PUSH", "PUSH2", "MERKLE", "SYNC"):
             self.sessions[sessionID].ongoingRequest = data
-            self.serviceRequests()
+            self.serviceRequest(sessionID)
+
+        elif data[0] == "MERKLE2":
+            # The server asks for the hashes of the children of buckets which differ
+            pullID, level, buckets = data[1:]
+            tree, filter = self.merkleRequests[pullID][1:]
+            self.send(sender, sessionID, ("MERKLE", pullID, filter, {}, tree.depth, level + 1,
+                                          tree.childHashes(level, buckets)))
+
+        elif data[0] == "MANIFEST":
+            # FETCH request : ("FETCH", pushPullID, positions of the missing records in the manifest)
+            self.send(sender, sessionID, ("FETCH", data[1], self.missingRecords(data[2][1][1])))
+
+        elif data[0] == "FETCH":
+            self.sendFetched(sender, sessionID, data[1], data[2])
 
         elif data[0] == "DATA":
-            self.incomingBuffer[data[1]] = data[2]
-            self.integrate()
+            self.merkleRequests.pop(data[1], None)
+            self.sessions[sessionID].checkpoints.pop(data[1], None)
+            filter, (changes, records) = data[2]
+            records = self.unpackRecords(records)
+            with self.lock.writing():
+                self.incomingBuffer[data[1]] = (filter, (changes, records))
+                self.integrate()
+            self.streamReceived(data[1], len(records), True)
+
+        elif data[0] == "SYNCDATA":
+            # The server's delta is integrated before the client works out its own
+            self.sessions[sessionID].checkpoints.pop(data[1], None)
+            filter, (changes, records) = data[2]
+            records = self.unpackRecords(records)
+            with self.lock.writing():
+                self.incomingBuffer[data[1]] = (filter, (changes, records))
+                self.integrate()
+            if self.chunkSize:
+                self.sendSnapshot(sender, sessionID, data[1], filter, data[3])
+                return
+            filter, (changes, records) = self.fsicDiffAndSnapshot(filter, data[3])
+            self.send(sender, sessionID, ("DATA", data[1], (filter, (changes, self.packRecords(sessionID, records)))))
+
+        elif data[0] == "CHUNK":
+            # Part of a streamed snapshot : ("CHUNK", pushPullID, (filter, records), checkpoint)
+            filter, records = data[2]
+            records = self.unpackRecords(records)
+            with self.lock.writing():
+                # The FSIC advances to the checkpoint along with the chunk's records, never backwards
+                changes = self.calcDiffChanges(data[3], self.syncDataStructure.get(filter[0] + "+" + filter[1], {}))
+                self.incomingBuffer[data[1]] = (filter, (changes, records))
+                self.integrate()
+            self.sessions[sessionID].recordCheckpoint(data[1], filter, data[3])
+            self.streamReceived(data[1], len(records), False)
+
+        elif data[0] == "CREDIT":
+            self.addCredit(data[1], data[2])
 
     def printNode(self):
         """
         Pretty-printing all the variable values residing in Node object
         """
-        print("Instance ID :" + str(self.instanceID))
+        print("Instance ID :" + self.instanceID)
         print("Counter value :" + str(self.counter))
         print("appData :")
         for i in range(0, len(self.appData)):
@@ -0,0 +1,353 @@
+"""
+Storage backends holding the store of a Node. Both engines support the read side
+of a dict keyed by recordID (lookup, membership, len, iteration, items and values)
+and the operations Node needs on top of it : adding and editing records, range
+queries by instance/counter within a partition, FSIC persistence and batched
+transactions.
+"""
+from __future__ import print_function, unicode_literals
+
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+
+import json
+import sqlite3
+
+from storeRecord import StoreRecord
+
+
+def checkPartitionFilter(partitionFacility, partitionUser):
+    """
+    A user can only be filtered on within a facility
+    """
+    if not partitionFacility and partitionUser:
+        raise ValueError("Facility ALL but User not ALL")
+
+
+class MemoryStoreEngine(object):
+    """
+    Keeps the store in a dict, with a counter index kept up to date on every write.
+    The syncDataStructure of the Node is not persisted. Stored records are never changed
+    once written, edits replace them.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.records = {}
+        # Inside a transaction, maps recordID to the record it replaced, None if there was none
+        self.undo = None
+        # Maps instanceID -> partitionFacility -> partitionUser to a list of
+        # (lastSavedByCounter, recordID) of store records, sorted by counter
+        self.counterIndex = {}
+
+    def __getitem__(self, recordID):
+        return self.records[recordID]
+
+    def __contains__(self, recordID):
+        return recordID in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def keys(self):
+        return self.records.keys()
+
+    def values(self):
+        return self.records.values()
+
+    def items(self):
+        return self.records.items()
+
+    def counterIndexEntries(self, record):
+        """
+        Returns the sorted (lastSavedByCounter, recordID) list holding the record's
+        instance and partition, creating it if needed
+        """
+        facilities = self.counterIndex.setdefault(record.lastSavedByInstance, {})
+        users = facilities.setdefault(record.partitionFacility, {})
+        return users.setdefault(record.partitionUser, [])
+
+    def indexRecord(self, record):
+        """
+        Adds a store record to the counter index
+        """
+        insort(self.counterIndexEntries(record), (record.lastSavedByCounter, record.recordID))
+
+    def unindexRecord(self, record):
+        """
+        Removes a store record from the counter index
+        """
+        entries = self.counterIndexEntries(record)
+        del entries[bisect_left(entries, (record.lastSavedByCounter, record.recordID))]
+
+    def addRecord(self, record):
+        """
+        Puts a record in the store, replacing any record with the same ID
+        """
+        if self.undo is not None and record.recordID not in self.undo:
+            self.undo[record.recordID] = self.records.get(record.recordID)
+        if record.recordID in self.records:
+            self.unindexRecord(self.records[record.recordID])
+        self.records[record.recordID] = record
+        self.indexRecord(record)
+
+    def editRecord(self, recordID, recordData, instanceID, counter, history):
+        """
+        Records a new version of an existing record. The previous version is replaced rather
+        than changed, so records handed out by earlier reads keep the version they were read at.
+        """
+        record = self.records[recordID]
+        if self.undo is not None and recordID not in self.undo:
+            self.undo[recordID] = record
+        self.unindexRecord(record)
+        record = StoreRecord(recordID, recordData, instanceID, counter, history, record.partitionFacility,
+                             record.partitionUser)
+        self.records[recordID] = record
+        self.indexRecord(record)
+
+    def rangeQuery(self, instanceID, counterLow, counterHigh, partitionFacility, partitionUser):
+        """
+        Returns records last saved by instanceID with counter between counterLow and counterHigh
+        (both inclusive) which fall under the given partition, ordered by counter
+        """
+        checkPartitionFilter(partitionFacility, partitionUser)
+
+        facilities = self.counterIndex.get(instanceID, {})
+        # Only visit the partitions covered by the filter
+        if not partitionFacility:
+            partitions = [entries for users in facilities.values() for entries in users.values()]
+        elif not partitionUser:
+            partitions = list(facilities.get(partitionFacility, {}).values())
+        else:
+            partitions = [facilities.get(partitionFacility, {}).get(partitionUser, [])]
+
+        found = []
+        for entries in partitions:
+            low = bisect_left(entries, (counterLow,))
+            high = bisect_left(entries, (counterHigh + 1,))
+            found.extend(entries[low:high])
+        # Each partition is already sorted, so this only merges the runs
+        if len(partitions) > 1:
+            found.sort()
+        return [self.records[recordID] for counter, recordID in found]
+
+    def partitionQuery(self, partitionFacility, partitionUser):
+        """
+        Returns every record which falls under the given partition, whoever saved it
+        """
+        records = []
+        for instanceID in self.counterIndex:
+            records.extend(self.rangeQuery(instanceID, 0, float("inf"), partitionFacility, partitionUser))
+        return records
+
+    def readSyncDataStructure(self):
+        """
+        Nothing is persisted, a new Node starts from scratch
+        """
+        return {}
+
+    def writeFSIC(self, filter, fsic):
+        """
+        The in-memory syncDataStructure of the Node is the only copy
+        """
+        pass
+
+    @contextmanager
+    def transaction(self):
+        """
+        Undoes every write inside the block if it raises, blocks can be nested
+        """
+        if self.undo is not None:
+            yield
+            return
+        self.undo = {}
+        try:
+            yield
+        except Exception:
+            for recordID, record in self.undo.items():
+                self.unindexRecord(self.records.pop(recordID))
+                if record is not None:
+                    self.records[recordID] = record
+                    self.indexRecord(record)
+            raise
+        finally:
+            self.undo = None
+
+    def close(self):
+        pass
+
+
+class SQLiteStoreEngine(object):
+    """
+    Keeps the store and the syncDataStructure in a SQLite database in WAL mode, so that a
+    Node survives restarts and can hold more records than fit in memory. Records read from
+    the engine are fresh objects : changes must go through addRecord or editRecord.
+    Iteration reads rows from the database as it goes, the store must not be written
+    to before it is done. Range and partition queries read their records page by page
+    and can be interleaved with writes.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS records ("
+        "recordID TEXT PRIMARY KEY, recordData TEXT, lastSavedByInstance TEXT NOT NULL, "
+        "lastSavedByCounter INTEGER NOT NULL, lastSavedByHistory TEXT NOT NULL, "
+        "partitionFacility TEXT, partitionUser TEXT)",
+        # Range queries of full replication
+        "CREATE INDEX IF NOT EXISTS recordsByCounter ON records (lastSavedByInstance, lastSavedByCounter)",
+        # Range queries of facility and facility+user filters
+        "CREATE INDEX IF NOT EXISTS recordsByPartition "
+        "ON records (lastSavedByInstance, partitionFacility, partitionUser, lastSavedByCounter)",
+        "CREATE TABLE IF NOT EXISTS fsic ("
+        "filter TEXT NOT NULL, instanceID TEXT NOT NULL, counter INTEGER NOT NULL, PRIMARY KEY (filter, instanceID))",
+    ]
+    COLUMNS = "recordID, recordData, lastSavedByInstance, lastSavedByCounter, lastSavedByHistory, " \
+              "partitionFacility, partitionUser"
+    # Rows read by each query of the range and partition queries
+    PAGE_SIZE = 500
+
+    def __init__(self, path=":memory:"):
+        """
+        Constructor
+        """
+        # Transactions are managed explicitly by transaction()
+        # Shared by the threads using the Node, whose lock keeps writes exclusive
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+        # Depth of nested transaction() blocks
+        self.transactionDepth = 0
+
+    def toRecord(self, row):
+        return StoreRecord(row[0], row[1], row[2], row[3], json.loads(row[4]), row[5], row[6])
+
+    def __getitem__(self, recordID):
+        row = self.connection.execute("SELECT " + self.COLUMNS + " FROM records WHERE recordID = ?",
+                                      (recordID,)).fetchone()
+        if row is None:
+            raise KeyError(recordID)
+        return self.toRecord(row)
+
+    def __contains__(self, recordID):
+        return self.connection.execute("SELECT 1 FROM records WHERE recordID = ?", (recordID,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def __iter__(self):
+        return (row[0] for row in self.connection.execute("SELECT recordID FROM records"))
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (self.toRecord(row) for row in self.connection.execute("SELECT " + self.COLUMNS + " FROM records"))
+
+    def items(self):
+        return ((record.recordID, record) for record in self.values())
+
+    def addRecord(self, record):
+        """
+        Puts a record in the store, replacing any record with the same ID
+        """
+        self.connection.execute("INSERT OR REPLACE INTO records (" + self.COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (record.recordID, record.recordData, record.lastSavedByInstance,
+                                 record.lastSavedByCounter, json.dumps(record.lastSavedByHistory),
+                                 record.partitionFacility, record.partitionUser))
+
+    def editRecord(self, recordID, recordData, instanceID, counter, history):
+        """
+        Records a new version of an existing record
+        """
+        self.connection.execute("UPDATE records SET recordData = ?, lastSavedByInstance = ?, lastSavedByCounter = ?, "
+                                "lastSavedByHistory = ? WHERE recordID = ?",
+                                (recordData, instanceID, counter, json.dumps(history), recordID))
+
+    def pages(self, conditions, parameters, column, start):
+        """
+        Yields the records meeting every condition ordered by column, whose values are unique,
+        from the first one above start. They are read PAGE_SIZE rows at a time, each page by a
+        query of its own, so the store can be written to between two records.
+        """
+        query = "SELECT " + self.COLUMNS + " FROM records WHERE " + " AND ".join(conditions + [column + " > ?"]) + \
+                " ORDER BY " + column + " LIMIT ?"
+        while True:
+            rows = self.connection.execute(query, parameters + [start, self.PAGE_SIZE]).fetchall()
+            for row in rows:
+                record = self.toRecord(row)
+                yield record
+            if len(rows) < self.PAGE_SIZE:
+                return
+            start = getattr(record, column)
+
+    def partitionConditions(self, partitionFacility, partitionUser):
+        checkPartitionFilter(partitionFacility, partitionUser)
+        conditions, parameters = [], []
+        if partitionFacility:
+            conditions.append("partitionFacility = ?")
+            parameters.append(partitionFacility)
+            if partitionUser:
+                conditions.append("partitionUser = ?")
+                parameters.append(partitionUser)
+        return conditions, parameters
+
+    def rangeQuery(self, instanceID, counterLow, counterHigh, partitionFacility, partitionUser):
+        """
+        Returns an iterator over the records last saved by instanceID with counter between
+        counterLow and counterHigh (both inclusive) which fall under the given partition,
+        ordered by counter
+        """
+        conditions, parameters = self.partitionConditions(partitionFacility, partitionUser)
+        conditions = ["lastSavedByInstance = ?"] + conditions + ["lastSavedByCounter <= ?"]
+        parameters = [instanceID] + parameters + [counterHigh]
+        return self.pages(conditions, parameters, "lastSavedByCounter", counterLow - 1)
+
+    def partitionQuery(self, partitionFacility, partitionUser):
+        """
+        Returns an iterator over every record which falls under the given partition, whoever saved it
+        """
+        conditions, parameters = self.partitionConditions(partitionFacility, partitionUser)
+        return self.pages(conditions, parameters, "recordID", "")
+
+    def readSyncDataStructure(self):
+        """
+        Returns the persisted syncDataStructure
+        """
+        syncDataStructure = {}
+        for filter, instanceID, counter in self.connection.execute("SELECT filter, instanceID, counter FROM fsic"):
+            syncDataStructure.setdefault(filter, {})[instanceID] = counter
+        return syncDataStructure
+
+    def writeFSIC(self, filter, fsic):
+        """
+        Persists the given entries of a syncDataStructure filter
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO fsic (filter, instanceID, counter) VALUES (?, ?, ?)",
+                                    [(filter, instanceID, counter) for instanceID, counter in fsic.items()])
+
+    @contextmanager
+    def transaction(self):
+        """
+        Batches every write inside the block into a single transaction, blocks can be nested
+        """
+        if self.transactionDepth == 0:
+            self.connection.execute("BEGIN")
+        self.transactionDepth = self.transactionDepth + 1
+        try:
+            yield
+        except Exception:
+            self.transactionDepth = self.transactionDepth - 1
+            if self.transactionDepth == 0:
+                self.connection.execute("ROLLBACK")
+            raise
+        self.transactionDepth = self.transactionDepth - 1
+        if self.transactionDepth == 0:
+            self.connection.execute("COMMIT")
+
+    def close(self):
+        self.connection.close()
@@ -1,19 +1,41 @@
 from __future__ import print_function, unicode_literals
 
-class StoreRecord:
-    # Record Unique ID
-    recordID = None
-    # Serialized Record Data
-    recordData = None
-    # Last morango Instance's ID which saved/modified the record
-    lastSavedByInstance = None
-    # Last morango Instance's counter position which saved/modified the record
-    lastSavedByCounter = None
-    # List of unique instance ID, counter(highest) pairs which have modified this record in past
-    lastSavedByHistory = None
-    # Partition information for this record
-    partitionFacility = None
-    partitionUser = None
+from versionVector import VersionVector
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern as a builtin
+    pass
+
+
+def internString(value):
+    """
+    Returns the interned copy of a string so that records share instance IDs and partition
+    names instead of each holding their own copy. Other values are returned unchanged.
+    """
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+class StoreRecord(object):
+    # Records are held in the millions, so they carry no per-instance __dict__
+    __slots__ = (
+        # Record Unique ID
+        "recordID",
+        # Serialized Record Data
+        "recordData",
+        # Last morango Instance's ID which saved/modified the record
+        "lastSavedByInstance",
+        # Last morango Instance's counter position which saved/modified the record
+        "lastSavedByCounter",
+        # VersionVector of unique instance ID, counter(highest) pairs which have modified this record in past
+        "lastSavedByHistory",
+        # Partition information for this record
+        "partitionFacility",
+        "partitionUser",
+    )
 
     def __init__(self, recordID, recordData, lastSavedByInstance, lastSavedByCounter, lastSavedByHistory,
                  partitionFacility, partitionUser):
@@ -24,11 +46,22 @@ class StoreRecord:
             raise ValueError('Length of recordID should be greater than 0')
         self.recordID = recordID
         self.recordData = recordData
-        self.lastSavedByInstance = lastSavedByInstance
+        self.lastSavedByInstance = internString(lastSavedByInstance)
         self.lastSavedByCounter = lastSavedByCounter
+        if lastSavedByHistory is not None and not isinstance(lastSavedByHistory, VersionVector):
+            lastSavedByHistory = VersionVector(lastSavedByHistory)
         self.lastSavedByHistory = lastSavedByHistory
-        self.partitionFacility = partitionFacility
-        self.partitionUser = partitionUser
+        self.partitionFacility = internString(partitionFacility)
+        self.partitionUser = internString(partitionUser)
+
+    def copy(self):
+        """
+        Returns a copy of the record which shares nothing mutable with it
+        """
+        history = self.lastSavedByHistory
+        return StoreRecord(self.recordID, self.recordData, self.lastSavedByInstance, self.lastSavedByCounter,
+                           history.copy() if history is not None else None, self.partitionFacility,
+                           self.partitionUser)
 
     def updateRecord(self, serializedData, instanceID, counter):
         """
@@ -0,0 +1,182 @@
+"""
+Instrumentation of the sync phases of a Node.
+
+A Node reports to the object set as its metrics attribute, None by default, in which
+case reporting costs an attribute check. Any object with the methods of SyncMetrics can
+be plugged in, to forward the figures to a monitoring system for instance.
+
+Phases timed :
+    fsic       computing an FSIC which was not cached
+    snapshot   reading from the store the records to send
+    integrate  integrating received records, conflict resolution included
+    serialize  saving dirty application records to the store
+    transfer   time a message waited for its receiver, reported by transports which queue them
+
+Counters :
+    messagesSent, recordsSent, bytesSent, messagesReceived, recordsReceived,
+    recordsScanned, recordsIntegrated, conflicts, historyMerges, copies
+
+Phases can nest : an FSIC computed for a snapshot counts in both phases.
+"""
+from __future__ import print_function, unicode_literals
+
+import threading
+import timeit
+
+from wireFormat import messageRecords
+
+
+class PhaseTimer(object):
+    """
+    Context manager reporting the time spent in a phase
+    """
+
+    def __init__(self, node, phase):
+        self.node = node
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.node.metrics.time(self.node, None, self.phase, timeit.default_timer() - self.start)
+        return False
+
+
+class NoPhase(object):
+    """
+    Context manager standing in for PhaseTimer when a node has no metrics
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+NO_PHASE = NoPhase()
+
+
+class PhaseMetrics(object):
+    """
+    Counters and seconds spent per phase, for a node or one of its sync sessions
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.seconds = {}
+
+    def count(self, name, amount):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def time(self, phase, seconds):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+    def asDict(self):
+        return {"counters": dict(self.counters), "seconds": dict(self.seconds)}
+
+
+class SyncMetrics(object):
+    """
+    Collects the figures reported by the nodes it is set on, per node and per sync session.
+    The figures of a session are also kept on the SyncSession, as its metrics attribute.
+    Figures reported while a node handles a message go to the session of the message,
+    the others only to the node.
+    """
+
+    def __init__(self, countBytes=False):
+        """
+        Constructor
+        countBytes : also encode every message sent to count its bytes in the wire format
+        """
+        self.countBytes = countBytes
+        self.lock = threading.Lock()
+        # Node -> PhaseMetrics of the node
+        self.nodes = {}
+        # (node, sessionID) -> wire encoder counting the bytes of the session
+        self.encoders = {}
+        # Per thread, node -> stack of the sessions whose messages it is handling
+        self.handling = threading.local()
+
+    def attach(self, *nodes):
+        for node in nodes:
+            node.metrics = self
+
+    def currentSession(self, node):
+        stack = self.handling.__dict__.get("sessions", {}).get(node)
+        return stack[-1] if stack else None
+
+    def enter(self, node, sessionID):
+        """
+        node starts handling a message of sessionID
+        """
+        self.handling.__dict__.setdefault("sessions", {}).setdefault(node, []).append(sessionID)
+
+    def leave(self, node):
+        self.handling.sessions[node].pop()
+
+    def targets(self, node, sessionID):
+        """
+        PhaseMetrics the figures of node for sessionID go to, must be called with the lock held
+        """
+        if node not in self.nodes:
+            self.nodes[node] = PhaseMetrics()
+        targets = [self.nodes[node]]
+        if sessionID is None:
+            sessionID = self.currentSession(node)
+        session = node.sessions.get(sessionID) if sessionID is not None else None
+        if session is not None:
+            if session.metrics is None:
+                session.metrics = PhaseMetrics()
+            targets.append(session.metrics)
+        return targets
+
+    def count(self, node, sessionID, name, amount):
+        with self.lock:
+            for target in self.targets(node, sessionID):
+                target.count(name, amount)
+
+    def time(self, node, sessionID, phase, seconds):
+        with self.lock:
+            for target in self.targets(node, sessionID):
+                target.time(phase, seconds)
+
+    def sent(self, node, sessionID, message):
+        """
+        node sends message in sessionID
+        """
+        with self.lock:
+            byteCount = 0
+            if self.countBytes:
+                key = (node, sessionID)
+                if key not in self.encoders:
+                    self.encoders[key] = node.sessions[sessionID].createWireEncoder()
+                byteCount = len(self.encoders[key].encode(message))
+            for target in self.targets(node, sessionID):
+                target.count("messagesSent", 1)
+                target.count("recordsSent", messageRecords(message))
+                if self.countBytes:
+                    target.count("bytesSent", byteCount)
+
+    def received(self, node, sessionID, message):
+        """
+        node receives message in sessionID
+        """
+        with self.lock:
+            for target in self.targets(node, sessionID):
+                target.count("messagesReceived", 1)
+                target.count("recordsReceived", messageRecords(message))
+
+    def export(self):
+        """
+        Plain dict of every figure collected, keyed by node instance ID, then "total" or "sessions"
+        """
+        with self.lock:
+            exported = {}
+            for node, metrics in self.nodes.items():
+                sessions = dict((sessionID, session.metrics.asDict()) for sessionID, session in node.sessions.items()
+                                if session.metrics is not None)
+                exported[node.instanceID] = {"total": metrics.asDict(), "sessions": sessions}
+            return exported
@@ -1,5 +1,8 @@
 from __future__ import print_function, unicode_literals
 
+from versionVector import VersionVector
+from wireFormat import WireDecoder, WireEncoder
+
 class SyncSession:
     # Sync Session ID
     syncSessID = None
@@ -11,8 +14,23 @@ class SyncSession:
     requestCounter = None
     # Ongoing request
     ongoingRequest = None
+    # Codec compressing record payloads sent in this session, None sends them as they are
+    compression = None
+    # Record payloads smaller than this many bytes are never compressed
+    compressionThreshold = None
+    # Instance tables exchanged at handshake : IDs known to this device and to the other one
+    localInstances = None
+    peerInstances = None
+    # Snapshots asked for in this session and not finished yet : pushPullID -> (filter,
+    # checkpoint of the last integrated chunk or None before the first one, chunks integrated)
+    checkpoints = None
+    # Records the other device accepts in flight at once, None when it does not limit them.
+    # Snapshots sent to a device with a budget only go as far as the credit it grants.
+    peerBudget = None
+    # Figures of this session collected by the node's metrics, None until it reports any
+    metrics = None
 
-    def __init__(self, syncSessID, clientInstance, serverInstance):
+    def __init__(self, syncSessID, clientInstance, serverInstance, compression=None, compressionThreshold=256):
         """
         Constructor
         """
@@ -21,6 +39,43 @@ class SyncSession:
         self.serverInstance = serverInstance
         self.requestCounter = 0
         self.ongoingRequest = None
+        self.compression = compression
+        self.compressionThreshold = compressionThreshold
+        self.localInstances = []
+        self.peerInstances = []
+        self.checkpoints = {}
+        self.peerBudget = None
+        self.metrics = None
+
+    def createWireEncoder(self):
+        """
+        Encoder for messages sent in this session. Instance IDs the other device received at
+        handshake are sent as integers from the first frame.
+        """
+        return WireEncoder(self.localInstances)
+
+    def createWireDecoder(self):
+        """
+        Decoder for messages received in this session
+        """
+        return WireDecoder(self.peerInstances)
+
+    def startTransfer(self, pushPullID, filter):
+        """
+        The snapshot of pushPullID has been asked for, it can be resumed before any chunk of it
+        arrives. It supersedes the snapshots of the same filter cut off before, which it resumes
+        from their checkpoints.
+        """
+        for other in [other for other, checkpoint in self.checkpoints.items() if checkpoint[0] == filter]:
+            del self.checkpoints[other]
+        self.checkpoints[pushPullID] = (filter, None, 0)
+
+    def recordCheckpoint(self, pushPullID, filter, checkpoint):
+        """
+        A chunk of the snapshot of pushPullID has been integrated
+        """
+        chunks = self.checkpoints.get(pushPullID, (None, None, 0))[2]
+        self.checkpoints[pushPullID] = (filter, checkpoint, chunks + 1)
 
     def incrementCounter(self):
         """
@@ -51,3 +106,25 @@ class SyncSession:
         "Counter : " + str(self.requestCounter)
         print
         "Ongoing Request :" + str(self.ongoingRequest)
+
+
+class SnapshotStream:
+    """
+    Snapshot being streamed to a device which grants credit for it
+    """
+
+    def __init__(self, receiver, sessionID, filter, changes, records):
+        """
+        Constructor
+        records : iterator over the records left to send
+        """
+        self.receiver = receiver
+        self.sessionID = sessionID
+        self.filter = filter
+        self.changes = changes
+        self.records = records
+        self.checkpoint = VersionVector()
+        # Records which may still be sent
+        self.credit = 0
+        # Set while a thread is sending, credit arriving meanwhile is used by that thread
+        self.sending = False
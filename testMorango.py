@@ -1,12 +1,69 @@
 from __future__ import print_function, unicode_literals
 
+import asyncio
+import json
+import os
 import random
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
-
+from copy import deepcopy
+
+from asyncTransport import AsyncTransport
+from benchmarkSuite import BENCHMARKS, compareResults, readResults, runSuite, sweepScenarios
+from experimentRunner import runExperiment
+from gossipScheduler import GossipScheduler
+from instanceTable import InstanceTable
+from networkSimulator import Link, NetworkSimulator
+from payloadCompression import CODECS, compressRecords, decompressRecords
+from readWriteLock import ReadWriteLock
 from simulateNode import Node
+from storeEngine import SQLiteStoreEngine
 from storeRecord import StoreRecord
+from syncMetrics import SyncMetrics
 from syncSession import SyncSession
+from trafficTrace import TraceRecorder, replayTrace
+from topology import addAppRecordDiff, addAppRecordMerge, createNodes, createRandomRange, endConditionData, \
+    endConditionMerge, eventualFullDiff, eventualFullDiffBi, eventualFullMerge, eventualStarDiff, eventualStarDiffBi, \
+    fullDBReplication, fullDBSync, sessionsRing, sessionsStar
+from versionVector import VersionVector
+from wireFormat import WireDecoder, WireEncoder, WireFormatError
+
+
+class RecordingTransport(object):
+    """
+    Delivers messages synchronously and keeps them for inspection
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, sender, receiver, sessionID, data):
+        self.messages.append(data)
+        receiver.receive(sender, sessionID, data)
+
+
+class InterruptingTransport(RecordingTransport):
+    """
+    Records messages and drops the connection once a number of CHUNK messages went through,
+    telling both nodes it was lost
+    """
+
+    def __init__(self, chunksBeforeCut):
+        RecordingTransport.__init__(self)
+        self.chunksLeft = chunksBeforeCut
+
+    def send(self, sender, receiver, sessionID, data):
+        if data[0] == "CHUNK":
+            if self.chunksLeft == 0:
+                sender.connectionLost(sessionID)
+                receiver.connectionLost(sessionID)
+                raise IOError("Connection lost")
+            self.chunksLeft = self.chunksLeft - 1
+        RecordingTransport.send(self, sender, receiver, sessionID, data)
 
 
 class Test(unittest.TestCase):
@@ -20,6 +77,17 @@ class Test(unittest.TestCase):
     def test_emptyRecordID(self):
         self.assertRaises(ValueError, lambda: StoreRecord("", "data", "A", 1, {}, "Facility1", "UserX"))
 
+    def test_storeRecordSlots(self):
+        record = StoreRecord("record1", "data", "".join(["A", "B"]), 1, {"AB": 1}, "Facility1", "UserX")
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertRaises(AttributeError, lambda: setattr(record, "extra", 1))
+        self.assertTrue(record.lastSavedByInstance is StoreRecord("record2", "", "AB", 1, {}, "", "").lastSavedByInstance)
+
+        copied = deepcopy(record)
+        self.assertEqual(copied.recordID, "record1")
+        self.assertEqual(copied.lastSavedByHistory, {"AB": 1})
+        self.assertEqual(copied.partitionUser, "UserX")
+
     def test_serialize(self):
         node = Node("A")
         # Create some application data for the node
@@ -84,6 +152,757 @@ class Test(unittest.TestCase):
         self.assertEqual(node.store["record6"].lastSavedByHistory, {"A": 6})
         self.assertEqual(node.store["record7"].lastSavedByHistory, {"A": 7})
 
+    def test_appIndex(self):
+        node = Node("A")
+        node.addAppData("record1", "Record1 data", "", "")
+        node.addAppData("record2", "Record2 data", "Facility1", "UserX")
+        node.serialize(("", ""))
+        node.addAppData("record1", "Record1 new data", "", "")
+        self.assertEqual(node.searchRecordInApp("record1"), 0)
+        self.assertEqual(node.searchRecordInApp("record2"), 1)
+        self.assertEqual(node.searchRecordInApp("record3"), -1)
+        self.assertEqual(node.appData[0][1], "Record1 new data")
+
+        # Records inflated during integration are indexed as well
+        other = Node("B")
+        other.addAppData("record3", "Record3 data", "", "")
+        other.serialize(("", ""))
+        sessionID = node.createSyncSession(other, other.instanceID)
+        node.pullInitiation(sessionID, ("", ""))
+        self.assertEqual(node.searchRecordInApp("record3"), 2)
+        for i, record in enumerate(node.appData):
+            self.assertEqual(node.searchRecordInApp(record[0]), i)
+
+    def test_dirtyRecords(self):
+        node = Node("A")
+        node.addAppData("record1", "data", "Facility1", "UserX")
+        node.addAppData("record2", "data", "Facility1", "UserY")
+        node.addAppData("record3", "data", "Facility2", "UserX")
+        self.assertEqual(node.dirtyRecords[("Facility1", "UserX")], set(["record1"]))
+
+        node.serialize(("Facility1", ""))
+        self.assertEqual(node.dirtyRecords[("Facility1", "UserX")], set())
+        self.assertEqual(node.dirtyRecords[("Facility1", "UserY")], set())
+        self.assertEqual(node.dirtyRecords[("Facility2", "UserX")], set(["record3"]))
+
+        # Serializing again only writes the records modified since, in application order
+        node.addAppData("record1", "new data", "Facility1", "UserX")
+        node.serialize(("", ""))
+        self.assertEqual(node.counter, 4)
+        self.assertEqual(node.store["record1"].lastSavedByCounter, 3)
+        self.assertEqual(node.store["record1"].lastSavedByHistory, {"A": 3})
+        self.assertEqual(node.store["record1"].recordData, "new data")
+        self.assertEqual(node.store["record2"].lastSavedByCounter, 2)
+        self.assertEqual(node.store["record3"].lastSavedByCounter, 4)
+        node.serialize(("", ""))
+        self.assertEqual(node.counter, 4)
+
+    def test_searchRecordInStore(self):
+        node = Node("A")
+        for i in range(1, 6):
+            node.addAppData("record" + str(i), "data", "Facility1", "UserX" if i % 2 else "UserY")
+        node.serialize(("", ""))
+
+        records = node.searchRecordInStore("A", 2, 4, "", "")
+        self.assertEqual([r.recordID for r in records], ["record2", "record3", "record4"])
+        records = node.searchRecordInStore("A", 1, 5, "Facility1", "UserX")
+        self.assertEqual([r.recordID for r in records], ["record1", "record3", "record5"])
+        self.assertEqual(node.searchRecordInStore("B", 1, 5, "", ""), [])
+
+        # Modified records move to their new counter position
+        node.addAppData("record2", "new data", "Facility1", "UserY")
+        node.serialize(("", ""))
+        records = node.searchRecordInStore("A", 2, 6, "", "")
+        self.assertEqual([r.recordID for r in records], ["record3", "record4", "record5", "record2"])
+
+        # Integrated records are indexed under the instance which saved them
+        other = Node("B")
+        sessionID = other.createSyncSession(node, node.instanceID)
+        other.pullInitiation(sessionID, ("", ""))
+        other.addAppData("record1", "B data", "Facility1", "UserX")
+        other.serialize(("", ""))
+        self.assertEqual([r.recordID for r in other.searchRecordInStore("A", 1, 6, "", "")],
+                         ["record3", "record4", "record5", "record2"])
+        self.assertEqual([r.recordID for r in other.searchRecordInStore("B", 1, 1, "", "")], ["record1"])
+
+    def test_searchRecordInStorePartitions(self):
+        node = Node("A")
+        node.addAppData("record1", "data", "", "")
+        node.addAppData("record2", "data", "Facility1", Node.GENERIC)
+        node.addAppData("record3", "data", "Facility1", "UserX")
+        node.addAppData("record4", "data", "Facility2", "UserX")
+        node.addAppData("record5", "data", "Facility1", "UserY")
+        node.serialize(("", ""))
+
+        def search(filter):
+            return [r.recordID for r in node.searchRecordInStore("A", 1, 5, filter[0], filter[1])]
+
+        self.assertEqual(search(("", "")), ["record1", "record2", "record3", "record4", "record5"])
+        self.assertEqual(search(("Facility1", "")), ["record2", "record3", "record5"])
+        self.assertEqual(search(("Facility1", "UserX")), ["record3"])
+        self.assertEqual(search(("Facility3", "")), [])
+        self.assertRaises(ValueError, lambda: search(("", "UserX")))
+
+        # Filtered snapshots only carry the records of the partition
+        filter, (changes, records) = node.fsicDiffAndSnapshot(("Facility1", "UserX"), {})
+        self.assertEqual(changes, {"A": 5})
+        self.assertEqual([r.recordID for r in records], ["record3"])
+
+    def test_streamingSnapshot(self):
+        server = Node("A")
+        server.chunkSize = 2
+        for i in range(5):
+            server.addAppData("record" + str(i), "data " + str(i), "", "")
+        server.serialize(("", ""))
+
+        client = Node("B")
+        received = []
+
+        def recordingReceive(sender, sessionID, data):
+            Node.receive(client, sender, sessionID, data)
+            received.append((data[0], len(client.store), dict(client.syncDataStructure["+"])))
+
+        client.receive = recordingReceive
+        sessionID = client.createSyncSession(server, server.instanceID)
+        client.pullInitiation(sessionID, ("", ""))
+
+        # Chunks are integrated as they arrive and the FSIC advances to the checkpoint of each
+        self.assertEqual(received, [("CHUNK", 2, {"B": 0, "A": 2}), ("CHUNK", 4, {"B": 0, "A": 4}),
+                                    ("DATA", 5, {"B": 0, "A": 5})])
+        self.assertEqual(client.incomingBuffer, {})
+        self.assertEqual(client.store["record4"].recordData, "data 4")
+
+        # Pushing streams as well, and an empty delta is a single DATA message
+        client.chunkSize = 2
+        client.addAppData("record5", "data 5", "", "")
+        client.serialize(("", ""))
+        client.pushInitiation(sessionID, ("", ""))
+        self.assertEqual(server.store["record5"].recordData, "data 5")
+        self.assertEqual(server.syncDataStructure["+"], {"A": 5, "B": 1})
+        del received[:]
+        client.pullInitiation(sessionID, ("", ""))
+        self.assertEqual([r[0] for r in received], ["DATA"])
+
+    def test_resumableTransfer(self):
+        server = Node("A")
+        server.chunkSize = 10
+        for i in range(95):
+            server.addAppData("record" + str(i), "data " + str(i), "Facility1" if i % 2 else "Facility2", "")
+        server.serialize(("", ""))
+        other = Node("C")
+        for i in range(30):
+            other.addAppData("other" + str(i), "C data " + str(i), "Facility1", "")
+        other.serialize(("", ""))
+        fullDBReplication(server, server.createSyncSession(other, other.instanceID))
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "B.sqlite3")
+        try:
+            client = Node("B", SQLiteStoreEngine(path))
+            sessionID = client.createSyncSession(server, server.instanceID)
+            session = client.sessions[sessionID]
+            # Cut before the first chunk, the pull starts over
+            server.transport = InterruptingTransport(0)
+            self.assertRaises(IOError, lambda: client.pullInitiation(sessionID, ("", "")))
+            pullID = list(session.checkpoints)[0]
+            self.assertEqual(session.checkpoints[pullID], (("", ""), None, 0))
+            server.transport = InterruptingTransport(4)
+            self.assertRaises(IOError, lambda: client.resumePull(sessionID, pullID))
+
+            # The four chunks which made it are integrated and the FSIC stands at their checkpoint
+            filter, checkpoint, chunks = session.checkpoints[pullID]
+            self.assertEqual((filter, chunks), (("", ""), 4))
+            self.assertEqual(len(client.store), 40)
+            self.assertEqual(client.syncDataStructure["+"], dict(checkpoint, B=0))
+            self.assertEqual(client.incomingBuffer, {})
+
+            # Resuming only sends what the cut transfer had not delivered
+            server.transport = RecordingTransport()
+            client.resumePull(sessionID, pullID)
+            sent = [len(message[2][1]) if message[0] == "CHUNK" else len(message[2][1][1])
+                    for message in server.transport.messages]
+            self.assertEqual(sum(sent), 125 - 40)
+            self.assertEqual(len(client.store), 125)
+            self.assertEqual(client.syncDataStructure["+"], {"A": 95, "C": 30, "B": 0})
+            self.assertEqual(session.checkpoints, {})
+            # Changes of a snapshot older than a checkpoint never take the FSIC back
+            client.updateSyncDS({"A": 90}, "+")
+            self.assertEqual(client.syncDataStructure["+"], {"A": 95, "C": 30, "B": 0})
+
+            # The server forgets a push cut mid-stream, a new request of the filter supersedes a cut one
+            for i in range(3):
+                client.addAppData("own" + str(i), "own data " + str(i), "", "")
+            client.serialize(("", ""))
+            client.chunkSize = 1
+            client.transport = InterruptingTransport(1)
+            self.assertRaises(IOError, lambda: client.pushInitiation(sessionID, ("", "")))
+            self.assertEqual((len(server.store), server.sessions[sessionID].checkpoints), (126, {}))
+            client.chunkSize = None
+            client.transport = None
+            session.recordCheckpoint("cut", ("", ""), {"A": 1})
+            client.pullInitiation(sessionID, ("", ""))
+            self.assertEqual(session.checkpoints, {})
+
+            # The checkpoint is stored with the chunk, so it survives a restart of the client
+            for i in range(3):
+                server.addAppData("new" + str(i), "new data " + str(i), "Facility1", "")
+            server.serialize(("", ""))
+            server.chunkSize = 1
+            server.transport = InterruptingTransport(1)
+            self.assertRaises(IOError, lambda: client.pullInitiation(sessionID, ("Facility1", "")))
+            client.store.close()
+            client = Node("B", SQLiteStoreEngine(path))
+            self.assertEqual(client.syncDataStructure["Facility1+"], {"A": 96})
+            self.assertEqual(client.store["new0"].recordData, "new data 0")
+            client.store.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sqliteStoreEngine(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "A.sqlite3")
+        try:
+            node = Node("A", SQLiteStoreEngine(path))
+            node.addAppData("record1", "A data 1", "", "")
+            node.addAppData("record2", "A data 2", "Facility1", "UserX")
+            node.addAppData("record3", "A data 3", "Facility1", "UserY")
+            node.serialize(("", ""))
+
+            # Syncing with an in-memory node, including a merge conflict on record1
+            other = Node("B")
+            other.addAppData("record1", "B data 1", "", "")
+            other.addAppData("record4", "B data 4", "Facility2", "UserX")
+            other.serialize(("", ""))
+            sessionID = node.createSyncSession(other, other.instanceID)
+            fullDBReplication(node, sessionID)
+            self.assertEqual(node.store["record1"].recordData, other.store["record1"].recordData)
+            self.assertEqual(node.store["record1"].lastSavedByHistory, other.store["record1"].lastSavedByHistory)
+            self.assertEqual([r.recordID for r in node.searchRecordInStore("A", 1, 3, "Facility1", "UserX")],
+                             ["record2"])
+            self.assertEqual([r.recordID for r in node.searchRecordInStore("A", 1, 3, "Facility1", "")],
+                             ["record2", "record3"])
+            self.assertRaises(ValueError, lambda: node.searchRecordInStore("A", 1, 3, "", "UserX"))
+            self.assertEqual(sorted(r.recordID for r in node.store.partitionQuery("Facility1", "")),
+                             ["record2", "record3"])
+            self.assertEqual(len(list(node.store.partitionQuery("", ""))), 4)
+
+            store = dict((k, (v.recordData, v.lastSavedByInstance, v.lastSavedByCounter, v.lastSavedByHistory))
+                         for k, v in node.store.items())
+            syncDataStructure = deepcopy(node.syncDataStructure)
+            counter = node.counter
+            node.store.close()
+
+            # A restarted node resumes from the database
+            node = Node("A", SQLiteStoreEngine(path))
+            self.assertEqual(dict((k, (v.recordData, v.lastSavedByInstance, v.lastSavedByCounter,
+                                       v.lastSavedByHistory)) for k, v in node.store.items()), store)
+            self.assertEqual(node.syncDataStructure, syncDataStructure)
+            self.assertEqual(node.counter, counter)
+            # Stored records are only inflated into appData once looked for
+            self.assertEqual(len(node.appData), 0)
+            self.assertEqual(node.appData[node.searchRecordInApp("record4")][1:], ["B data 4", 0, "Facility2", "UserX"])
+            self.assertEqual(len(node.appData), 1)
+            self.assertEqual(node.searchRecordInApp("record6"), -1)
+
+            node.addAppData("record5", "A data 5", "", "")
+            node.serialize(("", ""))
+            self.assertEqual(node.store["record5"].lastSavedByCounter, counter + 1)
+            sessionID = other.createSyncSession(node, node.instanceID)
+            other.pullInitiation(sessionID, ("", ""))
+            self.assertEqual(other.store["record5"].recordData, "A data 5")
+
+            # Queries read a page at a time, records written in between show up at their new counter
+            node.store.PAGE_SIZE = 2
+            order = [record.recordID for record in node.searchRecordInStore("A", 1, counter + 1, "", "")]
+            self.assertEqual(len(order), 4)
+            records = node.searchRecordInStore("A", 1, counter + 1, "", "")
+            self.assertEqual(next(records).recordID, order[0])
+            node.addAppData(order[0], "edited", "", "")
+            node.serialize(("", ""))
+            self.assertEqual([record.recordID for record in records], order[1:])
+            self.assertEqual([record.recordID for record in node.searchRecordInStore("A", 1, counter + 2, "", "")],
+                             order[1:] + order[:1])
+            self.assertEqual(len(list(node.store.partitionQuery("", ""))), 5)
+            node.store.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_transactionRollback(self):
+        def state(node):
+            return (dict((k, (v.recordData, v.lastSavedByInstance, v.lastSavedByCounter, dict(v.lastSavedByHistory)))
+                         for k, v in node.store.items()),
+                    deepcopy(node.syncDataStructure), node.counter, deepcopy(node.appData), dict(node.appIndex),
+                    deepcopy(node.dirtyRecords))
+
+        for storeEngine in (None, SQLiteStoreEngine):
+            node = Node("A", storeEngine() if storeEngine else None)
+            node.addAppData("record1", "A data 1", "", "")
+            node.addAppData("record2", "A data 2", "", "")
+            node.serialize(("", ""))
+            node.addAppData("record2", "A data 2 edited", "", "")
+            # In the application but not in the store, and not dirty : integrating it raises
+            node.appendAppRecord(["broken", "data", 0, "", ""])
+            before = state(node)
+
+            incoming = [StoreRecord("record3", "B data 3", "B", 1, {"B": 1}, "", ""),
+                        StoreRecord("record2", "B data 2", "B", 2, {"B": 2}, "", ""),
+                        StoreRecord("broken", "B data", "B", 3, {"B": 3}, "", "")]
+            node.incomingBuffer["pull"] = (("", ""), ({"B": 3}, incoming))
+            self.assertRaises(ValueError, node.integrate)
+            # The new record, the conflict on the dirty record2 and the counter it took are all undone
+            self.assertEqual(state(node), before)
+            self.assertEqual(node.calcFSIC(("", "")), {"A": 2})
+
+            # The records which failed to serialize stay dirty
+            node.incomingBuffer.clear()
+            node.store.addRecord = None
+            self.assertRaises(TypeError, lambda: node.serialize(("", "")))
+            del node.store.addRecord
+            self.assertEqual(state(node), before)
+            node.serialize(("", ""))
+            self.assertEqual(node.store["record2"].recordData, "A data 2 edited")
+
+    def test_wireFormat(self):
+        records = [StoreRecord("record1", "data \u00e9", "A", 1, {"A": 1}, "", ""),
+                   StoreRecord("record2", None, "B", 300, {"A": 1, "B": 300}, "Facility1", Node.GENERIC)]
+        messages = [("PULL", "s_0", ("", ""), {"A": 1, "B": 300}),
+                    ("PUSH", "s_1", ("Facility1", None)),
+                    ("PUSH2", "s_1", ("Facility1", "UserX"), {}),
+                    ("CHUNK", "s_2", (("", ""), records[:1]), {"A": 1}),
+                    ("DATA", "s_2", (("", ""), ({"A": 1, "B": 300}, records[1:])))]
+
+        encoder = WireEncoder()
+        frames = [encoder.encode(message) for message in messages]
+        # Instance IDs already seen on the stream are sent as integers
+        self.assertLess(len(encoder.encode(messages[0])), len(frames[0]))
+
+        decoder = WireDecoder()
+        stream = b"".join(frames)
+        decoded = []
+        # Frames can arrive split at any byte
+        for i in range(0, len(stream), 3):
+            decoded.extend(decoder.feed(stream[i:i + 3]))
+        self.assertEqual(decoder.buffer, bytearray())
+        self.assertEqual(len(decoded), len(messages))
+
+        def fields(record):
+            return (record.recordID, record.recordData, record.lastSavedByInstance, record.lastSavedByCounter,
+                    record.lastSavedByHistory, record.partitionFacility, record.partitionUser)
+
+        self.assertEqual(decoded[:3], messages[:3])
+        self.assertEqual(decoded[3][:2], messages[3][:2])
+        self.assertEqual([fields(r) for r in decoded[3][2][1]], [fields(records[0])])
+        self.assertEqual(decoded[4][2][1][0], {"A": 1, "B": 300})
+        self.assertEqual([fields(r) for r in decoded[4][2][1][1]], [fields(records[1])])
+
+        self.assertRaises(WireFormatError, lambda: encoder.encode(("RESET", "s_3")))
+        self.assertRaises(WireFormatError, lambda: WireDecoder().feed(b"\x03\x7f\x00\x00"))
+
+    def test_payloadCompression(self):
+        for codec in sorted(CODECS):
+            server = Node("A")
+            for i in range(20):
+                server.addAppData("record" + str(i), "attempt %d of exercise %d by learner %d" % (i, i % 3, i % 5),
+                                  "", "")
+            server.serialize(("", ""))
+
+            client = Node("B")
+            received = []
+
+            def recordingReceive(sender, sessionID, data, client=client):
+                if data[0] == "DATA":
+                    received.append(data[2][1][1])
+                Node.receive(client, sender, sessionID, data)
+
+            client.receive = recordingReceive
+            sessionID = client.createSyncSession(server, server.instanceID, compression=codec)
+            self.assertEqual(server.sessions[sessionID].compression, codec)
+            client.pullInitiation(sessionID, ("", ""))
+
+            self.assertEqual(received[0].codec, codec)
+            self.assertEqual(len(received[0]), 20)
+            for i in range(20):
+                self.assertEqual(client.store["record" + str(i)].recordData, server.store["record" + str(i)].recordData)
+            self.assertEqual(client.syncDataStructure["+"]["A"], 20)
+
+            # Payloads under the threshold are not compressed, in the push direction too
+            client.addAppData("record20", "short", "", "")
+            client.serialize(("", ""))
+            pushed = []
+
+            def serverReceive(sender, sessionID, data, server=server):
+                if data[0] == "DATA":
+                    pushed.append(data[2][1][1])
+                Node.receive(server, sender, sessionID, data)
+
+            server.receive = serverReceive
+            client.pushInitiation(sessionID, ("", ""))
+            self.assertEqual(pushed[0].codec, None)
+            self.assertEqual(server.store["record20"].recordData, "short")
+
+        records = [StoreRecord("record1", "data " * 100, "A", 1, {"A": 1}, "", "")]
+        compressed = compressRecords(records, "zlib", 256)
+        self.assertEqual(compressed.codec, "zlib")
+        self.assertLess(len(compressed.payload), 100)
+        self.assertEqual(records[0].recordData, "data " * 100)
+        self.assertEqual(compressRecords(records, "zlib", 1000).codec, None)
+        frame = WireEncoder().encode(("CHUNK", "s_1", (("", ""), compressed), {}))
+        decoded = WireDecoder().feed(frame)[0][2][1]
+        self.assertEqual(decompressRecords(decoded)[0].recordData, "data " * 100)
+        # A payload not matching its records is refused rather than truncated
+        compressed = compressRecords(records * 2, None, 0)
+        compressed.records = compressed.records[:1]
+        self.assertRaises(ValueError, lambda: decompressRecords(compressed))
+        self.assertRaises(ValueError, lambda: Node("C").createSyncSession(Node("D"), "D", compression="bz2"))
+
+    def test_versionVector(self):
+        vector = VersionVector({"A": 3, "B": 1})
+        self.assertTrue(vector.mergeMax({"B": 4}, {"A": 2, "C": 1}) is vector)
+        self.assertEqual(vector, {"A": 3, "B": 4, "C": 1})
+        self.assertTrue(vector.covers("A", 3))
+        self.assertFalse(vector.covers("A", 4))
+        self.assertFalse(vector.covers("D", 1))
+        self.assertTrue(vector.dominates({"A": 1, "C": 1}))
+        self.assertFalse(vector.dominates({"D": 1}))
+        # Histories stay as small as plain dicts
+        self.assertFalse(hasattr(vector, "__dict__"))
+
+        # Merged histories are owned by the store record, never by the incoming record
+        nodes = createNodes(2)
+        nodes[0].addAppData("record1", "data", "", "")
+        nodes[0].serialize(("", ""))
+        nodes[1].addAppData("record1", "other data", "", "")
+        nodes[1].serialize(("", ""))
+        sent = nodes[0].store["record1"].lastSavedByHistory
+        sessionID = nodes[1].createSyncSession(nodes[0], nodes[0].instanceID)
+        nodes[1].pullInitiation(sessionID, ("", ""))
+        self.assertEqual(sent, {"0": 1})
+        history = nodes[1].store["record1"].lastSavedByHistory
+        self.assertTrue(isinstance(history, VersionVector))
+        self.assertEqual(history, {"0": 1, "1": 2})
+
+    def test_instanceTable(self):
+        table = InstanceTable(["A", "B"])
+        self.assertEqual(table.add("C"), 2)
+        self.assertEqual(table.add("A"), 0)
+        self.assertEqual(table.instanceAt(1), "B")
+        self.assertEqual(table.snapshot(), ["A", "B", "C"])
+
+        server = Node("A")
+        server.updateSyncDS({"C": 4}, "Facility1+")
+        client = Node("B")
+        sessionID = client.createSyncSession(server, server.instanceID)
+        self.assertEqual(client.sessions[sessionID].peerInstances, ["A", "C"])
+        self.assertEqual(server.sessions[sessionID].peerInstances, ["B"])
+
+        # Instances from the handshake are sent as integers from the first frame
+        message = ("DATA", sessionID, (("", ""), ({"A": 1, "C": 4}, [StoreRecord("record1", "data", "C", 4,
+                                                                                   {"C": 4}, "", "")])))
+        seeded = server.sessions[sessionID].createWireEncoder().encode(message)
+        self.assertLess(len(seeded), len(WireEncoder().encode(message)))
+        decoded = client.sessions[sessionID].createWireDecoder().feed(seeded)[0]
+        self.assertEqual(decoded[2][1][0], {"A": 1, "C": 4})
+        self.assertEqual(decoded[2][1][1][0].lastSavedByHistory, {"C": 4})
+
+    def test_merkleAntiEntropy(self):
+        def versions(node):
+            return dict((k, (v.recordData, v.lastSavedByInstance, v.lastSavedByCounter)) for k, v in node.store.items())
+
+        nodes = createNodes(2)
+        for node in nodes:
+            for i in range(300):
+                node.addAppData("record%s_%d" % (node.instanceID, i), "data", "Facility%d" % (i % 2), "")
+            node.addAppData("shared", "data " + node.instanceID, "Facility0", "")
+            node.serialize(("", ""))
+            node.merkleDepth = 2
+        sessionID = nodes[0].createSyncSession(nodes[1], nodes[1].instanceID)
+        nodes[0].pullInitiation(sessionID, ("Facility0", ""))
+        self.assertEqual(len(nodes[0].store), 451)
+        self.assertEqual(nodes[0].calcFSIC(("Facility0", "")), {"0": 302, "1": 301})
+        self.assertEqual(nodes[0].merkleRequests, {})
+        self.assertEqual(nodes[1].merkleRequests, {})
+        nodes[0].pullInitiation(sessionID, ("", ""))
+        nodes[1].pullInitiation(nodes[1].createSyncSession(nodes[0], nodes[0].instanceID), ("", ""))
+        self.assertEqual(versions(nodes[0]), versions(nodes[1]))
+
+        # A node which lost its FSICs finds out from the root hash that nothing is missing
+        transport = RecordingTransport()
+        nodes[0].transport = transport
+        nodes[1].transport = transport
+        nodes[0].syncDataStructure = {"+": {"0": nodes[0].counter}}
+        nodes[0].fsicCache = {}
+        nodes[0].pullInitiation(sessionID, ("", ""))
+        self.assertEqual([message[0] for message in transport.messages], ["MERKLE", "DATA"])
+        self.assertEqual(transport.messages[-1][2][1][1], [])
+        self.assertEqual(nodes[0].calcFSIC(("", "")), nodes[1].calcFSIC(("", "")))
+
+        # A single record changed on the other node is found by walking down the tree
+        transport.messages = []
+        nodes[1].addAppData("record1_7", "new data", "Facility1", "")
+        nodes[1].serialize(("", ""))
+        nodes[0].syncDataStructure = {"+": {"0": nodes[0].counter}}
+        nodes[0].fsicCache = {}
+        nodes[0].pullInitiation(sessionID, ("", ""))
+        self.assertEqual([message[0] for message in transport.messages], ["MERKLE", "MERKLE2", "MERKLE",
+                                                                          "MERKLE2", "MERKLE", "DATA"])
+        self.assertEqual([record.recordID for record in transport.messages[-1][2][1][1]], ["record1_7"])
+        self.assertEqual(versions(nodes[0]), versions(nodes[1]))
+
+        # Merkle messages on the wire
+        messages = transport.messages[:2]
+        encoder = WireEncoder()
+        decoded = WireDecoder().feed(b"".join(encoder.encode(message) for message in messages))
+        self.assertEqual(decoded, messages)
+
+        # A chunking server sends the records of the differing buckets in chunks, a client
+        # with a budget pulls without the tree
+        nodes[1].chunkSize = 100
+        for i in range(300):
+            nodes[1].addAppData("record1_%d" % i, "newer data", "Facility%d" % (i % 2), "")
+        nodes[1].serialize(("", ""))
+        transport.messages = []
+        nodes[0].pullInitiation(sessionID, ("", ""))
+        self.assertEqual([message[0] for message in transport.messages][-3:], ["CHUNK", "CHUNK", "DATA"])
+        self.assertEqual(versions(nodes[0]), versions(nodes[1]))
+        self.assertEqual(nodes[0].sessions[sessionID].checkpoints, {})
+        nodes[1].addAppData("record1_7", "newest data", "Facility1", "")
+        nodes[1].serialize(("", ""))
+        nodes[0].incomingBudget = 10
+        sessionID = nodes[0].createSyncSession(nodes[1], nodes[1].instanceID)
+        transport.messages = []
+        nodes[0].pullInitiation(sessionID, ("", ""))
+        self.assertEqual([message[0] for message in transport.messages], ["PULL", "CREDIT", "DATA"])
+        self.assertEqual(versions(nodes[0]), versions(nodes[1]))
+        self.assertRaises(ValueError, lambda: nodes[1].handleMessage(nodes[0], sessionID, (
+            "MERKLE", "x", ("", ""), {}, 2, 0, [])))
+
+        # Trees only hold record IDs, and a Merkle pull whose connection drops is forgotten at both ends
+        tree = nodes[1].buildMerkleTree(("", ""), 2)
+        self.assertEqual(sorted(recordID for leaf in tree.leaves.values() for recordID in leaf),
+                         sorted(nodes[1].store.keys()))
+        client = Node("C")
+        client.merkleDepth = 2
+        sessionID = client.createSyncSession(nodes[1], nodes[1].instanceID)
+        simulator = NetworkSimulator(Link(latency=1.0))
+        simulator.attach(client, nodes[1])
+        client.pullInitiation(sessionID, ("", ""))
+        simulator.run(until=1.5)
+        self.assertEqual((len(client.merkleRequests), len(nodes[1].merkleRequests)), (1, 1))
+        simulator.breakConnection(sessionID, client, nodes[1])
+        self.assertEqual((client.merkleRequests, nodes[1].merkleRequests), ({}, {}))
+
+    def test_manifestMode(self):
+        nodes = createNodes(3)
+        for node in nodes:
+            node.addAppData("record" + node.instanceID, "data " + node.instanceID, "Facility1", "")
+            node.addAppData("other" + node.instanceID, "data " + node.instanceID, "Facility2", "")
+            node.serialize(("", ""))
+            node.manifestMode = True
+        # Node 2 gets the Facility1 record of node 0 through node 1
+        nodes[1].pullInitiation(nodes[1].createSyncSession(nodes[0], nodes[0].instanceID), ("Facility1", ""))
+        nodes[2].pullInitiation(nodes[2].createSyncSession(nodes[1], nodes[1].instanceID), ("Facility1", ""))
+        self.assertTrue("record0" in nodes[2].store)
+
+        # Its full replication FSIC does not cover it, only the record it lacks is sent
+        transport = RecordingTransport()
+        nodes[0].transport = transport
+        nodes[2].transport = transport
+        sessionID = nodes[2].createSyncSession(nodes[0], nodes[0].instanceID)
+        nodes[2].pushInitiation(sessionID, ("", ""))
+        nodes[2].pullInitiation(sessionID, ("", ""))
+        self.assertEqual([message[0] for message in transport.messages],
+                         ["PUSH", "PUSH2", "MANIFEST", "FETCH", "DATA", "PULL", "MANIFEST", "FETCH", "DATA"])
+        manifest = transport.messages[6][2][1][1]
+        self.assertEqual(sorted(entry[0] for entry in manifest), ["other0", "record0"])
+        self.assertEqual([record.recordID for record in transport.messages[8][2][1][1]], ["other0"])
+        self.assertEqual(sorted(nodes[2].store), ["other0", "other2", "record0", "record1", "record2"])
+        self.assertEqual(nodes[2].calcFSIC(("", "")), {"0": 2, "2": 2})
+        self.assertEqual(nodes[0].outgoingBuffer, {})
+        self.assertEqual(nodes[2].outgoingBuffer, {})
+
+        # Manifests and fetches on the wire
+        messages = transport.messages[6:8]
+        encoder = WireEncoder()
+        decoded = WireDecoder().feed(b"".join(encoder.encode(message) for message in messages))
+        self.assertEqual(decoded, messages)
+        self.assertRaises(WireFormatError, lambda: WireEncoder().encode(("FETCH", "s_0", [2, 1])))
+
+    def test_concurrentSessions(self):
+        def versions(node):
+            return dict((k, (v.recordData, v.lastSavedByInstance, v.lastSavedByCounter)) for k, v in node.store.items())
+
+        server = Node("server")
+        for i in range(200):
+            server.addAppData("server%d" % i, "data", "Facility%d" % (i % 4), "")
+        server.serialize(("", ""))
+        clients = [Node("client%d" % i) for i in range(16)]
+        sessionIDs = {}
+        errors = []
+
+        def syncClient(client):
+            try:
+                sessionIDs[client.instanceID] = sessionID = client.createSyncSession(server, server.instanceID)
+                for i in range(10):
+                    client.addAppData("%s_%d" % (client.instanceID, i), "data", "Facility%d" % (i % 4), "")
+                    client.serialize(("", ""))
+                    fullDBReplication(client, sessionID)
+                    client.pullInitiation(sessionID, ("Facility1", ""))
+            except Exception as error:
+                errors.append(error)
+
+        def editServer():
+            try:
+                for i in range(100):
+                    server.addAppData("server%d" % (i * 7 % 200), "new data %d" % i, "Facility%d" % (i * 7 % 4), "")
+                    server.serialize(("", ""))
+            except Exception as error:
+                errors.append(error)
+
+        # Switch threads as often as possible to interleave the sessions
+        switchInterval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=syncClient, args=(client,)) for client in clients]
+            threads.append(threading.Thread(target=editServer))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switchInterval)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(server.store), 200 + 16 * 10)
+        self.assertEqual(server.incomingBuffer, {})
+        self.assertEqual(server.outgoingBuffer, {})
+        for client in clients:
+            client.pullInitiation(sessionIDs[client.instanceID], ("", ""))
+            self.assertEqual(versions(client), versions(server))
+            self.assertEqual(client.calcFSIC(("", "")), server.calcFSIC(("", "")))
+
+    def test_readWriteLock(self):
+        lock = ReadWriteLock()
+        order = []
+
+        def write():
+            with lock.writing():
+                order.append("write")
+
+        def read():
+            with lock.reading():
+                order.append("read")
+
+        with lock.reading():
+            writer = threading.Thread(target=write)
+            writer.start()
+            while lock.writersWaiting == 0:
+                time.sleep(0.001)
+            # A new reader waits for the writer, a thread already reading does not
+            reader = threading.Thread(target=read)
+            reader.start()
+            with lock.reading():
+                pass
+            time.sleep(0.05)
+            self.assertEqual(order, [])
+        writer.join()
+        reader.join()
+        self.assertEqual(order, ["write", "read"])
+
+    def test_syncRequest(self):
+        nodeList = createNodes(self.STARSIZE)
+        addAppRecordDiff(nodeList)
+        addAppRecordMerge(nodeList)
+        sessIDlist = sessionsStar(nodeList)
+        transport = RecordingTransport()
+        for node in nodeList:
+            node.transport = transport
+
+        # Same rounds as test_eventualConsistencyStar, with one round trip per sync
+        for j in range(2):
+            for i in range(self.STARSIZE - 1):
+                fullDBSync(nodeList[sessIDlist[i][0]], sessIDlist[i][2])
+                self.assertEqual(nodeList[i].store["id"].lastSavedByHistory,
+                                 nodeList[-1].store["id"].lastSavedByHistory)
+        self.assertEqual(endConditionData(nodeList), False)
+        self.assertEqual(endConditionMerge(nodeList), False)
+        self.assertEqual([message[0] for message in transport.messages[:3]], ["SYNC", "SYNCDATA", "DATA"])
+        self.assertEqual(len(transport.messages), 3 * 2 * (self.STARSIZE - 1))
+        for node in nodeList:
+            self.assertEqual(node.calcFSIC(("", "")), nodeList[-1].calcFSIC(("", "")))
+
+        messages = transport.messages[:2]
+        encoder = WireEncoder()
+        decoded = WireDecoder().feed(b"".join(encoder.encode(message) for message in messages))
+        self.assertEqual(decoded[0], messages[0])
+        self.assertEqual(decoded[1][2][1][0], messages[1][2][1][0])
+        self.assertEqual(decoded[1][3], messages[1][3])
+
+        # Devices chunking their snapshots chunk both halves of the sync
+        nodes = createNodes(2)
+        for node in nodes:
+            for i in range(5):
+                node.addAppData("record%s_%d" % (node.instanceID, i), "data", "", "")
+            node.serialize(("", ""))
+            node.chunkSize = 2
+            node.transport = transport
+        sessionID = nodes[0].createSyncSession(nodes[1], nodes[1].instanceID)
+        transport.messages = []
+        nodes[0].syncInitiation(sessionID, ("", ""))
+        self.assertEqual([message[0] for message in transport.messages],
+                         ["SYNC", "CHUNK", "CHUNK", "SYNCDATA", "CHUNK", "CHUNK", "DATA"])
+        self.assertEqual(nodes[0].calcFSIC(("", "")), nodes[1].calcFSIC(("", "")))
+        self.assertEqual((nodes[0].sessions[sessionID].checkpoints, nodes[1].sessions[sessionID].checkpoints), ({}, {}))
+
+        # Replies to a sync are not streamed under credit : a device with a budget pulls and pushes
+        nodes[0].addAppData("new", "new data", "", "")
+        nodes[0].serialize(("", ""))
+        nodes[1].incomingBudget = 3
+        sessionID = nodes[0].createSyncSession(nodes[1], nodes[1].instanceID)
+        transport.messages = []
+        nodes[0].syncInitiation(sessionID, ("", ""))
+        self.assertEqual([message[0] for message in transport.messages if message[0] != "CREDIT"],
+                         ["PULL", "DATA", "PUSH", "PUSH2", "DATA"])
+        self.assertEqual(nodes[0].calcFSIC(("", "")), nodes[1].calcFSIC(("", "")))
+        self.assertRaises(ValueError, lambda: nodes[1].handleMessage(nodes[0], sessionID, ("SYNC", "x", ("", ""), {})))
+
+    def test_fsicCache(self):
+        node = Node("A")
+        node.addAppData("record1", "data", "Facility1", "UserX")
+        node.serialize(("", ""))
+        node.updateSyncDS({"B": 2}, "Facility1+")
+        node.updateSyncDS({"C": 3}, "Facility2+UserX")
+
+        full = node.calcFSIC(("", ""))
+        facility1 = node.calcFSIC(("Facility1", "UserX"))
+        facility2 = node.calcFSIC(("Facility2", "UserX"))
+        self.assertEqual(facility1, {"A": 1, "B": 2})
+        self.assertEqual(facility2, {"A": 1, "C": 3})
+        self.assertTrue(node.calcFSIC(("", "")) is full)
+
+        # Only the FSICs built from the changed entry are recomputed
+        node.updateSyncDS({"B": 4}, "Facility1+")
+        self.assertEqual(node.calcFSIC(("Facility1", "UserX")), {"A": 1, "B": 4})
+        self.assertTrue(node.calcFSIC(("Facility2", "UserX")) is facility2)
+        self.assertTrue(node.calcFSIC(("", "")) is full)
+        node.updateSyncDS({"C": 5}, "Facility2+UserX")
+        self.assertEqual(node.calcFSIC(("Facility2", "UserX")), {"A": 1, "C": 5})
+        self.assertTrue(node.calcFSIC(("", "")) is full)
+
+        # Counter updates change every FSIC
+        node.addAppData("record2", "data", "Facility1", "UserX")
+        node.serialize(("", ""))
+        self.assertEqual(node.calcFSIC(("", "")), {"A": 2})
+        self.assertEqual(node.calcFSIC(("Facility1", "UserX")), {"A": 2, "B": 4})
+        self.assertEqual(full, {"A": 1})
+
+        # A pull advancing the full replication entry
+        other = Node("D")
+        other.addAppData("record3", "data", "", "")
+        other.serialize(("", ""))
+        sessionID = node.createSyncSession(other, other.instanceID)
+        node.pullInitiation(sessionID, ("", ""))
+        self.assertEqual(node.calcFSIC(("Facility2", "UserX")), {"A": 2, "C": 5, "D": 1})
+
     def test_compareVersions(self):
         n = Node("A")
         self.assertEqual(n.compareVersions({"A": 1}, {"A": 2}, ("A", 1), ("A", 2)), 0)
@@ -92,36 +911,8 @@ class Test(unittest.TestCase):
         self.assertEqual(n.compareVersions({"A": 2, "B": 3}, {"A": 2}, ("B", 3), ("A", 2)), 1)
         self.assertEqual(n.compareVersions({"A": 2, "B": 3}, {"A": 3}, ("B", 3), ("A", 3)), 2)
 
-    def createNodes(self, size):
-        """
-        Creates size number of nodes and puts it in a list.
-        """
-        nodeList = []
-        for i in range(size):
-            nodeList.append(Node(str(i)))
-        return nodeList
-
-    def addAppRecordMerge(self, nodeList):
-        """
-        Adds an application record to each node in the nodeList such that
-        they create a merge conflict among each other. i.e their IDs are same but
-        different data.
-        """
-        for i in range(len(nodeList)):
-            nodeList[i].addAppData("id", "data " + nodeList[i].instanceID, "", "")
-            nodeList[i].serialize(("", ""))
-
-    def addAppRecordDiff(self, nodeList):
-        """
-        Adds an application record to each node in the nodelist such that they have different recordIDs
-        """
-        for i in range(len(nodeList)):
-            nodeList[i].addAppData("record" + nodeList[i].instanceID, "recordData" + \
-                                   nodeList[i].instanceID, "", "")
-            nodeList[i].serialize(("", ""))
-
     def test_scenario1(self):
-        nodeList = self.createNodes(3)
+        nodeList = createNodes(3)
 
         # Adding a record to a node A
         nodeList[0].addAppData("record1", "record1", "", "")
@@ -256,7 +1047,7 @@ class Test(unittest.TestCase):
         """
         Checks if fast-forwards are being propagated properly in different scenarios
         """
-        nodeList = self.createNodes(3)
+        nodeList = createNodes(3)
 
         # Adding a record to a node A
         nodeList[0].addAppData("record1", "A version 1", "", "")
@@ -316,7 +1107,7 @@ class Test(unittest.TestCase):
         self.assertEqual(nodeList[2].store["record1"].recordData, "B version 1")
 
     def test_mergeConflict_scenario1(self):
-        nodeList = self.createNodes(4)
+        nodeList = createNodes(4)
 
         # Adding a record to a node A
         nodeList[0].addAppData("record1", "A version 1", "", "")
@@ -369,81 +1160,347 @@ class Test(unittest.TestCase):
                                                                            nodeList[3].instanceID: 2,
                                                                            nodeList[2].instanceID: 1})
 
-    def endConditionData(self, nodeList):
-        """
-        End Condition : if all the nodes posses same set of data
-        Return True if the end condition is not met
-        Returns False if end condition is met
-        """
-        data = set([])
-        for i in range(len(nodeList)):
-            for k, v in nodeList[i].store.items():
-                data.add(v.recordID)
-
-        for i in range(len(nodeList)):
-            if len(nodeList[i].store) != len(data):
-                return True
-            else:
-                for m in data:
-                    if not m in nodeList[i].store:
-                        return True
-
-        return False
-
-    def endConditionMerge(self, nodeList):
-        """
-        End Condition : if all the nodes posses same data with same lastSavedByHistory
-        Return True if the end condition is not met
-        Returns False if end condition is met
-        """
-        data = nodeList[0].store["id"].lastSavedByHistory
-        for i in range(1, len(nodeList)):
-            if nodeList[i].store["id"].lastSavedByHistory != data:
-                return True
-        return False
-
-    def fullDBReplication(self, clientHandler, sessionID):
-        # Client pulling server's data
-        clientHandler.pullInitiation(sessionID, ("", ""))
-        # Client pushing data to server
-        clientHandler.pushInitiation(sessionID, ("", ""))
-
-    def sessionsRing(self, nodeList):
-        """
-        Establishes sync sessions between any 2 adjacent nodes and stores in an array
-        """
-        sessIDlist = []
-        # Create sync sessions and store session IDs in a list
-        ringSize = len(nodeList)
-        for i in range(ringSize):
-            if i == ringSize - 1:
-                sessIDlist.append((i, 0, nodeList[i].createSyncSession(nodeList[0], nodeList[0].instanceID)))
-            else:
-                sessIDlist.append(
-                    (i, i + 1, nodeList[i].createSyncSession(nodeList[i + 1], nodeList[i + 1].instanceID)))
-        return sessIDlist
-
-    def sessionsStar(self, nodeList):
-        # i client , len(nodeList)-1 server
-        sessIDlist = []
-        starSize = len(nodeList)
-        # Create sync sessions and store session IDs in a list
-        for i in range(starSize - 1):
-            sessIDlist.append((i, starSize - 1, nodeList[i].createSyncSession(nodeList[starSize - 1], \
-                                                                              nodeList[starSize - 1].instanceID)))
-        return sessIDlist
-
-    def sessionsFull(self, nodeList):
-        """
-        Establishes sync session between any 2 nodes in the network,
-        returns array with all these details
-        """
-        sessIDlist = []
-        for i in range(len(nodeList)):
-            for j in range(len(nodeList)):
-                if (i != j):
-                    sessIDlist.append((i, j, (nodeList[i].createSyncSession(nodeList[j], nodeList[j].instanceID))))
-        return sessIDlist
+    def test_asyncTransport(self):
+        starSize = self.STARSIZE
+        nodeList = createNodes(starSize)
+        addAppRecordDiff(nodeList)
+        sessIDlist = sessionsStar(nodeList)
+        transport = AsyncTransport()
+        transport.attach(*nodeList)
+
+        async def syncRounds():
+            transport.start()
+            for j in range(2):
+                # Every client starts its sync at once, the server interleaves the sessions
+                for client, server, sessionID in sessIDlist:
+                    fullDBReplication(nodeList[client], sessionID)
+                await transport.drain()
+            await transport.stop()
+
+        asyncio.run(syncRounds())
+        self.assertEqual(endConditionData(nodeList), False)
+        self.assertGreater(transport.maxQueueDepth, 1)
+
+    def test_incomingBudget(self):
+        def pushAll(budget):
+            server = Node("S")
+            server.incomingBudget = budget
+            clients = []
+            for i in range(8):
+                client = Node("C" + str(i))
+                client.chunkSize = 10
+                for j in range(60):
+                    client.addAppData("record%d_%d" % (i, j), "data", "Facility" + str(j % 3), "")
+                client.serialize(("", ""))
+                clients.append((client, client.createSyncSession(server, server.instanceID)))
+            transport = AsyncTransport()
+            transport.attach(server, *[client for client, sessionID in clients])
+
+            async def pushes():
+                transport.start()
+                # Every client pushes at once
+                for client, sessionID in clients:
+                    client.pushInitiation(sessionID, ("", ""))
+                await transport.drain()
+                await transport.stop()
+
+            asyncio.run(pushes())
+            self.assertEqual(len(server.store), 480)
+            self.assertEqual((server.incomingStreams, server.creditOutstanding), ({}, 0))
+            return transport.maxQueuedRecords
+
+        self.assertGreater(pushAll(None), 40)
+        # Records waiting for the server never exceed its budget
+        self.assertLessEqual(pushAll(40), 40)
+
+        # A server which does not chunk its snapshots streams them to a client with a budget
+        server = Node("A")
+        for i in range(25):
+            server.addAppData("record" + str(i), "data " + str(i), "", "")
+        server.serialize(("", ""))
+        client = Node("B")
+        client.incomingBudget = 7
+        sessionID = client.createSyncSession(server, server.instanceID)
+        server.transport = RecordingTransport()
+        client.pullInitiation(sessionID, ("", ""))
+        self.assertEqual([len(m[2][1]) for m in server.transport.messages if m[0] == "CHUNK"], [7, 7, 7])
+        self.assertEqual([len(m[2][1][1]) for m in server.transport.messages if m[0] == "DATA"], [4])
+        self.assertEqual(len(client.store), 25)
+        self.assertEqual(client.syncDataStructure["+"], {"A": 25, "B": 0})
+        self.assertEqual((client.incomingStreams, client.creditOutstanding, server.outgoingStreams), ({}, 0, {}))
+
+        # A pull cut mid-stream and followed by a new pull gives its credit back to the new one
+        server = Node("A")
+        server.chunkSize = 10
+        for i in range(50):
+            server.addAppData("record" + str(i), "data " + str(i), "", "")
+        server.serialize(("", ""))
+        client = Node("B")
+        client.incomingBudget = 20
+        sessionID = client.createSyncSession(server, server.instanceID)
+        server.transport = InterruptingTransport(1)
+        self.assertRaises(IOError, lambda: client.pullInitiation(sessionID, ("", "")))
+        self.assertEqual(len(client.store), 10)
+        server.transport = None
+        client.pullInitiation(sessionID, ("", ""))
+        self.assertEqual(len(client.store), 50)
+        self.assertEqual((client.incomingStreams, client.creditOutstanding, server.outgoingStreams), ({}, 0, {}))
+
+        # A push cut mid-stream leaves no stream nor credit behind at either end
+        client.addAppData("new", "new data", "", "")
+        client.serialize(("", ""))
+        client.chunkSize = 1
+        server.incomingBudget = 1
+        sessionID = client.createSyncSession(server, server.instanceID)
+        client.transport = InterruptingTransport(0)
+        self.assertRaises(IOError, lambda: client.pushInitiation(sessionID, ("", "")))
+        self.assertEqual((client.outgoingStreams, server.incomingStreams, server.creditOutstanding), ({}, {}, 0))
+
+        # Two pulls in one session share the budget and both finish
+        source = Node("S")
+        source.chunkSize = 5
+        for i in range(100):
+            source.addAppData("record" + str(i), "data " + str(i), "F" + str(i % 2), "")
+        source.serialize(("", ""))
+        pulling = Node("C")
+        pulling.incomingBudget = 10
+        pullSessionID = pulling.createSyncSession(source, source.instanceID)
+        transport = AsyncTransport()
+        transport.attach(source, pulling)
+
+        async def pulls():
+            transport.start()
+            pulling.pullInitiation(pullSessionID, ("F0", ""))
+            pulling.pullInitiation(pullSessionID, ("F1", ""))
+            await transport.drain()
+            await transport.stop()
+
+        asyncio.run(pulls())
+        self.assertEqual(len(pulling.store), 100)
+        self.assertEqual(pulling.calcFSIC(("F0", "")), {"S": 100, "C": 0})
+        self.assertEqual((pulling.incomingStreams, pulling.creditOutstanding, source.outgoingStreams), ({}, 0, {}))
+        credit = ("CREDIT", "s_0", 300)
+        self.assertEqual(WireDecoder().feed(WireEncoder().encode(credit)), [credit])
+
+    def test_syncMetrics(self):
+        server = Node("A")
+        server.chunkSize = 2
+        for i in range(5):
+            server.addAppData("record" + str(i), "A data " + str(i), "", "")
+        server.serialize(("", ""))
+        client = Node("B")
+        client.addAppData("record0", "B data 0", "", "")
+        client.addAppData("record9", "B data 9", "", "")
+        client.serialize(("", ""))
+        sessionID = client.createSyncSession(server, server.instanceID)
+        client.pullInitiation(sessionID, ("", ""))
+        # Nothing is collected without metrics
+        self.assertEqual(client.sessions[sessionID].metrics, None)
+
+        metrics = SyncMetrics(countBytes=True)
+        metrics.attach(server, client)
+        client.addAppData("record1", "B data 1", "", "")
+        client.serialize(("", ""))
+        server.addAppData("record1", "A data 1 again", "", "")
+        server.addAppData("record5", "A data 5", "", "")
+        server.serialize(("", ""))
+        client.pullInitiation(sessionID, ("", ""))
+        client.pushInitiation(sessionID, ("", ""))
+
+        exported = metrics.export()
+        clientSession = exported["B"]["sessions"][sessionID]["counters"]
+        self.assertEqual((clientSession["recordsReceived"], clientSession["recordsIntegrated"],
+                          clientSession["conflicts"], clientSession["historyMerges"]), (2, 2, 1, 1))
+        self.assertEqual((clientSession["messagesSent"], clientSession["recordsSent"]), (3, 3))
+        self.assertEqual(exported["A"]["sessions"][sessionID]["counters"]["recordsScanned"], 2)
+        self.assertGreater(clientSession["bytesSent"], 0)
+        # Serializing happens outside any session
+        self.assertEqual(exported["B"]["total"]["counters"]["copies"], 1 + 1 + 1)
+        self.assertEqual(set(exported["A"]["total"]["seconds"]), set(["fsic", "snapshot", "integrate", "serialize"]))
+        self.assertEqual(client.sessions[sessionID].metrics.asDict(), exported["B"]["sessions"][sessionID])
+
+        # Transports queueing messages report the time they waited
+        transport = AsyncTransport()
+        transport.attach(server, client)
+
+        async def pull():
+            transport.start()
+            client.pullInitiation(sessionID, ("", ""))
+            await transport.drain()
+            await transport.stop()
+
+        asyncio.run(pull())
+        self.assertTrue("transfer" in metrics.export()["A"]["sessions"][sessionID]["seconds"])
+
+    def test_trafficTrace(self):
+        # What a replay restores, state the nodes create themselves is not in the trace
+        def state(node):
+            return (dict((recordID, (record.recordData, record.lastSavedByInstance, record.lastSavedByCounter,
+                                     dict(record.lastSavedByHistory))) for recordID, record in node.store.items()),
+                    node.syncDataStructure, node.counter)
+
+        nodeList = createNodes(4)
+        addAppRecordMerge(nodeList)
+        addAppRecordDiff(nodeList)
+        nodeList[3].chunkSize = 2
+        nodeList[3].incomingBudget = 3
+        sessIDlist = sessionsStar(nodeList)
+        path = os.path.join(tempfile.mkdtemp(), "sync.trace")
+        try:
+            recorder = TraceRecorder(path)
+            recorder.attach(*nodeList)
+            for j in range(2):
+                for client, server, sessionID in sessIDlist:
+                    fullDBReplication(nodeList[client], sessionID)
+            recorder.close()
+            self.assertEqual(endConditionMerge(nodeList), False)
+
+            # Fresh nodes given the same messages end up in the same state
+            replayer = replayTrace(path, strict=True)
+            self.assertEqual(replayer.replayed, recorder.messages)
+            self.assertEqual(replayer.errors, {})
+            for node in nodeList:
+                self.assertEqual(state(replayer.nodes[node.instanceID]), state(node))
+            self.assertEqual(replayer.nodes[nodeList[3].instanceID].chunkSize, 2)
+
+            # On another store engine too
+            engines = []
+
+            def sqliteEngine(instanceID):
+                engines.append(SQLiteStoreEngine())
+                return engines[-1]
+
+            replayer = replayTrace(path, sqliteEngine)
+            for node in nodeList:
+                self.assertEqual(state(replayer.nodes[node.instanceID]), state(node))
+            for engine in engines:
+                engine.close()
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_networkSimulator(self):
+        def converged(nodeList):
+            return lambda: not endConditionData(nodeList)
+
+        # A pull and a push take three latencies on a fast link : PULL and PUSH, DATA and PUSH2, DATA
+        nodeList = createNodes(2)
+        addAppRecordDiff(nodeList)
+        sessionID = nodeList[0].createSyncSession(nodeList[1], nodeList[1].instanceID)
+        simulator = NetworkSimulator(Link(latency=1.0, bandwidth=10 ** 9))
+        simulator.attach(*nodeList)
+        simulator.at(0.0, simulator.sync, nodeList[0], sessionID, "full")
+        self.assertAlmostEqual(simulator.run(converged=converged(nodeList)), 3.0, places=3)
+        self.assertEqual(simulator.delivered, 5)
+
+        # Records take longer to send on a slow link
+
+        nodeList = createNodes(2)
+        addAppRecordDiff(nodeList)
+        sessionID = nodeList[0].createSyncSession(nodeList[1], nodeList[1].instanceID)
+        simulator = NetworkSimulator(Link(latency=1.0, bandwidth=100))
+        simulator.attach(*nodeList)
+        simulator.at(0.0, simulator.sync, nodeList[0], sessionID, "full")
+        self.assertTrue(simulator.run(converged=converged(nodeList)) > 3.5)
+
+        # Syncs while the server is offline are skipped
+        nodeList = createNodes(2)
+        addAppRecordDiff(nodeList)
+        sessionID = nodeList[0].createSyncSession(nodeList[1], nodeList[1].instanceID)
+        simulator = NetworkSimulator(Link(latency=1.0))
+        simulator.attach(*nodeList)
+        simulator.goOffline(nodeList[1], 0.0, 10.0)
+        simulator.at(5.0, simulator.sync, nodeList[0], sessionID, "full")
+        simulator.at(15.0, simulator.sync, nodeList[0], sessionID, "full")
+        self.assertAlmostEqual(simulator.run(converged=converged(nodeList)), 18.0, places=2)
+        self.assertEqual((simulator.syncs, simulator.skippedSyncs), (1, 1))
+
+        # A transfer cut by the client going offline is lost from the cut on, and resumes
+        # from its last chunk at the next sync
+        client, server = Node("A"), Node("B")
+        for i in range(20):
+            server.addAppData("record" + str(i), "data " + str(i), "", "")
+        server.serialize(("", ""))
+        server.chunkSize = 2
+        sessionID = client.createSyncSession(server, server.instanceID)
+        simulator = NetworkSimulator(Link(latency=0.1, bandwidth=200))
+        simulator.attach(client, server)
+        simulator.goOffline(client, 2.0, 3.0)
+        simulator.at(0.0, simulator.sync, client, sessionID, "pull")
+        simulator.at(10.0, simulator.sync, client, sessionID, "pull")
+        self.assertTrue(simulator.run(converged=lambda: len(client.store) == 20) > 10.0)
+        self.assertTrue(simulator.dropped > 0)
+        # Two PULL, nine CHUNK and the DATA, no chunk went through twice
+        self.assertEqual(simulator.delivered, 12)
+        self.assertEqual(client.calcFSIC(("", "")), {"A": 0, "B": 20})
+
+        # Pulls into a budget over a lossy link get back the credit of the ones cut off, and
+        # resume them, until every stream is done
+        client, server = Node("A"), Node("B")
+        for i in range(200):
+            server.addAppData("record" + str(i), "data " + str(i), "", "")
+        server.serialize(("", ""))
+        server.chunkSize = 5
+        client.incomingBudget = 10
+        sessionID = client.createSyncSession(server, server.instanceID)
+        simulator = NetworkSimulator(Link(loss=0.05), random.Random(1))
+        simulator.attach(client, server)
+        simulator.syncEvery(client, sessionID, 60.0, "pull")
+        self.assertTrue(simulator.run(until=7 * 24 * 3600, converged=lambda: (
+            len(client.store) == 200 and not client.incomingStreams and not server.outgoingStreams)) is not None)
+        self.assertTrue(simulator.dropped > 0)
+        self.assertEqual((client.creditOutstanding, client.sessions[sessionID].checkpoints), (0, {}))
+
+        # Instance IDs sent as strings once go as integers, until the connection breaks
+        message = ("PULL", "x", ("", ""), {"Z": 1})
+        size = simulator.messageSize(client, sessionID, message)
+        self.assertTrue(simulator.messageSize(client, sessionID, message) < size)
+        simulator.breakConnection(sessionID, client, server)
+        self.assertEqual(simulator.messageSize(client, sessionID, message), size)
+
+        # Star under churn, a partition and lossy links converges, the same way for the same seed
+        def runStar(seed):
+            rng = random.Random(seed)
+            nodeList = createNodes(6)
+            addAppRecordDiff(nodeList)
+            simulator = NetworkSimulator(Link(latency=0.3, bandwidth=5000, loss=0.05), rng)
+            simulator.attach(*nodeList)
+            for client, server, sessionID in sessionsStar(nodeList):
+                simulator.syncEvery(nodeList[client], sessionID, 60.0, jitter=10.0)
+                simulator.addChurn(nodeList[client], 600.0, 300.0)
+            simulator.partition([nodeList[:2], nodeList[2:]], 0.0, 1800.0)
+            return (simulator.run(until=7 * 24 * 3600, converged=converged(nodeList)), simulator.statistics())
+
+        convergedAt, statistics = runStar(1)
+        self.assertTrue(convergedAt is not None and convergedAt > 1800.0)
+        self.assertEqual(runStar(1), (convergedAt, statistics))
+
+    def test_gossipScheduler(self):
+        # Every client pushes to the center once, which then holds everything and gets it to
+        # the clients not synced since : the least a star can converge in
+        for seed in range(5):
+            self.assertEqual(eventualStarDiffBi(5, random.Random(seed), GossipScheduler), 2 * 4 - 1)
+
+        # Fewer syncs than picking sessions at random, in every experiment
+        for experiment in (eventualFullDiff, eventualFullMerge, eventualStarDiff, eventualStarDiffBi):
+            randomSyncs = sum(experiment(6, random.Random(seed)) for seed in range(10))
+            gossipSyncs = sum(experiment(6, random.Random(seed), GossipScheduler) for seed in range(10))
+            self.assertTrue(gossipSyncs < randomSyncs)
+        self.assertTrue(eventualFullDiffBi(6, 50, 1, 5, random.Random(1), GossipScheduler) > 0)
+
+        # Once the FSICs exchanged show nothing left to transfer, the session synced longest ago goes next
+        nodeList = createNodes(3)
+        addAppRecordDiff(nodeList)
+        sessionInfo = sessionsRing(nodeList)
+        scheduler = GossipScheduler(nodeList, sessionInfo, ("full",), random.Random(1))
+        for j in range(2):
+            for index in range(len(sessionInfo)):
+                fullDBReplication(nodeList[sessionInfo[index][0]], sessionInfo[index][2])
+                scheduler.synced(index)
+        self.assertEqual(endConditionData(nodeList), False)
+        self.assertEqual(scheduler.delta(0, 1), 0)
+        self.assertEqual(scheduler.next(), (0, "full"))
+        scheduler.failed(0)
+        self.assertEqual(scheduler.next(), (1, "full"))
 
     def test_eventualConsistencyRing(self):
         """
@@ -453,15 +1510,15 @@ class Test(unittest.TestCase):
         ringSize = self.RINGSIZE
         print(str(ringSize) + " Nodes arranged in ring topology")
 
-        nodeList = self.createNodes(ringSize)
-        self.addAppRecordDiff(nodeList)
+        nodeList = createNodes(ringSize)
+        addAppRecordDiff(nodeList)
 
         # i client , i+1 server
-        sessIDlist = self.sessionsRing(nodeList)
+        sessIDlist = sessionsRing(nodeList)
 
         for j in range(2):
             for i in range(ringSize):
-                self.fullDBReplication(nodeList[sessIDlist[i][0]], sessIDlist[i][2])
+                fullDBReplication(nodeList[sessIDlist[i][0]], sessIDlist[i][2])
 
                 # Print statements
                 if i == ringSize - 1:
@@ -470,7 +1527,7 @@ class Test(unittest.TestCase):
                     print("Sync data between " + nodeList[i].instanceID + " and " + nodeList[i + 1].instanceID)
 
         # Asserts to show that all the nodes have the same data
-        self.assertEqual(self.endConditionData(nodeList), False)
+        self.assertEqual(endConditionData(nodeList), False)
 
     def test_eventualConsistencyStar(self):
         """
@@ -481,34 +1538,34 @@ class Test(unittest.TestCase):
         starSize = self.STARSIZE
         print(str(starSize) + " Nodes arranged in star topology")
 
-        nodeList = self.createNodes(starSize)
-        self.addAppRecordDiff(nodeList)
-        sessIDlist = self.sessionsStar(nodeList)
+        nodeList = createNodes(starSize)
+        addAppRecordDiff(nodeList)
+        sessIDlist = sessionsStar(nodeList)
 
         for j in range(2):
             for i in range(starSize - 1):
-                self.fullDBReplication(nodeList[sessIDlist[i][0]], sessIDlist[i][2])
+                fullDBReplication(nodeList[sessIDlist[i][0]], sessIDlist[i][2])
 
                 # Print statements
                 print("Sync data between " + nodeList[i].instanceID + " and " + nodeList[starSize - 1].instanceID)
 
         # Asserts to show that all the nodes have the same data
-        self.assertEqual(self.endConditionData(nodeList), False)
+        self.assertEqual(endConditionData(nodeList), False)
 
     def test_eventualRingRandom(self):
         ringSize = self.RINGRANDOMSIZE
-        nodeList = self.createNodes(ringSize)
-        self.addAppRecordMerge(nodeList)
-        sessionInfo = self.sessionsRing(nodeList)
+        nodeList = createNodes(ringSize)
+        addAppRecordMerge(nodeList)
+        sessionInfo = sessionsRing(nodeList)
 
         loop = 0
-        while self.endConditionMerge(nodeList):
+        while endConditionMerge(nodeList):
             nextExchange = [x for x in range(ringSize)]
             while len(nextExchange) > 0:
                 index = random.randint(0, len(nextExchange) - 1)
                 sess = sessionInfo[nextExchange[index]]
                 # Full DB replication
-                self.fullDBReplication(nodeList[sess[0]], sess[2])
+                fullDBReplication(nodeList[sess[0]], sess[2])
                 self.assertEqual(nodeList[sess[0]].store["id"].lastSavedByHistory, \
                                  nodeList[sess[1]].store["id"].lastSavedByHistory)
                 del nextExchange[index]
@@ -516,84 +1573,18 @@ class Test(unittest.TestCase):
         print(loop)
         self.assertLessEqual(loop, ringSize * ringSize)
 
-    def eventualFullMerge(self, networkSize):
-        nodeList = self.createNodes(networkSize)
-        self.addAppRecordMerge(nodeList)
-        sessionInfo = self.sessionsFull(nodeList)
-
-        total = 0
-        while self.endConditionMerge(nodeList):
-            index = random.randint(0, len(sessionInfo) - 1)
-            nodeList[sessionInfo[index][0]].pullInitiation(sessionInfo[index][2], \
-                                                           ("", ""))
-            total = total + 1
-        return total
-
     def test_multipleEventualFullMerge(self):
         temp = []
         with open("mergeStats", "a+") as f:
             for j in range(3, 10):
                 for i in range(10):
-                    temp.append(self.eventualFullMerge(j))
+                    temp.append(eventualFullMerge(j))
                 f.write(str(j))
                 f.write("\n")
                 f.write(str(temp))
                 f.write("\n")
                 del temp[:]
 
-    def eventualFullDiff(self, networkSize):
-        nodeList = self.createNodes(networkSize)
-        self.addAppRecordDiff(nodeList)
-        sessionInfo = self.sessionsFull(nodeList)
-
-        total = 0
-        while self.endConditionData(nodeList):
-            index = random.randint(0, len(sessionInfo) - 1)
-            nodeList[sessionInfo[index][0]].pullInitiation(sessionInfo[index][2], \
-                                                           ("", ""))
-            total = total + 1
-        return total
-
-    def createOffline(self, nodeList, percentage):
-        numOffline = int((len(nodeList) * percentage) / 100)
-        offline = set([])
-        nodes = [x for x in range(len(nodeList))]
-        for i in range(numOffline):
-            offlineNode = random.randint(0, len(nodes) - 1)
-            offline.add(nodes[offlineNode])
-            del nodes[offlineNode]
-        return offline
-
-    def createRandomRange(self, start, end):
-        time = random.randint(1, end - start)
-        return (start, start + time)
-
-    def isOffline(self, client, server, offline, total, start, end):
-        if (((client in offline) or (server in offline)) and total > start and total < end):
-            return True
-        else:
-            return False
-
-    def eventualFullDiffBi(self, networkSize, percentage, start, end):
-        nodeList = self.createNodes(networkSize)
-        self.addAppRecordDiff(nodeList)
-        sessionInfo = self.sessionsFull(nodeList)
-
-        offline = self.createOffline(nodeList, percentage)
-        total = 0
-        # print offline
-        # print "start " + str(start) + " end " + str(end)
-        while self.endConditionData(nodeList):
-            index = random.randint(0, len(sessionInfo) - 1)
-            client = sessionInfo[index][0]
-            server = sessionInfo[index][1]
-
-            if not (self.isOffline(client, server, offline, total, start, end)):
-                # Full DB replication
-                self.fullDBReplication(nodeList[client], sessionInfo[index][2])
-                total = total + 1
-        return total
-
     def test_eventualFullDiff(self):
         with open("rand", "a+") as f:
             temp = []
@@ -601,50 +1592,58 @@ class Test(unittest.TestCase):
                 print(j)
                 f.write(str(j))
                 f.write("\n")
-                (start, end) = self.createRandomRange(1, 5)
+                (start, end) = createRandomRange(1, 5)
                 for k in range(5):
                     for i in range(10):
-                        temp.append(self.eventualFullDiffBi(j, k * 10, start, end))
+                        temp.append(eventualFullDiffBi(j, k * 10, start, end))
                     f.write(str(temp))
                     f.write("\n")
                     del temp[:]
 
-    def eventualStarDiff(self, starSize):
-        nodeList = self.createNodes(starSize)
-        self.addAppRecordDiff(nodeList)
-        sessionInfo = self.sessionsStar(nodeList)
-
-        total = 0
-        while self.endConditionData(nodeList):
-            index = random.randint(0, len(sessionInfo) - 1)
-            pushPull = random.randint(0, 1)
-            # Randomly choose between push and pull
-            if pushPull:
-                nodeList[sessionInfo[index][0]].pullInitiation(sessionInfo[index][2], ("", ""))
-            else:
-                nodeList[sessionInfo[index][0]].pushInitiation(sessionInfo[index][2], ("", ""))
-            total = total + 1
-        return total
-
-    def eventualStarDiffBi(self, starSize):
-        nodeList = self.createNodes(starSize)
-        self.addAppRecordDiff(nodeList)
-        sessionInfo = self.sessionsStar(nodeList)
-
-        total = 0
-        while self.endConditionData(nodeList):
-            index = random.randint(0, len(sessionInfo) - 1)
-            # Full DB replication
-            self.fullDBReplication(nodeList[sessionInfo[index][0]], sessionInfo[index][2])
-            total = total + 1
-        return total
+    def test_experimentRunner(self):
+        output = tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False)
+        output.close()
+        try:
+            results = runExperiment("starDiffBi", [3, 4], 3, seed=7, workers=2, output=output.name)
+            with open(output.name) as f:
+                written = [json.loads(line) for line in f]
+            # Same seed gives the same trials, with a different number of workers too
+            again = runExperiment("starDiffBi", [3, 4], 3, seed=7, workers=1)
+        finally:
+            os.remove(output.name)
+
+        self.assertEqual([(r["size"], r["trial"]) for r in written], [(3, 0), (3, 1), (3, 2), (4, 0), (4, 1), (4, 2)])
+        self.assertEqual([r["messages"] for r in written], [r["messages"] for r in results])
+        self.assertEqual([(r["seed"], r["messages"]) for r in results], [(r["seed"], r["messages"]) for r in again])
+        self.assertEqual(len(set(r["seed"] for r in results)), 6)
+        self.assertRaises(ValueError, lambda: runExperiment("ringDiff", [3], 1))
+
+    def test_benchmarkSuite(self):
+        self.assertEqual(sweepScenarios((10, 100), (2, 5), (1,), (100, 5, 1)),
+                         [(10, 5, 1), (100, 5, 1), (100, 2, 1)])
+        output = tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False)
+        output.close()
+        try:
+            results = runSuite([(60, 3, 4)], repeat=1, output=output.name, label="test")
+            written = readResults(output.name)
+        finally:
+            os.remove(output.name)
+
+        self.assertEqual(written, results)
+        self.assertEqual(sorted(r["benchmark"] for r in results), sorted(BENCHMARKS))
+        operations = dict((r["benchmark"], r["operations"]) for r in results)
+        self.assertEqual((operations["pullInitiation"], operations["fsicDiffAndSnapshot"],
+                          operations["fsicDiffAndSnapshotPartition"], operations["calcFSIC"]), (60, 6, 15, 5))
+        comparison = compareResults(results, results)
+        self.assertEqual([ratio for key, before, after, ratio in comparison], [1.0] * len(BENCHMARKS))
+        self.assertRaises(ValueError, lambda: runSuite([(10, 2, 1)], ["sort"]))
 
     def test_multipleEventualStarDiff(self):
         temp = []
         with open("rand2", "a+") as f:
             for j in range(4):
                 for i in range(1):
-                    temp.append(self.eventualStarDiffBi(j))
+                    temp.append(eventualStarDiffBi(j))
                 print(j)
                 f.write(str(j))
                 f.write("\n")
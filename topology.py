@@ -0,0 +1,254 @@
+"""
+Builds networks of nodes in ring, star and full-mesh topologies and runs the
+random convergence experiments on them. Functions drawing random numbers take
+an rng argument (the random module by default) so that a trial can be replayed
+from its seed. The experiments pick the sessions to sync with a scheduler class,
+see gossipScheduler, uniformly at random by default.
+"""
+from __future__ import print_function, unicode_literals
+
+import random
+
+from gossipScheduler import RandomScheduler
+from simulateNode import Node
+
+
+def createNodes(size):
+    """
+    Creates size number of nodes and puts it in a list.
+    """
+    nodeList = []
+    for i in range(size):
+        nodeList.append(Node(str(i)))
+    return nodeList
+
+
+def addAppRecordMerge(nodeList):
+    """
+    Adds an application record to each node in the nodeList such that
+    they create a merge conflict among each other. i.e their IDs are same but
+    different data.
+    """
+    for i in range(len(nodeList)):
+        nodeList[i].addAppData("id", "data " + nodeList[i].instanceID, "", "")
+        nodeList[i].serialize(("", ""))
+
+
+def addAppRecordDiff(nodeList):
+    """
+    Adds an application record to each node in the nodelist such that they have different recordIDs
+    """
+    for i in range(len(nodeList)):
+        nodeList[i].addAppData("record" + nodeList[i].instanceID, "recordData" + \
+                               nodeList[i].instanceID, "", "")
+        nodeList[i].serialize(("", ""))
+
+
+def endConditionData(nodeList):
+    """
+    End Condition : if all the nodes posses same set of data
+    Return True if the end condition is not met
+    Returns False if end condition is met
+    """
+    data = set([])
+    for i in range(len(nodeList)):
+        for k, v in nodeList[i].store.items():
+            data.add(v.recordID)
+
+    for i in range(len(nodeList)):
+        if len(nodeList[i].store) != len(data):
+            return True
+        else:
+            for m in data:
+                if not m in nodeList[i].store:
+                    return True
+
+    return False
+
+
+def endConditionMerge(nodeList):
+    """
+    End Condition : if all the nodes posses same data with same lastSavedByHistory
+    Return True if the end condition is not met
+    Returns False if end condition is met
+    """
+    data = nodeList[0].store["id"].lastSavedByHistory
+    for i in range(1, len(nodeList)):
+        if nodeList[i].store["id"].lastSavedByHistory != data:
+            return True
+    return False
+
+
+def fullDBReplication(clientHandler, sessionID):
+    # Client pulling server's data
+    clientHandler.pullInitiation(sessionID, ("", ""))
+    # Client pushing data to server
+    clientHandler.pushInitiation(sessionID, ("", ""))
+
+
+def fullDBSync(clientHandler, sessionID):
+    # Pull and push in a single round trip
+    clientHandler.syncInitiation(sessionID, ("", ""))
+
+
+def syncSession(nodeList, session, direction):
+    """
+    Syncs a (client, server, sessionID) session in direction "pull", "push" or "full"
+    """
+    client, server, sessionID = session
+    if direction == "pull":
+        nodeList[client].pullInitiation(sessionID, ("", ""))
+    elif direction == "push":
+        nodeList[client].pushInitiation(sessionID, ("", ""))
+    else:
+        fullDBReplication(nodeList[client], sessionID)
+
+
+def sessionsRing(nodeList):
+    """
+    Establishes sync sessions between any 2 adjacent nodes and stores in an array
+    """
+    sessIDlist = []
+    # Create sync sessions and store session IDs in a list
+    ringSize = len(nodeList)
+    for i in range(ringSize):
+        if i == ringSize - 1:
+            sessIDlist.append((i, 0, nodeList[i].createSyncSession(nodeList[0], nodeList[0].instanceID)))
+        else:
+            sessIDlist.append(
+                (i, i + 1, nodeList[i].createSyncSession(nodeList[i + 1], nodeList[i + 1].instanceID)))
+    return sessIDlist
+
+
+def sessionsStar(nodeList):
+    # i client , len(nodeList)-1 server
+    sessIDlist = []
+    starSize = len(nodeList)
+    # Create sync sessions and store session IDs in a list
+    for i in range(starSize - 1):
+        sessIDlist.append((i, starSize - 1, nodeList[i].createSyncSession(nodeList[starSize - 1], \
+                                                                          nodeList[starSize - 1].instanceID)))
+    return sessIDlist
+
+
+def sessionsFull(nodeList):
+    """
+    Establishes sync session between any 2 nodes in the network,
+    returns array with all these details
+    """
+    sessIDlist = []
+    for i in range(len(nodeList)):
+        for j in range(len(nodeList)):
+            if (i != j):
+                sessIDlist.append((i, j, (nodeList[i].createSyncSession(nodeList[j], nodeList[j].instanceID))))
+    return sessIDlist
+
+
+def eventualFullMerge(networkSize, rng=random, scheduler=RandomScheduler):
+    nodeList = createNodes(networkSize)
+    addAppRecordMerge(nodeList)
+    sessionInfo = sessionsFull(nodeList)
+    scheduler = scheduler(nodeList, sessionInfo, ("pull",), rng)
+
+    total = 0
+    while endConditionMerge(nodeList):
+        index, direction = scheduler.next()
+        syncSession(nodeList, sessionInfo[index], direction)
+        scheduler.synced(index)
+        total = total + 1
+    return total
+
+
+def eventualFullDiff(networkSize, rng=random, scheduler=RandomScheduler):
+    nodeList = createNodes(networkSize)
+    addAppRecordDiff(nodeList)
+    sessionInfo = sessionsFull(nodeList)
+    scheduler = scheduler(nodeList, sessionInfo, ("pull",), rng)
+
+    total = 0
+    while endConditionData(nodeList):
+        index, direction = scheduler.next()
+        syncSession(nodeList, sessionInfo[index], direction)
+        scheduler.synced(index)
+        total = total + 1
+    return total
+
+
+def createOffline(nodeList, percentage, rng=random):
+    numOffline = int((len(nodeList) * percentage) / 100)
+    offline = set([])
+    nodes = [x for x in range(len(nodeList))]
+    for i in range(numOffline):
+        offlineNode = rng.randint(0, len(nodes) - 1)
+        offline.add(nodes[offlineNode])
+        del nodes[offlineNode]
+    return offline
+
+
+def createRandomRange(start, end, rng=random):
+    time = rng.randint(1, end - start)
+    return (start, start + time)
+
+
+def isOffline(client, server, offline, total, start, end):
+    if (((client in offline) or (server in offline)) and total > start and total < end):
+        return True
+    else:
+        return False
+
+
+def eventualFullDiffBi(networkSize, percentage, start, end, rng=random, scheduler=RandomScheduler):
+    nodeList = createNodes(networkSize)
+    addAppRecordDiff(nodeList)
+    sessionInfo = sessionsFull(nodeList)
+
+    offline = createOffline(nodeList, percentage, rng)
+    scheduler = scheduler(nodeList, sessionInfo, ("full",), rng)
+    total = 0
+    # print offline
+    # print "start " + str(start) + " end " + str(end)
+    while endConditionData(nodeList):
+        index, direction = scheduler.next()
+        client = sessionInfo[index][0]
+        server = sessionInfo[index][1]
+
+        if not (isOffline(client, server, offline, total, start, end)):
+            # Full DB replication
+            syncSession(nodeList, sessionInfo[index], direction)
+            scheduler.synced(index)
+            total = total + 1
+        else:
+            scheduler.failed(index)
+    return total
+
+
+def eventualStarDiff(starSize, rng=random, scheduler=RandomScheduler):
+    nodeList = createNodes(starSize)
+    addAppRecordDiff(nodeList)
+    sessionInfo = sessionsStar(nodeList)
+    # Randomly choose between push and pull
+    scheduler = scheduler(nodeList, sessionInfo, ("push", "pull"), rng)
+
+    total = 0
+    while endConditionData(nodeList):
+        index, direction = scheduler.next()
+        syncSession(nodeList, sessionInfo[index], direction)
+        scheduler.synced(index)
+        total = total + 1
+    return total
+
+
+def eventualStarDiffBi(starSize, rng=random, scheduler=RandomScheduler):
+    nodeList = createNodes(starSize)
+    addAppRecordDiff(nodeList)
+    sessionInfo = sessionsStar(nodeList)
+    scheduler = scheduler(nodeList, sessionInfo, ("full",), rng)
+
+    total = 0
+    while endConditionData(nodeList):
+        index, direction = scheduler.next()
+        # Full DB replication
+        syncSession(nodeList, sessionInfo[index], direction)
+        scheduler.synced(index)
+        total = total + 1
+    return total
@@ -0,0 +1,283 @@
+"""
+Record and replay of the messages exchanged by Nodes.
+
+TraceRecorder is a transport writing every message sent by the nodes attached to it to a
+trace file, then delivering it synchronously or through the transport it wraps. The
+trace starts with the state of each attached node : its settings, syncDataStructure and
+store records. replayTrace rebuilds those nodes fresh and hands every recorded message
+to its receiver in the recorded order, at full speed. Messages the replayed nodes send
+in response are counted and dropped, the trace already holds what was sent. This gives
+every node the same input as during the recording, to profile it or to compare store
+engines and revisions on it.
+
+Only received messages are replayed. Provided no local changes were made while recording,
+the replayed nodes end with the same store, syncDataStructure and counter as the recorded
+ones. State a node creates itself is not restored : addAppData and serialize calls, the
+checkpoints of the transfers it asked for, the credit of its incoming streams, and Merkle
+trees, so Merkle pulls cannot be replayed.
+
+A trace is a header followed by entries, each a varint length and a payload starting
+with the entry type. Messages are in the wire format, one stream per sender and session.
+Node and session IDs are interned over the whole trace.
+    NODE     instance ID, settings as JSON, syncDataStructure, store records
+    SESSION  session ID, client, server, compression, compression threshold,
+             incoming budgets of the client and the server
+    MESSAGE  microseconds since the recording started, sender, receiver, session ID, message
+"""
+from __future__ import print_function, unicode_literals
+
+import json
+import threading
+import timeit
+
+from simulateNode import Node
+from storeEngine import MemoryStoreEngine
+from syncSession import SyncSession
+from wireFormat import Reader, WireDecoder, WireEncoder, WireFormatError, writeVarint
+
+TRACE_HEADER = b"MORANGO-TRACE 1\n"
+
+NODE = 1
+SESSION = 2
+MESSAGE = 3
+
+# Node attributes changing how it syncs, saved with its state
+SETTINGS = ("chunkSize", "merkleDepth", "manifestMode", "incomingBudget")
+
+
+def writeOptionalVarint(out, value):
+    # 0 stands for None, otherwise the value is shifted by one
+    writeVarint(out, 0 if value is None else value + 1)
+
+
+def readOptionalVarint(reader):
+    value = reader.readVarint()
+    return None if value == 0 else value - 1
+
+
+class TraceRecorder(object):
+
+    def __init__(self, path, transport=None):
+        """
+        Constructor
+        path      : trace file to write
+        transport : transport delivering the messages once recorded, None delivers them synchronously
+        """
+        self.file = open(path, "wb")
+        self.file.write(TRACE_HEADER)
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.start = timeit.default_timer()
+        # Interns node and session IDs, and encodes node states
+        self.meta = WireEncoder()
+        # (sender instance ID, sessionID) -> encoder of the messages of that stream
+        self.encoders = {}
+        self.sessions = set()
+        self.messages = 0
+
+    def writeEntry(self, payload):
+        out = bytearray()
+        writeVarint(out, len(payload))
+        out.extend(payload)
+        self.file.write(out)
+
+    def attach(self, *nodes):
+        """
+        Records the current state of nodes and routes the messages they send through the recorder
+        """
+        with self.lock:
+            for node in nodes:
+                with node.lock.reading():
+                    out = bytearray([NODE])
+                    self.meta.writeInstance(out, node.instanceID)
+                    self.meta.writeString(out, json.dumps(dict((name, getattr(node, name)) for name in SETTINGS),
+                                                          sort_keys=True))
+                    writeVarint(out, len(node.syncDataStructure))
+                    for filter, fsic in node.syncDataStructure.items():
+                        self.meta.writeString(out, filter)
+                        self.meta.writeFSIC(out, fsic)
+                    self.meta.writeRecords(out, list(node.store.values()))
+                self.writeEntry(out)
+                node.transport = self
+
+    def recordSession(self, sender, receiver, sessionID):
+        """
+        Writes the settings of a session the first time one of its messages is sent
+        """
+        session = sender.sessions[sessionID]
+        if session.serverInstance is not None:
+            client, server, clientSession, serverSession = sender, receiver, session, receiver.sessions[sessionID]
+        else:
+            client, server, clientSession, serverSession = receiver, sender, receiver.sessions[sessionID], session
+        out = bytearray([SESSION])
+        self.meta.writeInstance(out, sessionID)
+        self.meta.writeInstance(out, client.instanceID)
+        self.meta.writeInstance(out, server.instanceID)
+        self.meta.writeOptionalString(out, session.compression)
+        writeVarint(out, session.compressionThreshold)
+        writeOptionalVarint(out, serverSession.peerBudget)
+        writeOptionalVarint(out, clientSession.peerBudget)
+        self.writeEntry(out)
+        self.sessions.add(sessionID)
+
+    def send(self, sender, receiver, sessionID, data):
+        """
+        Called by Node.send, records the message and delivers it
+        """
+        with self.lock:
+            if sessionID not in self.sessions:
+                self.recordSession(sender, receiver, sessionID)
+            key = (sender.instanceID, sessionID)
+            if key not in self.encoders:
+                self.encoders[key] = WireEncoder()
+            out = bytearray([MESSAGE])
+            writeVarint(out, int((timeit.default_timer() - self.start) * 1e6))
+            self.meta.writeInstance(out, sender.instanceID)
+            self.meta.writeInstance(out, receiver.instanceID)
+            self.meta.writeInstance(out, sessionID)
+            out.extend(self.encoders[key].encodePayload(data))
+            self.writeEntry(out)
+            self.messages = self.messages + 1
+
+        if self.transport is not None:
+            self.transport.send(sender, receiver, sessionID, data)
+        else:
+            receiver.receive(sender, sessionID, data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def readEntries(path):
+    """
+    Yields the payloads of the entries of a trace
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(TRACE_HEADER):
+        raise WireFormatError("Not a trace file : " + path)
+    reader = Reader(data, len(TRACE_HEADER))
+    while reader.position < len(data):
+        yield reader.readBytes(reader.readVarint())
+
+
+class TraceReplayer(object):
+    """
+    Transport of the replayed nodes, dropping the messages they send
+    """
+
+    def __init__(self, storeEngine=None):
+        """
+        Constructor
+        storeEngine : optional factory called with an instance ID, giving the store engine of a replayed node
+        """
+        self.storeEngine = storeEngine
+        self.nodes = {}
+        self.meta = WireDecoder()
+        # (sender instance ID, sessionID) -> decoder of the messages of that stream
+        self.decoders = {}
+        self.replayed = 0
+        self.dropped = 0
+        # Messages whose handling raised, by message type
+        self.errors = {}
+        self.recordedSeconds = 0.0
+        # Time taken by the replay, of which restoring the nodes' state and handling the messages
+        self.seconds = 0.0
+        self.restoreSeconds = 0.0
+        self.receiveSeconds = 0.0
+
+    def send(self, sender, receiver, sessionID, data):
+        self.dropped = self.dropped + 1
+
+    def node(self, instanceID):
+        """
+        Replayed node of instanceID, a fresh empty one if the trace holds no state for it
+        """
+        if instanceID not in self.nodes:
+            self.nodes[instanceID] = Node(instanceID, self.storeEngine(instanceID) if self.storeEngine else None)
+            self.nodes[instanceID].transport = self
+        return self.nodes[instanceID]
+
+    def restoreNode(self, reader):
+        instanceID = self.meta.readInstance(reader)
+        settings = json.loads(self.meta.readString(reader))
+        syncDataStructure = {}
+        for i in range(reader.readVarint()):
+            filter = self.meta.readString(reader)
+            syncDataStructure[filter] = self.meta.readFSIC(reader)
+        store = self.storeEngine(instanceID) if self.storeEngine else MemoryStoreEngine()
+        with store.transaction():
+            for record in self.meta.readRecords(reader):
+                store.addRecord(record)
+        node = Node(instanceID, store)
+        for filter, fsic in syncDataStructure.items():
+            node.updateSyncDS(dict(fsic), filter)
+        node.counter = node.syncDataStructure["+"][node.instanceID]
+        for name, value in settings.items():
+            setattr(node, name, value)
+        node.transport = self
+        self.nodes[instanceID] = node
+
+    def restoreSession(self, reader):
+        sessionID = self.meta.readInstance(reader)
+        client = self.node(self.meta.readInstance(reader))
+        server = self.node(self.meta.readInstance(reader))
+        compression = self.meta.readOptionalString(reader)
+        threshold = reader.readVarint()
+        clientBudget = readOptionalVarint(reader)
+        serverBudget = readOptionalVarint(reader)
+
+        clientSession = SyncSession(sessionID, None, server, compression, threshold)
+        clientSession.peerBudget = serverBudget
+        client.sessions[sessionID] = clientSession
+        serverSession = SyncSession(sessionID, client, None, compression, threshold)
+        serverSession.peerBudget = clientBudget
+        server.sessions[sessionID] = serverSession
+
+    def replay(self, path, strict=False):
+        """
+        Replays the trace at path. With strict set, a message raising stops the replay,
+        otherwise it is counted in errors and the replay goes on.
+        """
+        start = timeit.default_timer()
+        for payload in readEntries(path):
+            reader = Reader(payload)
+            entryType = reader.readByte()
+            if entryType == NODE:
+                restoreStart = timeit.default_timer()
+                self.restoreNode(reader)
+                self.restoreSeconds = self.restoreSeconds + timeit.default_timer() - restoreStart
+            elif entryType == SESSION:
+                self.restoreSession(reader)
+            elif entryType == MESSAGE:
+                self.recordedSeconds = reader.readVarint() / 1e6
+                sender = self.node(self.meta.readInstance(reader))
+                receiver = self.node(self.meta.readInstance(reader))
+                sessionID = self.meta.readInstance(reader)
+                key = (sender.instanceID, sessionID)
+                if key not in self.decoders:
+                    self.decoders[key] = WireDecoder()
+                message = self.decoders[key].decodePayload(bytes(payload[reader.position:]))
+                self.replayed = self.replayed + 1
+                receiveStart = timeit.default_timer()
+                try:
+                    receiver.receive(sender, sessionID, message)
+                except Exception:
+                    if strict:
+                        raise
+                    self.errors[message[0]] = self.errors.get(message[0], 0) + 1
+                self.receiveSeconds = self.receiveSeconds + timeit.default_timer() - receiveStart
+            else:
+                raise WireFormatError("Unknown trace entry type : " + str(entryType))
+        self.seconds = timeit.default_timer() - start
+        return self.nodes
+
+
+def replayTrace(path, storeEngine=None, strict=False):
+    """
+    Replays the trace at path into fresh nodes, returns the TraceReplayer holding them and the figures of the replay
+    """
+    replayer = TraceReplayer(storeEngine)
+    replayer.replay(path, strict)
+    return replayer
@@ -0,0 +1,49 @@
+"""
+A version vector maps instance IDs to the highest counter seen from that instance.
+It is a dict, so it compares equal to plain dicts with the same entries, and adds
+in-place merging and dominance checks which allocate nothing.
+"""
+from __future__ import print_function, unicode_literals
+
+
+class VersionVector(dict):
+    # Every record history is one, no instance dict
+    __slots__ = ()
+
+    def mergeMax(self, *others):
+        """
+        Raises every entry to the maximum found in self and others, in place.
+        Returns self so merges can be chained.
+        """
+        for other in others:
+            for instanceID, counter in other.items():
+                if instanceID not in self or self[instanceID] < counter:
+                    self[instanceID] = counter
+        return self
+
+    def covers(self, instanceID, counter):
+        """
+        True if the version saved by instanceID at counter is included in this vector
+        """
+        return instanceID in self and self[instanceID] >= counter
+
+    def dominates(self, other):
+        """
+        True if every version included in other is included in this vector
+        """
+        for instanceID, counter in other.items():
+            if instanceID not in self or self[instanceID] < counter:
+                return False
+        return True
+
+    def copy(self):
+        return VersionVector(self)
+
+
+def asVersionVector(vector):
+    """
+    Returns vector itself if it already is a VersionVector, a VersionVector copy otherwise
+    """
+    if isinstance(vector, VersionVector):
+        return vector
+    return VersionVector(vector)
@@ -0,0 +1,426 @@
+"""
+Compact binary encoding of the messages exchanged through Node.send.
+
+A stream is a sequence of frames, each one a varint payload length followed by the
+payload. A payload starts with a message type byte followed by the fields of the
+message. Counters and lengths are unsigned LEB128 varints. Instance IDs are interned
+per stream : the first occurrence is sent as a string and later ones as the small
+integer it was given, so an encoder and its decoder must see the same frames in the
+same order. Both can start from the instance table exchanged at handshake, in which
+case the instances it holds are never sent as strings.
+
+The records of DATA and CHUNK messages are either a plain list or a CompressedRecords
+block, in which case their recordData travels in the block payload.
+
+Messages :
+    ("PULL", pullID, filter, fsic)
+    ("PUSH", pushID, filter)
+    ("PUSH2", pushID, filter, fsic)
+    ("DATA", pushPullID, (filter, (changes, records)))
+    ("CHUNK", pushPullID, (filter, records), checkpoint)
+    ("MERKLE", pullID, filter, fsic, depth, level, hashes)
+    ("MERKLE2", pullID, level, buckets)
+    ("MANIFEST", pushPullID, (filter, (changes, [(recordID, instanceID, counter), ...])))
+    ("FETCH", pushPullID, indexes)
+    ("SYNC", syncID, filter, fsic)
+    ("SYNCDATA", syncID, (filter, (changes, records)), fsic)
+    ("CREDIT", pushPullID, records)
+
+The checkpoint of a CHUNK is the FSIC the receiver reaches once it has integrated the chunk.
+A CREDIT lets the sender of a snapshot send that many more records of it.
+
+The indexes of a FETCH are increasing positions in the manifest, sent as the gaps between them.
+
+Merkle hashes are sent as 8 bytes each, keyed by their bucket number.
+"""
+from __future__ import print_function, unicode_literals
+
+from payloadCompression import CompressedRecords
+from storeRecord import StoreRecord, internString
+from versionVector import VersionVector
+
+PULL = 1
+PUSH = 2
+PUSH2 = 3
+DATA = 4
+CHUNK = 5
+MERKLE = 6
+MERKLE2 = 7
+MANIFEST = 8
+FETCH = 9
+SYNC = 10
+SYNCDATA = 11
+CREDIT = 12
+
+MESSAGE_TYPES = {"PULL": PULL, "PUSH": PUSH, "PUSH2": PUSH2, "DATA": DATA, "CHUNK": CHUNK, "MERKLE": MERKLE,
+                 "MERKLE2": MERKLE2, "MANIFEST": MANIFEST, "FETCH": FETCH, "SYNC": SYNC, "SYNCDATA": SYNCDATA,
+                 "CREDIT": CREDIT}
+
+# Tags of the records field
+RECORD_LIST = 0
+COMPRESSED_RECORDS = 1
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+def messageRecords(message):
+    """
+    Number of records carried by a message
+    """
+    if message[0] in ("DATA", "SYNCDATA"):
+        return len(message[2][1][1])
+    elif message[0] == "CHUNK":
+        return len(message[2][1])
+    return 0
+
+
+def writeVarint(out, value):
+    """
+    Appends an unsigned LEB128 varint to the bytearray out
+    """
+    if value < 0:
+        raise WireFormatError("Varints cannot be negative : " + str(value))
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value = value >> 7
+    out.append(value)
+
+
+class Reader(object):
+    """
+    Reads the fields of a single payload
+    """
+
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def readByte(self):
+        if self.position >= len(self.data):
+            raise WireFormatError("Truncated payload")
+        value = self.data[self.position]
+        self.position = self.position + 1
+        return value
+
+    def readVarint(self):
+        # Most counters and lengths fit in a single byte
+        if self.position < len(self.data) and self.data[self.position] < 0x80:
+            self.position = self.position + 1
+            return self.data[self.position - 1]
+        result = 0
+        shift = 0
+        while True:
+            byte = self.readByte()
+            result = result | ((byte & 0x7f) << shift)
+            if not byte & 0x80:
+                return result
+            shift = shift + 7
+
+    def readBytes(self, length):
+        if self.position + length > len(self.data):
+            raise WireFormatError("Truncated payload")
+        value = self.data[self.position:self.position + length]
+        self.position = self.position + length
+        return value
+
+
+class WireEncoder(object):
+    """
+    Encodes messages into frames. Keep one encoder per stream.
+    """
+
+    def __init__(self, instances=()):
+        """
+        Constructor
+        instances : instance IDs the decoder already knows, numbered in order
+        """
+        # Maps instanceID to the integer it was given on this stream
+        self.instances = dict((instanceID, number) for number, instanceID in enumerate(instances))
+
+    def writeString(self, out, value):
+        data = value.encode("utf-8")
+        writeVarint(out, len(data))
+        out.extend(data)
+
+    def writeOptionalString(self, out, value):
+        # 0 stands for None, otherwise the length is shifted by one
+        if value is None:
+            writeVarint(out, 0)
+        else:
+            data = value.encode("utf-8")
+            writeVarint(out, len(data) + 1)
+            out.extend(data)
+
+    def writeInstance(self, out, instanceID):
+        # 0 introduces a new instance ID, otherwise its integer shifted by one
+        if instanceID in self.instances:
+            writeVarint(out, self.instances[instanceID] + 1)
+        else:
+            self.instances[instanceID] = len(self.instances)
+            writeVarint(out, 0)
+            self.writeString(out, instanceID)
+
+    def writeFSIC(self, out, fsic):
+        writeVarint(out, len(fsic))
+        for instanceID, counter in fsic.items():
+            self.writeInstance(out, instanceID)
+            writeVarint(out, counter)
+
+    def writeFilter(self, out, filter):
+        self.writeOptionalString(out, filter[0])
+        self.writeOptionalString(out, filter[1])
+
+    def writeBucketHashes(self, out, hashes):
+        writeVarint(out, len(hashes))
+        for bucket in sorted(hashes):
+            writeVarint(out, bucket)
+            out.extend(bytearray((hashes[bucket] >> shift) & 0xff for shift in range(56, -8, -8)))
+
+    def writeRecord(self, out, record):
+        self.writeString(out, record.recordID)
+        self.writeOptionalString(out, record.recordData)
+        self.writeInstance(out, record.lastSavedByInstance)
+        writeVarint(out, record.lastSavedByCounter)
+        self.writeFSIC(out, record.lastSavedByHistory)
+        self.writeOptionalString(out, record.partitionFacility)
+        self.writeOptionalString(out, record.partitionUser)
+
+    def writeRecords(self, out, records):
+        if isinstance(records, CompressedRecords):
+            writeVarint(out, COMPRESSED_RECORDS)
+            self.writeOptionalString(out, records.codec)
+            writeVarint(out, len(records.payload))
+            out.extend(records.payload)
+            records = records.records
+        else:
+            writeVarint(out, RECORD_LIST)
+        writeVarint(out, len(records))
+        for record in records:
+            self.writeRecord(out, record)
+
+    def encodePayload(self, message):
+        """
+        Returns the payload of a message, without the frame length
+        """
+        if message[0] not in MESSAGE_TYPES:
+            raise WireFormatError("Unknown message type : " + str(message[0]))
+        messageType = MESSAGE_TYPES[message[0]]
+        out = bytearray([messageType])
+        self.writeString(out, message[1])
+
+        if messageType == PULL or messageType == PUSH2 or messageType == SYNC:
+            self.writeFilter(out, message[2])
+            self.writeFSIC(out, message[3])
+        elif messageType == PUSH:
+            self.writeFilter(out, message[2])
+        elif messageType == DATA or messageType == SYNCDATA:
+            filter, (changes, records) = message[2]
+            self.writeFilter(out, filter)
+            self.writeFSIC(out, changes)
+            self.writeRecords(out, records)
+            if messageType == SYNCDATA:
+                self.writeFSIC(out, message[3])
+        elif messageType == CHUNK:
+            filter, records = message[2]
+            self.writeFilter(out, filter)
+            self.writeRecords(out, records)
+            self.writeFSIC(out, message[3])
+        elif messageType == MERKLE:
+            self.writeFilter(out, message[2])
+            self.writeFSIC(out, message[3])
+            writeVarint(out, message[4])
+            writeVarint(out, message[5])
+            self.writeBucketHashes(out, message[6])
+        elif messageType == MERKLE2:
+            writeVarint(out, message[2])
+            writeVarint(out, len(message[3]))
+            for bucket in message[3]:
+                writeVarint(out, bucket)
+        elif messageType == MANIFEST:
+            filter, (changes, manifest) = message[2]
+            self.writeFilter(out, filter)
+            self.writeFSIC(out, changes)
+            writeVarint(out, len(manifest))
+            for recordID, instanceID, counter in manifest:
+                self.writeString(out, recordID)
+                self.writeInstance(out, instanceID)
+                writeVarint(out, counter)
+        elif messageType == FETCH:
+            writeVarint(out, len(message[2]))
+            previous = -1
+            for index in message[2]:
+                if index <= previous:
+                    raise WireFormatError("FETCH indexes must be increasing")
+                writeVarint(out, index - previous - 1)
+                previous = index
+        elif messageType == CREDIT:
+            writeVarint(out, message[2])
+        return out
+
+    def encode(self, message):
+        """
+        Returns the frame of a message
+        """
+        payload = self.encodePayload(message)
+        out = bytearray()
+        writeVarint(out, len(payload))
+        out.extend(payload)
+        return bytes(out)
+
+
+class WireDecoder(object):
+    """
+    Decodes frames back into messages. Data can be fed in arbitrary pieces, complete
+    frames are decoded as soon as they are available. Keep one decoder per stream.
+    """
+
+    def __init__(self, instances=()):
+        """
+        Constructor
+        instances : instance IDs the encoder already knows, numbered in order
+        """
+        # Instance IDs in the order they were introduced on this stream
+        self.instances = [internString(instanceID) for instanceID in instances]
+        self.buffer = bytearray()
+
+    def readString(self, reader):
+        return reader.readBytes(reader.readVarint()).decode("utf-8")
+
+    def readOptionalString(self, reader):
+        length = reader.readVarint()
+        if length == 0:
+            return None
+        return reader.readBytes(length - 1).decode("utf-8")
+
+    def readInstance(self, reader):
+        index = reader.readVarint()
+        if index == 0:
+            instanceID = internString(self.readString(reader))
+            self.instances.append(instanceID)
+            return instanceID
+        if index > len(self.instances):
+            raise WireFormatError("Unknown instance reference : " + str(index))
+        return self.instances[index - 1]
+
+    def readFSIC(self, reader):
+        fsic = VersionVector()
+        for i in range(reader.readVarint()):
+            instanceID = self.readInstance(reader)
+            fsic[instanceID] = reader.readVarint()
+        return fsic
+
+    def readFilter(self, reader):
+        facility = self.readOptionalString(reader)
+        return (facility, self.readOptionalString(reader))
+
+    def readBucketHashes(self, reader):
+        hashes = {}
+        for i in range(reader.readVarint()):
+            bucket = reader.readVarint()
+            value = 0
+            for byte in bytearray(reader.readBytes(8)):
+                value = (value << 8) | byte
+            hashes[bucket] = value
+        return hashes
+
+    def readRecord(self, reader):
+        recordID = self.readString(reader)
+        recordData = self.readOptionalString(reader)
+        instanceID = self.readInstance(reader)
+        counter = reader.readVarint()
+        history = self.readFSIC(reader)
+        facility = self.readOptionalString(reader)
+        return StoreRecord(recordID, recordData, instanceID, counter, history, facility,
+                           self.readOptionalString(reader))
+
+    def readRecords(self, reader):
+        tag = reader.readVarint()
+        if tag == RECORD_LIST:
+            return [self.readRecord(reader) for i in range(reader.readVarint())]
+        elif tag == COMPRESSED_RECORDS:
+            codec = self.readOptionalString(reader)
+            payload = reader.readBytes(reader.readVarint())
+            return CompressedRecords(codec, payload, [self.readRecord(reader) for i in range(reader.readVarint())])
+        raise WireFormatError("Unknown records tag : " + str(tag))
+
+    def decodePayload(self, payload):
+        """
+        Returns the message held in a payload
+        """
+        reader = Reader(payload)
+        messageType = reader.readByte()
+        pushPullID = self.readString(reader)
+
+        if messageType == PULL or messageType == PUSH2:
+            filter = self.readFilter(reader)
+            message = ("PULL" if messageType == PULL else "PUSH2", pushPullID, filter, self.readFSIC(reader))
+        elif messageType == PUSH:
+            message = ("PUSH", pushPullID, self.readFilter(reader))
+        elif messageType == DATA:
+            filter = self.readFilter(reader)
+            changes = self.readFSIC(reader)
+            message = ("DATA", pushPullID, (filter, (changes, self.readRecords(reader))))
+        elif messageType == CHUNK:
+            filter = self.readFilter(reader)
+            records = self.readRecords(reader)
+            message = ("CHUNK", pushPullID, (filter, records), self.readFSIC(reader))
+        elif messageType == SYNC:
+            filter = self.readFilter(reader)
+            message = ("SYNC", pushPullID, filter, self.readFSIC(reader))
+        elif messageType == SYNCDATA:
+            filter = self.readFilter(reader)
+            changes = self.readFSIC(reader)
+            records = self.readRecords(reader)
+            message = ("SYNCDATA", pushPullID, (filter, (changes, records)), self.readFSIC(reader))
+        elif messageType == MERKLE:
+            filter = self.readFilter(reader)
+            fsic = self.readFSIC(reader)
+            depth = reader.readVarint()
+            level = reader.readVarint()
+            message = ("MERKLE", pushPullID, filter, fsic, depth, level, self.readBucketHashes(reader))
+        elif messageType == MERKLE2:
+            level = reader.readVarint()
+            message = ("MERKLE2", pushPullID, level, [reader.readVarint() for i in range(reader.readVarint())])
+        elif messageType == MANIFEST:
+            filter = self.readFilter(reader)
+            changes = self.readFSIC(reader)
+            manifest = []
+            for i in range(reader.readVarint()):
+                recordID = self.readString(reader)
+                instanceID = self.readInstance(reader)
+                manifest.append((recordID, instanceID, reader.readVarint()))
+            message = ("MANIFEST", pushPullID, (filter, (changes, manifest)))
+        elif messageType == FETCH:
+            indexes = []
+            for i in range(reader.readVarint()):
+                indexes.append(reader.readVarint() + (indexes[-1] + 1 if indexes else 0))
+            message = ("FETCH", pushPullID, indexes)
+        elif messageType == CREDIT:
+            message = ("CREDIT", pushPullID, reader.readVarint())
+        else:
+            raise WireFormatError("Unknown message type : " + str(messageType))
+
+        if reader.position != len(payload):
+            raise WireFormatError("Trailing bytes after message")
+        return message
+
+    def feed(self, data):
+        """
+        Adds received bytes and returns the list of messages completed by them
+        """
+        self.buffer.extend(data)
+        messages = []
+        while True:
+            # A frame is complete once its length prefix and payload have arrived
+            reader = Reader(self.buffer)
+            try:
+                length = reader.readVarint()
+            except WireFormatError:
+                break
+            if reader.position + length > len(self.buffer):
+                break
+            messages.append(self.decodePayload(bytes(self.buffer[reader.position:reader.position + length])))
+            del self.buffer[:reader.position + length]
+        return messages